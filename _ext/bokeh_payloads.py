@@ -0,0 +1,53 @@
+'''
+Sphinx extension: content-addressed sidecar files for Bokeh figure data
+
+Figures displayed with neurodyn.plotting.Show normally inline their large
+arrays into the page, once per page. During the book build this extension
+asks Show to write each array to a sidecar file named by its content hash
+instead, so an array shared by several figures or chapters is stored once,
+and pages only fetch the data of the figures a reader scrolls to.
+
+The sidecars are kept in _build/.bokeh_sidecars, next to the execution
+cache, and copied to _static/bokeh/ in the HTML output at the end of the build.
+'''
+import os
+import shutil
+
+# The environment variables read by neurodyn.plotting.Show
+SIDECAR_DIR_VARIABLE = "NEURODYN_BOKEH_SIDECARS"
+SIDECAR_URL_VARIABLE = "NEURODYN_BOKEH_URL"
+
+
+def _SidecarDirectory(app):
+    return os.path.abspath(os.path.join(app.outdir, os.pardir, ".bokeh_sidecars"))
+
+
+def SetSidecarDirectory(app, config):
+    '''
+    Points Show at the sidecar directory before the notebooks are executed
+    '''
+    directory = _SidecarDirectory(app)
+    os.makedirs(directory, exist_ok=True)
+    # The kernels inherit the build's environment
+    os.environ[SIDECAR_DIR_VARIABLE] = directory
+    os.environ[SIDECAR_URL_VARIABLE] = "_static/bokeh/"
+
+
+def CopySidecars(app, exception):
+    '''
+    Copies the sidecars that the HTML output does not have yet
+    '''
+    if exception is not None or app.builder.format != "html":
+        return
+    target = os.path.join(app.outdir, "_static", "bokeh")
+    os.makedirs(target, exist_ok=True)
+    directory = _SidecarDirectory(app)
+    for name in os.listdir(directory):
+        if not os.path.exists(os.path.join(target, name)):
+            shutil.copy2(os.path.join(directory, name), target)
+
+
+def setup(app):
+    app.connect("config-inited", SetSidecarDirectory)
+    app.connect("build-finished", CopySidecars)
+    return {"parallel_read_safe": True, "parallel_write_safe": True}
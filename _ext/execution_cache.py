@@ -0,0 +1,165 @@
+'''
+Sphinx extension: invalidates cached notebook outputs when their input files change
+
+With execute_notebooks: cache, jupyter-cache stores the outputs of every
+notebook keyed by a hash of its code cells, so a rebuild after an edit to the
+prose of a chapter reuses the stored outputs instead of running any code. The
+hash does not cover the files the code reads, though: a change to the neurodyn
+package would leave stale figures in the book.
+
+This extension hashes, for every notebook, the modules of the local packages
+(execution_cache_packages) that its code cells import, following the imports
+between those modules, together with the package's __init__.py. A notebook
+whose hash differs from the one stored with the cache loses its cached
+outputs, and only it is executed again. Files matched by the
+execution_cache_inputs glob patterns are inputs of every notebook: a change to
+any of them clears the whole cache.
+'''
+import ast
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+
+from notebook_paths import Notebooks, CachePath
+
+STAMP = "inputs.json"
+CODE_CELL = re.compile(r"^```\{code-cell\}[^\n]*\n(.*?)^```", re.MULTILINE | re.DOTALL)
+# The ":key: value" lines or "---" YAML block of cell options at the top of a MyST code cell
+CELL_OPTIONS = re.compile(r"\A(?:---\n.*?^---\n|(?::[^\n]*\n)+)", re.MULTILINE | re.DOTALL)
+
+
+def InputsHash(root, patterns):
+    '''
+    Hashes the names and contents of every file matching the glob patterns
+    '''
+    paths = sorted({path for pattern in patterns for path in glob.glob(os.path.join(root, pattern), recursive=True)})
+    return FilesHash(root, paths)
+
+
+def FilesHash(root, paths):
+    '''
+    Hashes the names (relative to root) and contents of files
+    '''
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(os.path.relpath(path, root).encode())
+        with open(path, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def CodeCells(path):
+    '''
+    The sources of the code cells of a MyST markdown or .ipynb notebook
+    '''
+    with open(path) as f:
+        text = f.read()
+    if path.endswith(".ipynb"):
+        return ["".join(cell["source"]) for cell in json.loads(text)["cells"] if cell["cell_type"] == "code"]
+    return [CELL_OPTIONS.sub("", cell) for cell in CODE_CELL.findall(text)]
+
+
+def ImportedModules(source):
+    '''
+    The absolute module names imported by Python source; IPython magics are skipped
+    '''
+    source = "\n".join("" if line.lstrip().startswith(("%", "!")) else line for line in source.splitlines())
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return set()
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules.add(node.module)
+            # from package import module
+            modules.update(f"{node.module}.{alias.name}" for alias in node.names)
+    return modules
+
+
+def ModuleFiles(root, modules, packages):
+    '''
+    The files of the local package modules imported, directly or through each other
+
+    Importing any module of a package also runs the package's __init__.py, whose
+    own file is included; the modules it imports are not followed.
+    '''
+    files, seen = set(), set()
+    pending = list(modules)
+    while pending:
+        name = pending.pop()
+        parts = name.split(".")
+        if name in seen or parts[0] not in packages:
+            continue
+        seen.add(name)
+        path = os.path.join(root, *parts) + ".py"
+        if not os.path.exists(path):
+            path = os.path.join(root, *parts, "__init__.py")
+            if not os.path.exists(path):
+                continue
+        files.update((os.path.join(root, parts[0], "__init__.py"), path))
+        if not path.endswith("__init__.py"):
+            with open(path) as f:
+                pending.extend(ImportedModules(f.read()))
+    return sorted(path for path in files if os.path.exists(path))
+
+
+def NotebookHashes(root, notebooks, packages):
+    '''
+    The hash of the local modules each notebook imports, by path relative to root
+    '''
+    hashes = {}
+    for path in notebooks:
+        modules = set().union(*map(ImportedModules, CodeCells(path)))
+        hashes[os.path.relpath(path, root)] = FilesHash(root, ModuleFiles(root, modules, packages))
+    return hashes
+
+
+def _RemoveCachedOutputs(cache_path, paths):
+    '''
+    Removes the cached outputs of the notebooks at paths
+    '''
+    from jupyter_cache import get_cache
+
+    cache = get_cache(cache_path)
+    paths = {os.path.abspath(path) for path in paths}
+    for record in cache.list_cache_records():
+        if os.path.abspath(record.uri) in paths:
+            cache.remove_cache(record.pk)
+
+
+def CheckInputs(app, config):
+    '''
+    Drops the cached outputs of every notebook whose inputs changed since it was cached
+    '''
+    cache = os.path.abspath(CachePath(app))
+    stamp = os.path.join(cache, STAMP)
+    current = {"inputs": InputsHash(app.srcdir, config.execution_cache_inputs),
+               "notebooks": NotebookHashes(app.srcdir, Notebooks(app.srcdir), config.execution_cache_packages)}
+    previous = {}
+    if os.path.exists(stamp):
+        with open(stamp) as f:
+            previous = json.load(f)
+    if previous.get("inputs") != current["inputs"]:
+        if os.path.isdir(cache):
+            shutil.rmtree(cache)
+    else:
+        changed = [name for name, digest in current["notebooks"].items()
+                   if previous.get("notebooks", {}).get(name) != digest]
+        if changed:
+            _RemoveCachedOutputs(cache, [os.path.join(app.srcdir, name) for name in changed])
+    os.makedirs(cache, exist_ok=True)
+    with open(stamp, "w") as f:
+        json.dump(current, f, indent=1)
+
+
+def setup(app):
+    app.add_config_value("execution_cache_inputs", [], "env")
+    app.add_config_value("execution_cache_packages", ["neurodyn"], "env")
+    app.connect("config-inited", CheckInputs)
+    return {"parallel_read_safe": True, "parallel_write_safe": True}
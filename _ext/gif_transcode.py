@@ -0,0 +1,123 @@
+'''
+Sphinx extension: serves animated GIFs as muted looping video or animated WebP
+
+GIF is a very inefficient format for the book's animations. For every GIF in a
+page, this extension makes an H.264 video with a poster frame (when ffmpeg is
+installed) or else an animated WebP (with Pillow), entirely offline, and wraps
+the figure's image in a <picture> element that prefers the WebP, or replaces
+it with a <video>. In a <picture> the original GIF stays as the fallback image.
+A <video> shows its poster frame before playing, and holds only a link to the
+GIF as fallback content: an <img> there would keep the GIF referenced, and
+browsers often fetch it anyway. A transcoded file that is not smaller than its
+GIF is not used.
+
+Configuration (in the sphinx: config: section of _config.yml)
+    gif_transcode: "auto" (video if ffmpeg is available, else WebP), "video", "webp", or "off"
+    gif_webp_quality: the lossy WebP quality, 0-100
+'''
+import html
+import os
+import shutil
+import subprocess
+
+from docutils import nodes
+from sphinx.util import logging
+
+from media_cache import CacheDirectory, ContentKey, ImageNodes, Publish
+
+LOGGER = logging.getLogger(__name__)
+
+
+def TranscodeWebP(source, target, quality=75):
+    '''
+    Converts an animated GIF to an animated WebP with the same frame durations and looping
+    '''
+    from PIL import Image, ImageSequence
+
+    with Image.open(source) as gif:
+        frames, durations = [], []
+        for frame in ImageSequence.Iterator(gif):
+            frames.append(frame.convert("RGBA"))
+            durations.append(frame.info.get("duration", 100))
+        frames[0].save(target, "WEBP", save_all=True, append_images=frames[1:], duration=durations,
+                       loop=gif.info.get("loop", 0), quality=quality, method=6)
+
+
+def TranscodeVideo(source, target, poster):
+    '''
+    Converts an animated GIF to a silent H.264 video, and saves its first frame as the poster
+    '''
+    from PIL import Image
+
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-i", source, "-an", "-movflags", "faststart",
+                    "-pix_fmt", "yuv420p", "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2", target], check=True)
+    with Image.open(source) as gif:
+        gif.convert("RGB").save(poster, "JPEG", quality=85)
+
+
+def _Transcoded(app, source):
+    '''
+    The cached transcodes of a GIF, made on first use
+
+    Outputs
+        A dict with "video" and "poster" or "webp" paths, or None if they would not be smaller
+    '''
+    mode = app.config.gif_transcode
+    if mode == "auto":
+        mode = "video" if shutil.which("ffmpeg") else "webp"
+    directory = CacheDirectory(app)
+    key = ContentKey(source, mode, app.config.gif_webp_quality)
+    if mode == "video":
+        files = {"video": os.path.join(directory, f"{key}.mp4"), "poster": os.path.join(directory, f"{key}.jpg")}
+        if not os.path.exists(files["video"]):
+            TranscodeVideo(source, files["video"], files["poster"])
+    else:
+        files = {"webp": os.path.join(directory, f"{key}.webp")}
+        if not os.path.exists(files["webp"]):
+            TranscodeWebP(source, files["webp"], app.config.gif_webp_quality)
+    main = files.get("video", files.get("webp"))
+    if os.path.getsize(main) >= os.path.getsize(source):
+        return None
+    return files
+
+
+def RewriteGifs(app, doctree, docname):
+    '''
+    Wraps every GIF image of a page in a <video> or <picture> element preferring its transcode
+    '''
+    if app.builder.format != "html" or app.config.gif_transcode == "off":
+        return
+    for node in ImageNodes(doctree):
+        uri = node["uri"]
+        if not uri.lower().endswith(".gif") or "://" in uri:
+            continue
+        source = os.path.join(app.srcdir, uri)
+        try:
+            files = _Transcoded(app, source)
+        except (OSError, subprocess.CalledProcessError) as error:
+            LOGGER.warning(f"Could not transcode {uri}: {error}")
+            continue
+        if files is None:
+            continue
+        uris = {kind: html.escape(Publish(app, docname, path)) for kind, path in files.items()}
+        if "video" in uris:
+            width = f' width="{html.escape(node["width"])}"' if "width" in node else ""
+            alt = html.escape(node.get("alt", os.path.basename(uri)))
+            node.replace_self(nodes.raw(
+                "", f'<video autoplay loop muted playsinline poster="{uris["poster"]}"{width} '
+                    f'style="max-width:100%;height:auto"><source src="{uris["video"]}" type="video/mp4">'
+                    f'<a href="{html.escape(Publish(app, docname, source))}">{alt}</a></video>', format="html"))
+            continue
+        start = f'<picture><source srcset="{uris["webp"]}" type="image/webp">'
+        end = "</picture>"
+        parent = node.parent
+        index = parent.index(node)
+        parent.insert(index + 1, nodes.raw("", end, format="html"))
+        parent.insert(index, nodes.raw("", start, format="html"))
+
+
+def setup(app):
+    app.add_config_value("gif_transcode", "auto", "html")
+    app.add_config_value("gif_webp_quality", 75, "html")
+    app.connect("doctree-resolved", RewriteGifs)
+    return {"parallel_read_safe": True, "parallel_write_safe": True}
@@ -0,0 +1,55 @@
+'''
+Content-addressed cache of the media files generated during the book build
+
+The media extensions (gif_transcode.py, responsive_images.py) derive new files
+from the book's images. Each derived file is named after a hash of its source
+file's contents and of the settings it was made with, and kept in
+_build/.media_cache, so a rebuild only regenerates the files whose source or
+settings changed. Files used by a page are copied to _images/ in the HTML
+output, next to the images Sphinx copies itself.
+'''
+import hashlib
+import os
+import posixpath
+import shutil
+
+
+def CacheDirectory(app):
+    directory = os.path.abspath(os.path.join(app.outdir, os.pardir, ".media_cache"))
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def ContentKey(path, *settings):
+    '''
+    Hashes a source file together with the settings used to derive files from it
+    '''
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    digest.update(repr(settings).encode())
+    return digest.hexdigest()[:20]
+
+
+def Publish(app, docname, path):
+    '''
+    Copies a cached file into the HTML output's _images/ directory
+
+    Outputs
+        The file's URI relative to the page of docname
+    '''
+    target = os.path.join(app.outdir, "_images")
+    os.makedirs(target, exist_ok=True)
+    name = os.path.basename(path)
+    if not os.path.exists(os.path.join(target, name)):
+        shutil.copy2(path, target)
+    page = app.builder.get_target_uri(docname)
+    return posixpath.relpath(posixpath.join("_images", name), posixpath.dirname(page) or ".")
+
+
+def ImageNodes(doctree):
+    from docutils import nodes
+
+    # docutils 0.18 renamed traverse to findall
+    return list(getattr(doctree, "findall", doctree.traverse)(nodes.image))
@@ -0,0 +1,59 @@
+'''
+The notebooks of the book and the location of their execution cache
+
+Shared by the execution extensions (execution_cache.py, parallel_execute.py),
+which must agree on which files are notebooks and where jupyter-cache keeps
+their outputs.
+'''
+import os
+
+import yaml
+
+
+def TocFiles(root):
+    '''
+    Lists the files of _toc.yml in reading order, without extensions
+    '''
+    with open(os.path.join(root, "_toc.yml")) as f:
+        toc = yaml.safe_load(f)
+    files = [toc["root"]]
+
+    def Walk(entries):
+        for entry in entries or []:
+            if "file" in entry:
+                files.append(entry["file"])
+            Walk(entry.get("sections"))
+            Walk(entry.get("chapters"))
+
+    Walk(toc.get("parts"))
+    Walk(toc.get("chapters"))
+    Walk(toc.get("sections"))
+    return files
+
+
+def Notebooks(root):
+    '''
+    The TOC files that have code to execute, as paths
+    '''
+    paths = []
+    for name in TocFiles(root):
+        for extension in (".ipynb", ".md"):
+            path = os.path.join(root, name + extension)
+            if os.path.exists(path):
+                break
+        else:
+            continue
+        if extension == ".md":
+            with open(path) as f:
+                if "```{code-cell}" not in f.read():
+                    continue
+        paths.append(path)
+    return paths
+
+
+def CachePath(app):
+    '''
+    The jupyter-cache directory configured for the build (execute: cache: in _config.yml)
+    '''
+    path = getattr(app.config, "nb_execution_cache_path", "") or getattr(app.config, "jupyter_cache", "")
+    return path or os.path.join(app.outdir, os.pardir, ".jupyter_cache")
@@ -0,0 +1,79 @@
+'''
+Sphinx extension: executes the book's notebooks in parallel before the build reads them
+
+The chapters do not depend on each other, but the build executes them one
+after another as it reads each page. This extension fills the execution cache
+first: every notebook listed in _toc.yml whose cached outputs are missing or
+stale is executed by jupyter-cache's local-parallel executor, one kernel per
+notebook on a pool of worker processes sized to the number of CPUs. The build
+then reads every page's outputs from the cache, in TOC order as usual, and the
+execution time of each chapter is reported in the build log.
+
+It only runs when execute_notebooks is cache, after execution_cache.py has
+checked the cache against the input files.
+'''
+import os
+import time
+
+from sphinx.util import logging
+
+from notebook_paths import Notebooks, CachePath
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _Option(config, *names, default=None):
+    '''
+    Reads an execution option under its current myst-nb name or an older one
+    '''
+    for name in names:
+        value = getattr(config, name, None)
+        if value is not None:
+            return value
+    return default
+
+
+def ExecuteNotebooks(app, config):
+    '''
+    Fills the execution cache with every stale notebook, executed in parallel
+    '''
+    if _Option(config, "nb_execution_mode", "jupyter_execute_notebooks") != "cache":
+        return
+    from jupyter_cache import get_cache
+    from jupyter_cache.executors import load_executor
+
+    cache = get_cache(os.path.abspath(CachePath(app)))
+    paths = Notebooks(app.srcdir)
+    records = {path: cache.add_nb_to_project(path, read_data={"name": "jupytext", "type": "plugin"})
+               for path in paths}
+    stale = {record.pk for record in cache.list_unexecuted(filter_pks=[r.pk for r in records.values()])}
+    if not stale:
+        return
+
+    LOGGER.info(f"Executing {len(stale)} of {len(paths)} notebooks on {os.cpu_count()} cores")
+    start = time.perf_counter()
+    executor = load_executor("local-parallel", cache=cache, logger=LOGGER)
+    executor.run_and_cache(filter_pks=sorted(stale),
+                           timeout=_Option(config, "nb_execution_timeout", "execution_timeout", default=30),
+                           allow_errors=_Option(config, "nb_execution_allow_errors", "execution_allow_errors",
+                                                default=False),
+                           run_in_temp=_Option(config, "nb_execution_in_temp", "execution_in_temp", default=False))
+
+    # Report in TOC order
+    for path, record in records.items():
+        name = os.path.relpath(path, app.srcdir)
+        if record.pk not in stale:
+            LOGGER.info(f"  {name}: cached")
+            continue
+        cached = cache.get_cached_project_nb(record.pk)
+        if cached is None:
+            LOGGER.warning(f"  {name}: failed, see the execution report")
+        else:
+            LOGGER.info(f"  {name}: {cached.data.get('execution_seconds', float('nan')):.1f} s")
+    LOGGER.info(f"Executed in {time.perf_counter() - start:.1f} s of wall time")
+
+
+def setup(app):
+    # After execution_cache.py, which may clear the cache
+    app.connect("config-inited", ExecuteNotebooks, priority=900)
+    return {"parallel_read_safe": True, "parallel_write_safe": True}
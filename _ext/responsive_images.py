@@ -0,0 +1,148 @@
+'''
+Sphinx extension: responsive, recompressed images with srcset
+
+Many of the book's figures are photographs and renders several megabytes in
+size, far more than a page column can show. For every PNG or JPEG image in a
+page, this extension makes copies at a few fixed widths (never wider than the
+original) in AVIF and WebP, plus a recompressed fallback in the original
+format, and replaces the image with a <picture> element whose srcset and sizes
+let the browser download only the width it needs. Every image after the
+first one on a page is marked loading="lazy", since it starts below the fold.
+Derived files are cached by content hash (see media_cache.py).
+
+Configuration (in the sphinx: config: section of _config.yml)
+    responsive_image_widths: the widths (px) of the derived copies
+    responsive_image_formats: the modern formats to offer, in order of preference
+    responsive_image_column: the widest the page column gets (px), for sizes
+    responsive_image_quality: the lossy quality of the derived copies, 0-100
+'''
+import html
+import os
+
+from docutils import nodes
+from sphinx.util import logging
+
+from media_cache import CacheDirectory, ContentKey, ImageNodes, Publish
+
+LOGGER = logging.getLogger(__name__)
+
+_EXTENSIONS = {".png": "png", ".jpg": "jpeg", ".jpeg": "jpeg"}
+_MIME = {"avif": "image/avif", "webp": "image/webp", "png": "image/png", "jpeg": "image/jpeg"}
+
+
+def _Save(image, path, format, quality):
+    if format == "jpeg":
+        image.convert("RGB").save(path, "JPEG", quality=quality, optimize=True, progressive=True)
+    elif format == "png":
+        image.save(path, "PNG", optimize=True)
+    elif format == "webp":
+        image.save(path, "WEBP", quality=quality, method=6)
+    else:
+        image.save(path, format.upper(), quality=quality)
+
+
+def Derivatives(app, source):
+    '''
+    The cached width-stepped copies of an image, made on first use
+
+    Outputs
+        (width, height, copies): the original size, and for each format a list of (width, path)
+    '''
+    from PIL import Image, features
+
+    config = app.config
+    fallback = _EXTENSIONS[os.path.splitext(source)[1].lower()]
+    formats = [f for f in config.responsive_image_formats if features.check(f)] + [fallback]
+    key = ContentKey(source, config.responsive_image_widths, formats, config.responsive_image_quality)
+    directory = CacheDirectory(app)
+
+    with Image.open(source) as image:
+        width, height = image.size
+        # Copies wider than the widest step would only be used on very high density screens
+        steps = [w for w in sorted(config.responsive_image_widths) if w < width]
+        if width <= max(config.responsive_image_widths) or not steps:
+            steps.append(width)
+        copies = {format: [] for format in formats}
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info or "A" in image.mode else "RGB")
+        for w in steps:
+            resized = None
+            for format in formats:
+                path = os.path.join(directory, f"{key}-{w}.{'jpg' if format == 'jpeg' else format}")
+                if not os.path.exists(path):
+                    if resized is None:
+                        resized = image if w == width else image.resize((w, round(height * w / width)),
+                                                                         Image.LANCZOS)
+                    _Save(resized, path, format, config.responsive_image_quality)
+                copies[format].append((w, path))
+    return width, height, copies
+
+
+def _DisplayWidth(node, width, column):
+    '''
+    The width the image is shown at, from its :width: and :scale: options
+
+    Outputs
+        (shown, percent): the largest width in pixels, and the percentage of a
+        narrow viewport (at most column wide) the image spans
+    '''
+    option = node.get("width", "")
+    percent = 100.0
+    if option.endswith("px") or option.isdigit():
+        shown = float(option.rstrip("px"))
+    elif option.endswith("%"):
+        percent = float(option[:-1])
+        shown = column * percent / 100
+    else:
+        shown = width * node.get("scale", 100) / 100
+    return int(min(shown, column)), percent
+
+
+def RewriteImages(app, doctree, docname):
+    '''
+    Replaces every PNG and JPEG image of a page by a responsive <picture> element
+    '''
+    if app.builder.format != "html":
+        return
+    config = app.config
+    first = True
+    for node in ImageNodes(doctree):
+        uri = node["uri"]
+        if os.path.splitext(uri)[1].lower() not in _EXTENSIONS or "://" in uri:
+            continue
+        try:
+            width, height, copies = Derivatives(app, os.path.join(app.srcdir, uri))
+        except OSError as error:
+            LOGGER.warning(f"Could not make responsive copies of {uri}: {error}")
+            continue
+
+        shown, percent = _DisplayWidth(node, width, config.responsive_image_column)
+        sizes = f"(max-width: {config.responsive_image_column}px) {percent:g}vw, {shown}px"
+        srcsets = {format: ", ".join(f"{html.escape(Publish(app, docname, path))} {w}w" for w, path in paths)
+                   for format, paths in copies.items()}
+        *modern, fallback = copies
+        # The fallback's src is the smallest copy at least as wide as the image is shown
+        src = next((path for w, path in copies[fallback] if w >= shown), copies[fallback][-1][1])
+
+        lazy = "" if first else ' loading="lazy"'
+        classes = node.get("classes", []) + ([f"align-{node['align']}"] if "align" in node else [])
+        classes = f' class="{" ".join(classes)}"' if classes else ""
+        parts = ["<picture>"]
+        parts += [f'<source type="{_MIME[f]}" srcset="{srcsets[f]}" sizes="{sizes}">' for f in modern]
+        parts.append(f'<img src="{html.escape(Publish(app, docname, src))}" srcset="{srcsets[fallback]}" '
+                     f'sizes="{sizes}" width="{shown}" height="{round(height * shown / width)}" '
+                     f'alt="{html.escape(node.get("alt", ""))}"{classes} '
+                     f'style="max-width:100%;height:auto"'
+                     f'{lazy} decoding="async">')
+        parts.append("</picture>")
+        node.replace_self(nodes.raw("", "".join(parts), format="html"))
+        first = False
+
+
+def setup(app):
+    app.add_config_value("responsive_image_widths", [480, 800, 1200, 1600], "html")
+    app.add_config_value("responsive_image_formats", ["avif", "webp"], "html")
+    app.add_config_value("responsive_image_column", 800, "html")
+    app.add_config_value("responsive_image_quality", 80, "html")
+    app.connect("doctree-resolved", RewriteImages)
+    return {"parallel_read_safe": True, "parallel_write_safe": True}
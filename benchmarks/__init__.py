@@ -0,0 +1,9 @@
+'''
+Throughput benchmarks of the neurodyn kernels
+
+Run the suite from the book's root directory with
+
+    python -m benchmarks.run
+
+See benchmarks/run.py for the options and the report format.
+'''
@@ -0,0 +1,219 @@
+'''
+Throughput benchmark suite for the neurodyn kernels
+
+Every benchmark times one kernel of the package on a fixed, seeded problem:
+the Nernst and GHK evaluations of Chapter 2, the passive RC and
+Hodgkin-Huxley integrators of Chapter 5 at several population sizes and
+step sizes, and the phase-plane grid evaluation. Each reports its throughput
+in work units per second (neurons x steps for the integrators, evaluations
+or grid points for the rest), the best wall time of a few repeats, and the
+peak memory the kernel allocates, measured with tracemalloc in a separate run.
+
+Throughputs and peak memory are compared with the stored baselines in
+benchmarks/baselines.json; a benchmark regresses when its throughput falls,
+or its peak memory rises, by more than the tolerance. Baselines depend on the
+machine, so record them on the machine that runs the comparisons:
+
+    python -m benchmarks.run                     compare with the baselines
+    python -m benchmarks.run --update            store the results as the new baselines
+    python -m benchmarks.run --filter hh --output report.json
+
+The report is JSON, printed to stdout or written to --output, and the exit
+status is 1 when any benchmark regressed. Everything runs offline on one CPU.
+'''
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+
+import numpy as np
+
+from neurodyn.ions import NernstPotential, MAMMALIAN_IONS
+from neurodyn.ghk import GHKCurrent, GHKTableVoltage
+from neurodyn.passive import PassiveTrace
+from neurodyn.hh import ConductanceBasedPopulation
+from neurodyn.phase_plane import ReducedModel, ComputePhasePortrait
+
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+
+
+@dataclass
+class Benchmark:
+    '''
+    A named kernel and its problem size
+
+    setup() builds the inputs and returns (run, n_units): a callable that does
+    the timed work once, and the number of work units it processes.
+    '''
+    name: str
+    unit: str
+    setup: object
+
+
+def _Nernst(n):
+    def Setup():
+        rng = np.random.default_rng(0)
+        C_in = rng.uniform(1.0, 150.0, n)
+        C_out = rng.uniform(1.0, 150.0, n)
+        out = np.empty(n)
+        return lambda: NernstPotential(1.0, 310.15, C_in, C_out, out=out), n
+    return Benchmark(f"nernst/n={n}", "evaluations", Setup)
+
+
+def _GHKCurrent(n):
+    def Setup():
+        V = np.linspace(-100.0, 60.0, n)
+        return lambda: GHKCurrent(V, 1e-6, 1.0, 140.0, 5.0), n
+    return Benchmark(f"ghk_current/n={n}", "evaluations", Setup)
+
+
+def _GHKVoltage(n):
+    def Setup():
+        # Calcium is permeant, so the resting potential is found by the root search
+        P = np.random.default_rng(0).uniform(1e-8, 1e-6, (n, len(MAMMALIAN_IONS)))
+        return lambda: GHKTableVoltage(P), n
+    return Benchmark(f"ghk_voltage/n={n}", "configurations", Setup)
+
+
+def _Passive(N, dt, t_stop=10.0):
+    def Setup():
+        n_steps = int(round(t_stop / dt))
+        I_inj = np.random.default_rng(0).uniform(0.0, 2.0, (n_steps, N))
+        out = np.empty((n_steps + 1, N))
+        return lambda: PassiveTrace(I_inj, dt, out=out), N * n_steps
+    return Benchmark(f"passive/N={N}/dt={dt}", "neuron-steps", Setup)
+
+
+def _HH(N, dt, t_stop=10.0):
+    def Setup():
+        pop = ConductanceBasedPopulation(N)
+        I_inj = np.linspace(0.0, 20.0, N)
+
+        def Run():
+            pop.Reset()
+            pop.Run(t_stop, dt, I_inj)
+        return Run, N * int(round(t_stop / dt))
+    return Benchmark(f"hh/N={N}/dt={dt}", "neuron-steps", Setup)
+
+
+def _PhasePlane(n):
+    def Setup():
+        f = ReducedModel(I_inj=10.0)
+        return lambda: ComputePhasePortrait(f, (-80.0, 50.0), (0.0, 1.0), (n, n)), n * n
+    return Benchmark(f"phase_plane/{n}x{n}", "grid points", Setup)
+
+
+BENCHMARKS = ([_Nernst(1_000_000), _GHKCurrent(1_000_000), _GHKVoltage(10_000)]
+              + [_Passive(N, dt) for N in (1_000, 10_000) for dt in (0.01, 0.1)]
+              + [_HH(N, dt) for N in (100, 10_000) for dt in (0.01, 0.05)]
+              + [_PhasePlane(500)])
+
+
+def Measure(benchmark, repeats=3, min_time=0.2):
+    '''
+    Times a benchmark and measures the peak memory of one run
+
+    Each repeat runs the kernel as many times as fit in min_time seconds, and
+    the best time per run over the repeats is kept.
+
+    Outputs
+        A dict with the benchmark's name, unit, throughput (units/s), seconds per run, and peak_bytes
+    '''
+    run, n_units = benchmark.setup()
+    run()   # warm up
+    best = np.inf
+    for _ in range(repeats):
+        n_runs, start = 0, time.perf_counter()
+        while True:
+            run()
+            n_runs += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = min(best, elapsed / n_runs)
+
+    gc.collect()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"name": benchmark.name, "unit": benchmark.unit, "throughput": n_units / best, "seconds": best,
+            "peak_bytes": peak}
+
+
+def Compare(result, baseline, tolerance):
+    '''
+    Adds the ratios to the baseline and the regression flag to a result
+    '''
+    if baseline is None:
+        result.update(baseline=None, regression=False)
+        return result
+    speed = result["throughput"] / baseline["throughput"]
+    memory = result["peak_bytes"] / max(baseline["peak_bytes"], 1)
+    result.update(baseline=baseline, throughput_ratio=speed, memory_ratio=memory,
+                  regression=bool(speed < 1 - tolerance or memory > 1 + tolerance))
+    return result
+
+
+def Machine():
+    '''
+    Describes the machine and library versions the results were measured with
+    '''
+    return {"platform": platform.platform(), "processor": platform.processor() or platform.machine(),
+            "cpus": os.cpu_count(), "python": platform.python_version(), "numpy": np.__version__}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput benchmarks of the neurodyn kernels")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--baselines", default=BASELINES, help="the baseline file")
+    parser.add_argument("--update", action="store_true", help="store the results as the new baselines")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="the fraction by which throughput may drop or memory rise")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--min-time", type=float, default=0.2, help="the minimum time (s) of each repeat")
+    parser.add_argument("--output", help="write the report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)["results"]
+
+    results = []
+    for benchmark in BENCHMARKS:
+        if args.filter not in benchmark.name:
+            continue
+        result = Compare(Measure(benchmark, args.repeats, args.min_time), baselines.get(benchmark.name),
+                         args.tolerance)
+        print(f"{result['name']:<28} {result['throughput']:12.4g} {result['unit']}/s "
+              f"{result['peak_bytes'] / 2**20:9.1f} MiB" + ("  REGRESSION" if result["regression"] else ""),
+              file=sys.stderr)
+        results.append(result)
+
+    report = {"machine": Machine(), "tolerance": args.tolerance, "results": results,
+              "regressions": [r["name"] for r in results if r["regression"]]}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.update:
+        baselines.update({r["name"]: {key: r[key] for key in ("unit", "throughput", "peak_bytes")}
+                          for r in results})
+        with open(args.baselines, "w") as f:
+            json.dump({"machine": report["machine"], "results": baselines}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        return 0
+    return 1 if report["regressions"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
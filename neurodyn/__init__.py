@@ -0,0 +1,36 @@
+'''
+Simulation and analysis code for A Visual Introduction to Dynamical Neuroscience
+
+The chapters import from this package so that the models they describe can be
+run at scale outside of the book as well. The Bokeh plotting helpers in
+neurodyn.plotting are imported from that module directly, so that the
+simulation code does not depend on Bokeh.
+'''
+from neurodyn.ions import (R, F, T_phys, ION_DTYPE, MAMMALIAN_IONS, IonTable,
+                           NernstPotential, ReversalPotentials)
+from neurodyn.ghk import GHKCurrent, GHKVoltage, GHKTableVoltage, CheckSingleIonLimit
+from neurodyn.passive import PassiveTimeConstant, PassiveStep, PassiveTrace, PassiveStepResponse
+from neurodyn.hh import (T_squid, RateFunction, GateKinetics, Current, HH_m, HH_h, HH_n, HH_CURRENTS,
+                         ConductanceBasedPopulation)
+from neurodyn.gating_tables import VoltageGrid, GatingTable, GetGatingTable
+from neurodyn.spikes import SpikeTrains
+from neurodyn.adaptive import AdaptiveIntegrator
+from neurodyn.cable import HinesOrder, Morphology, SolveHines, MultiCompartmentNeuron
+from neurodyn.spikes import REST, TONIC, BURSTING, FIRING_PATTERNS, InterspikeIntervalStats, ClassifySpikeTrains
+from neurodyn.sweeps import ParameterGrid, LatinHypercube, ApplyParameters, SimulateChunk, ParameterSweep
+from neurodyn.continuation import (ConductanceBasedVectorField, FindEquilibrium, EquilibriumBranch,
+                                   ContinueEquilibria, LimitCycleBranch, ContinueLimitCycles)
+from neurodyn.phase_plane import (HH_H_OF_N, FIXED_POINT_TYPES, ReducedModel, MarchingSquares, SegmentsToLine,
+                                  FixedPoints, PhasePortrait, ComputePhasePortrait)
+from neurodyn.display import CacheThumbnail, PrefetchThumbnails, YouTubeVideo
+from neurodyn.animations import (ANIMATION_FORMATS, DiffusionScene, DispersionScene, CapacitorScene,
+                                 StokesEinsteinRatio, RenderAnimation)
+from neurodyn.stochastic import (METHODS, HH_CHANNEL_DENSITY, ChannelScheme, Streams, GillespieStep, LangevinStep,
+                                 StochasticPopulation)
+from neurodyn.network import SynapseMatrix, RandomSynapses, SynapseType, Network
+from neurodyn.parallel_network import (DefaultPopulation, Partitions, PartitionSynapses, PartitionRows,
+                                       ParallelNetwork)
+from neurodyn.traces import COMPRESSIONS, DOWNSAMPLING, TraceWriter, TraceStore
+from neurodyn.spike_stream import (BURST_CRITERIA, SimulatedSpikes, VoltageChunks, StoredVoltage, DetectSpikes,
+                                   PoissonSurprise, SpikeStreamStats, AnalyzeSpikeStream)
+from neurodyn.fi_curve import FICurves, ComputeFICurves, FindRheobase
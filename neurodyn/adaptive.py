@@ -0,0 +1,196 @@
+'''
+Adaptive-step integration of the conductance-based models of Chapter 5
+
+Action potentials are brief and stiff, while the stretches between them are
+slow and smooth. An AdaptiveIntegrator lets every neuron of a
+ConductanceBasedPopulation take its own step size, chosen from an embedded
+error estimate, so quiet neurons take long steps while spiking neurons take
+short ones, all within one vectorized loop over the population. Spikes are
+found as upward threshold crossings, located to sub-step accuracy on the
+cubic Hermite interpolant of each accepted step, and returned as compressed
+SpikeTrains instead of dense traces.
+
+Two methods are available:
+    "rk23":         the explicit Bogacki-Shampine 3(2) pair, for non-stiff regimes
+    "rosenbrock23": the linearly implicit, L-stable Rosenbrock 2(3) pair of
+                    Shampine and Reichelt (MATLAB's ode23s), for stiff regimes
+'''
+import numpy as np
+
+from neurodyn.spikes import SpikeTrains
+
+# Coefficients of the Rosenbrock 2(3) pair
+_ROS_D = 1 / (2 + np.sqrt(2))
+_ROS_E32 = 6 + np.sqrt(2)
+
+
+class AdaptiveIntegrator:
+    '''
+    Adaptive, per-neuron step-size integration of a ConductanceBasedPopulation
+
+    Inputs
+        population: ConductanceBasedPopulation
+            The population whose state (V, gates, t, spike_count) is advanced in place
+        method: str
+            "rosenbrock23" (stiff) or "rk23" (explicit)
+        rtol, atol: float
+            The relative and absolute error tolerances of each step
+        h0: float
+            The initial step size (ms)
+        h_min, h_max: float
+            The smallest and largest allowed step sizes (ms)
+
+    Attributes
+        h: array of shape (N,)
+            The next step size of each neuron, carried over between runs
+        n_accepted, n_rejected: int
+            The total number of accepted and rejected neuron-steps
+    '''
+
+    def __init__(self, population, method="rosenbrock23", rtol=1e-4, atol=1e-6, h0=0.01, h_min=1e-6, h_max=1.0):
+        if method not in ("rk23", "rosenbrock23"):
+            raise ValueError(f"Unknown method {method!r}, expected 'rk23' or 'rosenbrock23'")
+        self.population = population
+        self.method = method
+        self.rtol, self.atol = rtol, atol
+        self.h_min, self.h_max = h_min, h_max
+        self.h = np.full(population.N, h0)
+        self.n_accepted = 0
+        self.n_rejected = 0
+
+    def _Jacobian(self, y, f0, I_inj, index):
+        '''
+        Forward-difference Jacobian of the vector field, of shape (n, d, d)
+        '''
+        d, n = y.shape
+        J = np.empty((n, d, d))
+        for j in range(d):
+            delta = np.sqrt(np.finfo(float).eps) * np.maximum(np.abs(y[j]), 1.0)
+            yp = y.copy()
+            yp[j] += delta
+            J[:, :, j] = ((self.population.Derivatives(yp, I_inj, index) - f0) / delta).T
+        return J
+
+    def _Step(self, y, f0, h, I_inj, index):
+        '''
+        Takes one embedded step of size h (per column) from y
+
+        Outputs
+            (y_new, f_new, err): the new state, the vector field there, and the local error estimate
+        '''
+        F = self.population.Derivatives
+        if self.method == "rk23":
+            k2 = F(y + 0.5*h*f0, I_inj, index)
+            k3 = F(y + 0.75*h*k2, I_inj, index)
+            y_new = y + h*(2/9*f0 + 1/3*k2 + 4/9*k3)
+            f_new = F(y_new, I_inj, index)
+            err = h*(-5/72*f0 + 1/12*k2 + 1/9*k3 - 1/8*f_new)
+            return y_new, f_new, err
+
+        # Rosenbrock 2(3): every stage solves with W = I - h d J, inverted once per step
+        J = self._Jacobian(y, f0, I_inj, index)
+        W_inv = np.linalg.inv(np.eye(y.shape[0]) - (_ROS_D * h)[:, None, None] * J)
+
+        def Solve(v):
+            return np.einsum("nij,jn->in", W_inv, v)
+
+        k1 = Solve(f0)
+        f1 = F(y + 0.5*h*k1, I_inj, index)
+        k2 = Solve(f1 - k1) + k1
+        y_new = y + h*k2
+        f_new = F(y_new, I_inj, index)
+        k3 = Solve(f_new - _ROS_E32*(k2 - f1) - 2*(k1 - f0))
+        err = h/6*(k1 - 2*k2 + k3)
+        return y_new, f_new, err
+
+    def Run(self, t_stop, I_inj=0.0):
+        '''
+        Advances every neuron of the population by t_stop milliseconds
+
+        Inputs
+            t_stop: float
+                The duration of the run (ms)
+            I_inj: float or array of shape (N,)
+                The injected current density (uA/cm^2), constant over the run
+
+        Outputs
+            The SpikeTrains of the run, with times measured on the population's clock
+        '''
+        pop = self.population
+        V_thresh = pop.V_thresh
+        y = np.vstack([pop.V[np.newaxis], pop.gates]).astype(np.float64)
+        f = pop.Derivatives(y, I_inj)
+        t = np.zeros(pop.N)
+        active = np.arange(pop.N)
+        spike_neurons, spike_times = [], []
+
+        while active.size:
+            ya, fa = y[:, active], f[:, active]
+            h = np.minimum(self.h[active], t_stop - t[active])
+            y_new, f_new, err = self._Step(ya, fa, h, I_inj, active)
+
+            # Root-mean-square error relative to the mixed tolerance
+            scale = self.atol + self.rtol * np.maximum(np.abs(ya), np.abs(y_new))
+            err_norm = np.sqrt(np.mean((err / scale)**2, axis=0))
+            finite = np.all(np.isfinite(y_new), axis=0)
+            # Shortening the step no further cannot make a diverged state finite
+            stuck = ~finite & (h <= self.h_min)
+            if np.any(stuck):
+                k = np.argmax(stuck)
+                raise FloatingPointError(f"The state of neuron {active[k]} is not finite at t = "
+                                         f"{pop.t + t[active[k]]} ms, even at the smallest step {self.h_min} ms")
+            accept = ((err_norm <= 1) | (h <= self.h_min)) & finite
+
+            # Spikes: upward threshold crossings within accepted steps
+            crossed = accept & (ya[0] < V_thresh) & (y_new[0] >= V_thresh)
+            if np.any(crossed):
+                s = _HermiteCrossing(ya[0, crossed], fa[0, crossed], y_new[0, crossed],
+                                     f_new[0, crossed], h[crossed], V_thresh)
+                spike_neurons.append(active[crossed])
+                spike_times.append(pop.t + t[active[crossed]] + s*h[crossed])
+
+            done = active[accept]
+            y[:, done] = y_new[:, accept]
+            f[:, done] = f_new[:, accept]
+            t[done] += h[accept]
+            self.n_accepted += int(np.count_nonzero(accept))
+            self.n_rejected += int(accept.size - np.count_nonzero(accept))
+
+            # Standard step-size control for an embedded pair of orders 2 and 3
+            with np.errstate(divide="ignore"):
+                factor = np.clip(0.9 * err_norm**(-1/3), 0.2, 5.0)
+            factor = np.where(finite, factor, 0.2)
+            h_next = np.clip(h*factor, self.h_min, self.h_max)
+            # A step shortened to land on t_stop says nothing about the next one
+            truncated = accept & (h < self.h[active])
+            self.h[active] = np.where(truncated, np.maximum(self.h[active], h_next), h_next)
+
+            active = active[t[active] < t_stop * (1 - 1e-12)]
+
+        pop.V[:] = y[0]
+        pop.gates[:] = y[1:]
+        pop.t += t_stop
+        if spike_neurons:
+            spikes = SpikeTrains.FromEvents(np.concatenate(spike_neurons), np.concatenate(spike_times), pop.N)
+        else:
+            spikes = SpikeTrains([], np.zeros(pop.N + 1))
+        pop.spike_count += spikes.Counts()
+        return spikes
+
+
+def _HermiteCrossing(V0, dV0, V1, dV1, h, V_thresh, n_iter=40):
+    '''
+    Finds where the cubic Hermite interpolant of a step first reaches V_thresh
+
+    Outputs
+        The crossing as a fraction s in [0, 1] of each step
+    '''
+    lo, hi = np.zeros_like(V0), np.ones_like(V0)
+    for _ in range(n_iter):
+        s = 0.5 * (lo + hi)
+        s2, s3 = s*s, s*s*s
+        V = (2*s3 - 3*s2 + 1)*V0 + (s3 - 2*s2 + s)*h*dV0 + (3*s2 - 2*s3)*V1 + (s3 - s2)*h*dV1
+        above = V >= V_thresh
+        hi = np.where(above, s, hi)
+        lo = np.where(above, lo, s)
+    return 0.5 * (lo + hi)
@@ -0,0 +1,365 @@
+'''
+Procedural animations of the physics in Chapter 2
+
+The diffusion, ink dispersion, and capacitor charging animations are simulated
+and drawn here rather than shipped as fixed GIFs, so they can be rendered at
+any resolution and frame rate:
+
+    DiffusionScene   a random walk of many particles released from one side
+                     of a box when a dividing wall is lifted
+    DispersionScene  drops of ink spreading through a cold and a warm glass
+                     of water, with the diffusion coefficient set by temperature
+    CapacitorScene   charge building up on the plates of a capacitor charged
+                     through a resistor
+
+Each scene yields RGB frames one at a time. When ffmpeg is installed,
+RenderAnimation pipes them into it, so no more than one frame is held in
+memory whatever the duration. Without ffmpeg, WebP and GIF files are encoded
+with Pillow, which collects every frame before writing, so memory then grows
+with the number of frames. Given a byte budget, RenderAnimation lowers the
+encoding quality until the file fits; the scenes are seeded, so every render
+of a scene shows the same motion.
+'''
+import os
+import shutil
+import subprocess
+
+import numpy as np
+
+ANIMATION_FORMATS = (".webp", ".gif", ".mp4", ".webm")
+
+# Colors of high and low concentration
+PURPLE = np.array([88, 40, 120], dtype=np.float64)
+BEIGE = np.array([245, 235, 210], dtype=np.float64)
+
+
+def _Blend(fraction, high, low):
+    '''
+    Mixes two colors per pixel; fraction is 1 for high and 0 for low
+    '''
+    fraction = np.clip(fraction, 0, 1)[..., np.newaxis]
+    return (low + fraction * (high - low)).astype(np.uint8)
+
+
+def _Upsample(a, height, width):
+    '''
+    Bilinear interpolation of a coarse image to height x width pixels
+    '''
+    def Axis(n_out, n_in):
+        u = (np.arange(n_out) + 0.5) * n_in / n_out - 0.5
+        i0 = np.clip(np.floor(u).astype(np.intp), 0, n_in - 1)
+        return i0, np.minimum(i0 + 1, n_in - 1), np.clip(u - i0, 0, 1)
+
+    y0, y1, fy = Axis(height, a.shape[0])
+    x0, x1, fx = Axis(width, a.shape[1])
+    top = a[y0][:, x0] * (1 - fx) + a[y0][:, x1] * fx
+    bottom = a[y1][:, x0] * (1 - fx) + a[y1][:, x1] * fx
+    return top * (1 - fy)[:, np.newaxis] + bottom * fy[:, np.newaxis]
+
+
+class DiffusionScene:
+    '''
+    Particles diffusing out of the left part of a box once a wall is lifted
+
+    Inputs
+        n_particles: int
+            The number of particles
+        D: float
+            The diffusion coefficient, in box heights^2 per second
+        aspect: float
+            The width of the box in box heights
+        wall: float
+            The position of the wall as a fraction of the box width
+        t_wall: float
+            The time (s) at which the wall is lifted
+        n_tracers: int
+            The number of particles drawn as dots
+        seed: int
+            The seed of the random walk
+    '''
+
+    def __init__(self, n_particles=100_000, D=0.02, aspect=2.0, wall=0.25, t_wall=1.0, n_tracers=200, seed=0):
+        self.n_particles = n_particles
+        self.D = D
+        self.aspect = aspect
+        self.wall = wall * aspect
+        self.t_wall = t_wall
+        self.n_tracers = n_tracers
+        self.seed = seed
+
+    def Frames(self, width, height, fps, duration, substeps=4, cell=8):
+        '''
+        Yields the frames of the animation as uint8 arrays of shape (height, width, 3)
+
+        The background color shows the concentration, counted on a grid of cell x cell
+        pixel squares and interpolated; the first n_tracers particles are drawn as dots.
+        '''
+        rng = np.random.default_rng(self.seed)
+        x = rng.random(self.n_particles) * self.wall
+        y = rng.random(self.n_particles)
+        dt = 1.0 / (fps * substeps)
+        sigma = np.sqrt(2 * self.D * dt)
+        nx, ny = max(width // cell, 1), max(height // cell, 1)
+        # The count per grid square that shows as the darkest color: the initial density behind the wall
+        full = self.n_particles / (self.wall / self.aspect * nx * ny)
+        dot = max(width // 240, 1)
+        for frame in range(int(round(duration * fps))):
+            hist = np.bincount(np.minimum((y * ny).astype(np.intp), ny - 1) * nx
+                               + np.minimum((x / self.aspect * nx).astype(np.intp), nx - 1),
+                               minlength=nx * ny).reshape(ny, nx)
+            image = _Blend(_Upsample(hist / full, height, width), PURPLE, BEIGE)
+            tx = np.minimum((x[:self.n_tracers] / self.aspect * width).astype(np.intp), width - dot)
+            ty = np.minimum((y[:self.n_tracers] * height).astype(np.intp), height - dot)
+            for i in range(dot):
+                for j in range(dot):
+                    image[ty + i, tx + j] = 30
+            if frame / fps < self.t_wall:
+                column = min(int(self.wall / self.aspect * width), width - 1)
+                image[:, column:column + max(width // 200, 1)] = 40
+            yield image[::-1]
+            for _ in range(substeps):
+                x += sigma * rng.standard_normal(self.n_particles)
+                y += sigma * rng.standard_normal(self.n_particles)
+                # Reflecting walls, and the dividing wall until it is lifted
+                right = self.wall if (frame + 1) / fps <= self.t_wall else self.aspect
+                x = np.abs(x)
+                x = np.where(x > right, 2 * right - x, x)
+                y = np.abs(y)
+                y = np.where(y > 1, 2 - y, y)
+
+
+def StokesEinsteinRatio(T, T_ref=277.15):
+    '''
+    The ratio D(T) / D(T_ref) of a solute's diffusion coefficient in water
+
+    D is proportional to T / eta(T), with the viscosity of water eta(T) from
+    Vogel's equation.
+    '''
+    def eta(T):
+        return 2.414e-5 * 10 ** (247.8 / (T - 140.0))
+    return (T / eta(T)) / (T_ref / eta(T_ref))
+
+
+class DispersionScene:
+    '''
+    Ink spreading through a cold (left) and a warm (right) glass of water
+
+    The ink concentration is solved exactly at every frame: diffusion with
+    no-flux walls multiplies each cosine mode of the initial drop by
+    exp(-D k^2 t), which is computed with FFTs of the mirrored glass.
+
+    Inputs
+        T_cold, T_warm: float
+            The water temperatures (K)
+        D: float
+            The diffusion coefficient at T_cold, in glass heights^2 per second
+        seed: int
+            The seed of the shape of the ink drops
+    '''
+
+    def __init__(self, T_cold=277.15, T_warm=333.15, D=0.01, seed=0):
+        self.D = D * np.array([1.0, StokesEinsteinRatio(T_warm, T_cold)])
+        self.seed = seed
+
+    def Frames(self, width, height, fps, duration):
+        '''
+        Yields the frames of the animation as uint8 arrays of shape (height, width, 3)
+        '''
+        rng = np.random.default_rng(self.seed)
+        w = width // 2
+        # A drop near the top of each glass, made of a few overlapping blobs
+        Y, X = np.mgrid[0:height, 0:w] / height
+        c0 = np.zeros((height, w))
+        for cx, cy, r in zip(w / height * (0.5 + 0.08 * rng.standard_normal(5)), 0.15 + 0.05 * rng.random(5),
+                             0.03 + 0.02 * rng.random(5)):
+            c0 += np.exp(-((X - cx)**2 + (Y - cy)**2) / (2 * r**2))
+        c0 /= c0.max()
+        # Mirroring both axes makes the periodic FFT solution satisfy no-flux walls
+        mirrored = np.block([[c0, c0[:, ::-1]], [c0[::-1], c0[::-1, ::-1]]])
+        C0 = np.fft.rfft2(mirrored)
+        ky = 2 * np.pi * np.fft.fftfreq(2 * height, d=1 / height)
+        kx = 2 * np.pi * np.fft.rfftfreq(2 * w, d=1 / height)
+        k2 = ky[:, np.newaxis]**2 + kx[np.newaxis, :]**2
+        ink = np.array([30, 60, 160], dtype=np.float64)
+        water = np.array([250, 250, 255], dtype=np.float64)
+
+        for frame in range(int(round(duration * fps))):
+            t = frame / fps
+            image = np.empty((height, 2 * w, 3), dtype=np.uint8)
+            for glass, D in enumerate(self.D):
+                c = np.fft.irfft2(C0 * np.exp(-D * k2 * t), s=mirrored.shape)[:height, :w]
+                # The square root keeps the diluted ink visible
+                image[:, glass * w:(glass + 1) * w] = _Blend(np.sqrt(np.maximum(c, 0)), ink, water)
+            image[:, w - 1:w + 1] = 40
+            yield image
+
+
+class CapacitorScene:
+    '''
+    A capacitor charging through a resistor from a constant voltage source
+
+    The charge on the plates follows Q(t) = C V (1 - exp(-t / RC)); each plate
+    shows one dot per unit of charge, positive on the left plate and negative
+    on the right, and a bar at the bottom shows the capacitor's voltage.
+
+    Inputs
+        tau: float
+            The time constant RC (s)
+        n_charges: int
+            The number of charges on each plate when fully charged
+        seed: int
+            The seed of the charges' positions on the plates
+    '''
+
+    def __init__(self, tau=1.0, n_charges=60, seed=0):
+        self.tau = tau
+        self.n_charges = n_charges
+        self.seed = seed
+
+    def Frames(self, width, height, fps, duration):
+        '''
+        Yields the frames of the animation as uint8 arrays of shape (height, width, 3)
+        '''
+        rng = np.random.default_rng(self.seed)
+        # Charges take their places in a fixed random order
+        rows = rng.permutation(self.n_charges)
+        jitter = rng.random((2, self.n_charges))
+        plate_w, gap = max(width // 40, 2), width // 5
+        left, right = width // 2 - gap // 2 - plate_w, width // 2 + gap // 2
+        top, bottom = height // 6, height * 2 // 3
+        radius = max(min(width, height) // 80, 1)
+        Y, X = np.mgrid[0:height, 0:width]
+        background = np.full((height, width, 3), 255, dtype=np.uint8)
+        background[top:bottom, left:left + plate_w] = 90
+        background[top:bottom, right:right + plate_w] = 90
+
+        for frame in range(int(round(duration * fps))):
+            charge = 1 - np.exp(-frame / fps / self.tau)
+            n = int(round(charge * self.n_charges))
+            image = background.copy()
+            cy = top + (rows[:n] + jitter[0, :n]) / self.n_charges * (bottom - top)
+            for side, x0, color in ((0, left - 2 * radius, (200, 40, 40)), (1, right + plate_w + 2 * radius,
+                                                                              (40, 70, 200))):
+                cx = x0 + (jitter[1, :n] - 0.5) * radius
+                # Pixels within the radius of any charge (charges are sparse, so test near each one)
+                for x, y in zip(cx.astype(int), cy.astype(int)):
+                    ys, xs = slice(max(y - radius, 0), y + radius + 1), slice(max(x - radius, 0), x + radius + 1)
+                    disc = (X[ys, xs] - x)**2 + (Y[ys, xs] - y)**2 <= radius**2
+                    image[ys, xs][disc] = color
+            bar_top = height * 5 // 6
+            image[bar_top:bar_top + max(height // 30, 2), width // 10:width // 10 + int(charge * width * 0.8)] = \
+                (40, 150, 60)
+            yield image
+
+
+def _FFmpegOutput(extension, quality):
+    '''
+    The ffmpeg output options for an animation format at a quality of 0-100
+    '''
+    if extension == ".mp4":
+        return ["-pix_fmt", "yuv420p", "-crf", str(int(round(51 - quality * 0.33))), "-movflags", "faststart"]
+    if extension == ".webm":
+        return ["-c:v", "libvpx-vp9", "-pix_fmt", "yuv420p", "-crf", str(int(round(63 - quality * 0.48))),
+                "-b:v", "0"]
+    if extension == ".webp":
+        return ["-c:v", "libwebp", "-lossless", "0", "-q:v", str(quality), "-loop", "0"]
+    # A palette per frame, so that ffmpeg never has to see the whole stream first
+    return ["-filter_complex", "split[a][b];[a]palettegen=stats_mode=single[p];[b][p]paletteuse=new=1",
+            "-loop", "0"]
+
+
+def _EncodeStream(frames, path, fps, quality):
+    '''
+    Encodes frames one at a time into an animation file
+
+    MP4 and WebM need ffmpeg. WebP and GIF are piped into ffmpeg as well when it
+    is installed; otherwise Pillow encodes them, holding every frame in memory.
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in ANIMATION_FORMATS:
+        raise ValueError(f"Unsupported animation format {extension!r}; use one of {ANIMATION_FORMATS}")
+    frames = iter(frames)
+    first = next(frames)
+    if shutil.which("ffmpeg"):
+        height, width = first.shape[:2]
+        process = subprocess.Popen(["ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+                                    "-s", f"{width}x{height}", "-r", str(fps), "-i", "-", "-an"]
+                                   + _FFmpegOutput(extension, quality) + [path], stdin=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        try:
+            process.stdin.write(first.tobytes())
+            for frame in frames:
+                process.stdin.write(frame.tobytes())
+            process.stdin.close()
+        except BrokenPipeError:
+            # ffmpeg exited before taking every frame; its error message says why
+            pass
+        # stderr is only read once ffmpeg is done, which -loglevel error keeps from filling the pipe
+        _, errors = process.communicate()
+        if process.returncode:
+            raise RuntimeError(f"ffmpeg failed to encode {path}: {errors.decode(errors='replace').strip()}")
+        return
+    if extension in (".mp4", ".webm"):
+        raise RuntimeError(f"Encoding {extension} requires ffmpeg")
+
+    from PIL import Image
+
+    options = dict(save_all=True, append_images=(Image.fromarray(frame) for frame in frames),
+                   duration=int(round(1000 / fps)), loop=0)
+    if extension == ".webp":
+        options.update(quality=quality, method=4)
+    Image.fromarray(first).save(path, **options)
+
+
+def RenderAnimation(scene, path, width=640, height=320, fps=20, duration=6.0, quality=80, max_bytes=None):
+    '''
+    Renders a scene to an animation file
+
+    Inputs
+        scene: DiffusionScene, DispersionScene, CapacitorScene, or any object with
+            a Frames(width, height, fps, duration) generator
+        path: str
+            The output file; .webp, .gif, .mp4 or .webm (the last two need ffmpeg)
+        width, height: int
+            The frame size in pixels
+        fps: float
+            The frame rate
+        duration: float
+            The length of the animation (s)
+        quality: int
+            The encoding quality, 0-100 (ignored for GIF)
+        max_bytes: int, optional
+            A size budget; the quality is lowered by bisection, re-rendering the
+            scene each time, until the file fits. A ValueError is raised if even
+            quality 0 (or, for GIF, the only quality) does not fit
+
+    Outputs
+        The quality the file was encoded with
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".mp4", ".webm") and shutil.which("ffmpeg") is None:
+        raise RuntimeError(f"Encoding {extension} requires ffmpeg")
+
+    def Encode(quality):
+        _EncodeStream(scene.Frames(width, height, fps, duration), path, fps, quality)
+        return os.path.getsize(path) <= max_bytes
+
+    if max_bytes is None:
+        _EncodeStream(scene.Frames(width, height, fps, duration), path, fps, quality)
+        return quality
+    if Encode(quality):
+        return quality
+    if extension == ".gif" or quality == 0 or not Encode(0):
+        raise ValueError(f"{path} is {os.path.getsize(path)} bytes at the lowest quality, over the budget of "
+                         f"{max_bytes}; lower the resolution, frame rate, or duration")
+    # The quality low fits and high does not
+    low, high, last = 0, quality, 0
+    while high - low > 1:
+        last = (low + high) // 2
+        if Encode(last):
+            low = last
+        else:
+            high = last
+    if last != low:
+        Encode(low)
+    return low
@@ -0,0 +1,349 @@
+'''
+Multi-compartment neurons (Chapter 5, "The Point Neuron vs. Multi-Compartment Models")
+
+A neuron is split into compartments arranged in a tree, each one a point
+neuron with its own membrane potential and ionic currents, coupled to its
+parent compartment by an axial conductance:
+
+    C_i dV_i/dt = -sum_j I_j,i + sum_{k adjacent to i} g_ik (V_k - V_i) + I_inj,i
+
+The ionic currents are the same Current declarations used by
+ConductanceBasedPopulation. The voltage update is implicit (backward Euler
+with the ionic conductances frozen over the step), and the resulting
+tree-structured linear system is solved in O(n) by Hines' algorithm.
+
+The tree is cut into unbranched sections. Each section is a tridiagonal
+system, solved by cyclic reduction in O(log length) vectorized passes, and
+the sections are eliminated into their parents one section depth at a time,
+so the Python loops run over branch points rather than compartments.
+
+Compartment currents are absolute: conductances in mS, capacitances in uF,
+and currents in nA; densities (mS/cm^2, uF/cm^2) are multiplied by each
+compartment's membrane area.
+'''
+import numpy as np
+
+from neurodyn.hh import T_squid, ConductanceBasedPopulation
+
+
+def HinesOrder(parent):
+    '''
+    Computes a renumbering of a tree in which every compartment comes after its parent
+
+    Inputs
+        parent: integer array of shape (n,)
+            The parent of each compartment, -1 for the root
+
+    Outputs
+        order: the old index of each compartment in the new numbering, so that
+        new_parent = rank[parent[order]] with rank = argsort(order)
+    '''
+    parent = np.asarray(parent)
+    children = [[] for _ in parent]
+    roots = []
+    for i, p in enumerate(parent):
+        (roots if p < 0 else children[p]).append(i)
+    if len(roots) != 1:
+        raise ValueError(f"A morphology must have exactly one root, found {len(roots)}")
+    # Depth-first numbering keeps unbranched sections contiguous
+    order, stack = [], roots
+    while stack:
+        i = stack.pop()
+        order.append(i)
+        stack.extend(reversed(children[i]))
+    if len(order) != len(parent):
+        raise ValueError("The parent array does not describe a tree")
+    return np.array(order)
+
+
+class Morphology:
+    '''
+    A tree of cylindrical compartments in Hines order (every parent precedes its children)
+
+    Inputs
+        parent: integer array of shape (n,)
+            The parent of each compartment, with parent[0] = -1 and parent[i] < i;
+            use HinesOrder to renumber a tree that is not in this order
+        length: float or array of shape (n,)
+            The length of each compartment (um)
+        diameter: float or array of shape (n,)
+            The diameter of each compartment (um)
+        R_a: float
+            The axial resistivity of the cytoplasm (Ohm cm)
+
+    Attributes
+        area: array of shape (n,)
+            The membrane area of each compartment (cm^2)
+        g_axial: array of shape (n,)
+            The conductance (mS) between each compartment and its parent (0 for the root)
+        sections: list of (index, mask, top)
+            The unbranched sections at each section depth, from the root down:
+            index is an integer array of shape (n_sections, longest) of their
+            compartments from the top, mask marks the real entries of the padded
+            rows, and top is the parent of each section's first compartment (-1
+            for the root)
+    '''
+
+    def __init__(self, parent, length, diameter, R_a=100.0):
+        self.parent = np.asarray(parent, dtype=np.intp)
+        n = len(self.parent)
+        if self.parent[0] != -1 or np.any(self.parent[1:] >= np.arange(1, n)) or np.any(self.parent[1:] < 0):
+            raise ValueError("parent must have parent[0] = -1 and 0 <= parent[i] < i; use HinesOrder to renumber")
+        self.length = np.broadcast_to(np.asarray(length, dtype=float), (n,))
+        self.diameter = np.broadcast_to(np.asarray(diameter, dtype=float), (n,))
+        self.R_a = R_a
+
+        L, r = self.length * 1e-4, self.diameter * 0.5e-4  # cm
+        self.area = np.pi * 2 * r * L
+        # Resistance (Ohm) from each compartment's center to its end, in series with the parent's half
+        R_half = R_a * (L / 2) / (np.pi * r**2)
+        self.g_axial = np.zeros(n)
+        self.g_axial[1:] = 1e3 / (R_half[1:] + R_half[self.parent[1:]])
+
+        # A compartment continues the section of the one before it if that is its
+        # parent and has no other child
+        n_children = np.bincount(self.parent[1:], minlength=n)
+        continues = np.zeros(n, dtype=bool)
+        continues[1:] = (self.parent[1:] == np.arange(n - 1)) & (n_children[:-1] == 1)
+        starts = np.flatnonzero(~continues)
+        lengths = np.diff(np.append(starts, n))
+        section = np.cumsum(~continues) - 1
+        top = self.parent[starts]
+        depth = np.zeros(len(starts), dtype=np.intp)
+        for s in range(1, len(starts)):
+            depth[s] = depth[section[top[s]]] + 1
+        self.sections = []
+        for level in range(depth.max() + 1):
+            group = np.flatnonzero(depth == level)
+            offsets = np.arange(lengths[group].max())
+            mask = offsets < lengths[group, None]
+            index = np.where(mask, starts[group, None] + offsets, 0)
+            self.sections.append((index, mask, top[group]))
+
+    def __len__(self):
+        return len(self.parent)
+
+    @classmethod
+    def Cable(cls, n, length=1000.0, diameter=1.0, R_a=100.0):
+        '''
+        An unbranched cable of total length (um) split into n equal compartments
+        '''
+        return cls(np.arange(-1, n - 1), length / n, diameter, R_a)
+
+    @classmethod
+    def Soma(cls, n_dendrites, n_per_dendrite, soma_diameter=20.0, length=200.0, diameter=2.0, R_a=100.0):
+        '''
+        A spherical-equivalent soma (compartment 0) with n_dendrites unbranched dendrites attached
+        '''
+        parent = [-1]
+        for d in range(n_dendrites):
+            start = len(parent)
+            parent += [0] + list(range(start, start + n_per_dendrite - 1))
+        n = len(parent)
+        lengths = np.full(n, length / n_per_dendrite)
+        diameters = np.full(n, diameter)
+        # A cylinder as long as it is wide has the area of the sphere of that diameter
+        lengths[0] = diameters[0] = soma_diameter
+        return cls(parent, lengths, diameters, R_a)
+
+
+def _CyclicReduction(lower, diag, upper, rhs):
+    '''
+    Solves a batch of tridiagonal systems by cyclic reduction
+
+    Every pass eliminates the odd rows from the even ones, halving the systems,
+    so a system of n rows takes about log2(n) vectorized passes.
+
+    Inputs
+        lower, diag, upper: arrays of shape (m, n)
+            The coefficients of x[i - 1], x[i] and x[i + 1] in row i of each
+            system; lower[:, 0] and upper[:, -1] must be 0
+        rhs: array of shape (m, n, k)
+            k right-hand sides per system
+
+    Outputs
+        The solutions, an array of shape (m, n, k)
+    '''
+    n = diag.shape[1]
+    if n == 1:
+        return rhs / diag[..., None]
+    # Even row j couples to odd rows j - 1 (above) and j (below)
+    d_even, d_odd = diag[:, 0::2], diag[:, 1::2]
+    m, k = d_even.shape[1], d_odd.shape[1]
+    l_odd, u_odd, r_odd = lower[:, 1::2], upper[:, 1::2], rhs[:, 1::2]
+    above = np.zeros_like(d_even)
+    above[:, 1:] = -lower[:, 2::2] / d_odd[:, :m - 1]
+    below = np.zeros_like(d_even)
+    below[:, :k] = -upper[:, 0::2][:, :k] / d_odd
+
+    d = d_even.copy()
+    d[:, 1:] += above[:, 1:] * u_odd[:, :m - 1]
+    d[:, :k] += below[:, :k] * l_odd
+    l = np.zeros_like(d_even)
+    l[:, 1:] = above[:, 1:] * l_odd[:, :m - 1]
+    u = np.zeros_like(d_even)
+    u[:, :k] = below[:, :k] * u_odd
+    r = rhs[:, 0::2].copy()
+    r[:, 1:] += above[:, 1:, None] * r_odd[:, :m - 1]
+    r[:, :k] += below[:, :k, None] * r_odd
+
+    x = np.empty_like(rhs)
+    x[:, 0::2] = x_even = _CyclicReduction(l, d, u, r)
+    x_odd = r_odd - l_odd[..., None] * x_even[:, :k]
+    x_odd[:, :m - 1] -= u_odd[:, :m - 1, None] * x_even[:, 1:]
+    x[:, 1::2] = x_odd / d_odd[..., None]
+    return x
+
+
+def SolveHines(morphology, d, a, b):
+    '''
+    Solves the symmetric tree-structured system of a morphology in O(n) by Hines' algorithm
+
+    The system has diagonal d and the off-diagonal entry a[i] linking compartment i
+    to its parent. The unbranched sections at the same section depth are solved
+    together by cyclic reduction, each for its right-hand side and for a unit
+    load at its top; the latter gives the section's Schur complement onto its
+    parent compartment. The sections are eliminated from the deepest up, then
+    the solution is substituted back from the root down.
+
+    Inputs
+        morphology: Morphology
+            The tree, in Hines order
+        d, a, b: arrays of shape (n,)
+            The diagonal, parent off-diagonal, and right-hand side; d and b are overwritten
+
+    Outputs
+        The solution x, stored in b
+    '''
+    solved = []
+    # Backward elimination from the leaves to the root
+    for index, mask, top in reversed(morphology.sections):
+        coupling = np.where(mask, a[index], 0.0)
+        coupling[:, 0] = 0.0
+        upper = np.zeros_like(coupling)
+        upper[:, :-1] = coupling[:, 1:]
+        rhs = np.zeros(index.shape + (2,))
+        rhs[..., 0] = np.where(mask, b[index], 0.0)
+        rhs[:, 0, 1] = 1.0
+        y = _CyclicReduction(coupling, np.where(mask, d[index], 1.0), upper, rhs)
+        attached = top >= 0
+        a_top = a[index[attached, 0]]
+        np.subtract.at(d, top[attached], a_top**2 * y[attached, 0, 1])
+        np.subtract.at(b, top[attached], a_top * y[attached, 0, 0])
+        solved.append(y)
+    # Forward substitution from the root to the leaves
+    for (index, mask, top), y in zip(morphology.sections, reversed(solved)):
+        load = np.where(top >= 0, a[index[:, 0]] * b[np.maximum(top, 0)], 0.0)
+        x = y[..., 0] - y[..., 1] * load[:, None]
+        b[index[mask]] = x[mask]
+    return b
+
+
+class MultiCompartmentNeuron:
+    '''
+    A conductance-based neuron with one point-neuron compartment per node of a Morphology
+
+    Inputs
+        morphology: Morphology
+            The compartment tree
+        currents: list of Current
+            The ionic current declarations; per-compartment densities are given as
+            arrays of shape (n,) for g_bar or E (defaults to HH_CURRENTS everywhere)
+        C_m: float or array of shape (n,)
+            The specific membrane capacitance (uF/cm^2)
+        T: float
+            The temperature in Kelvin
+        V0: float or array of shape (n,)
+            The initial membrane potential (mV)
+
+    Attributes
+        compartments: ConductanceBasedPopulation
+            The compartments' state (V, gates), one "neuron" per compartment
+    '''
+
+    def __init__(self, morphology, currents=None, C_m=1.0, T=T_squid, V0=-65.0, V_thresh=0.0):
+        self.morphology = morphology
+        self.compartments = ConductanceBasedPopulation(len(morphology), currents, C_m, T, V0, V_thresh)
+        self.C = self.compartments.C_m * morphology.area  # uF
+        # Off-diagonal entries of the coupling matrix, and the coupling's contribution to the diagonal
+        self._a = -morphology.g_axial
+        self._coupling = morphology.g_axial.copy()
+        np.add.at(self._coupling, morphology.parent[1:], morphology.g_axial[1:])
+
+    @property
+    def V(self):
+        return self.compartments.V
+
+    @property
+    def t(self):
+        return self.compartments.t
+
+    def Step(self, dt, I_inj=0.0):
+        '''
+        Advances the neuron by dt
+
+        The gates take an exponential-Euler step, then all membrane potentials are
+        updated together by solving
+
+            (C_i/dt + G_i + sum_k g_ik) V_i' - sum_k g_ik V_k' = C_i/dt V_i + sum_j g_j,i E_j + I_inj,i
+
+        where G_i is the total ionic conductance of compartment i.
+
+        Inputs
+            dt: float
+                The step size (ms)
+            I_inj: float or array of shape (n,)
+                The current injected into each compartment (nA)
+
+        Outputs
+            A boolean array marking the compartments whose potential crossed V_thresh upwards
+        '''
+        comp = self.compartments
+        V_prev = comp.V.copy()
+        G, GE = comp.Conductances()
+        area = self.morphology.area
+        C_dt = self.C / dt
+
+        d = C_dt + G * area + self._coupling
+        b = C_dt * comp.V + GE * area + 1e-3 * np.asarray(I_inj)
+        comp.StepGates(dt)
+        comp.V[:] = SolveHines(self.morphology, d, self._a, b)
+
+        comp.t += dt
+        spiked = (V_prev < comp.V_thresh) & (comp.V >= comp.V_thresh)
+        comp.spike_count += spiked
+        return spiked
+
+    def Run(self, t_stop, dt, I_inj=0.0, record_every=0, out=None):
+        '''
+        Advances the neuron for t_stop milliseconds
+
+        Inputs
+            t_stop: float
+                The duration of the run (ms)
+            dt: float
+                The step size (ms)
+            I_inj: float, array of shape (n,), or callable
+                The current injected into each compartment (nA), or a function of time returning it
+            record_every: int
+                Record every compartment's V every this many steps (0 records nothing)
+            out: array of shape (n_steps // record_every + 1, n), optional
+                A preallocated buffer for the recorded voltages
+
+        Outputs
+            The recorded voltage traces (mV) with the initial state in the first row,
+            or None if nothing was recorded
+        '''
+        n_steps = int(round(t_stop / dt))
+        trace = None
+        if record_every:
+            shape = (n_steps // record_every + 1, len(self.morphology))
+            trace = np.empty(shape) if out is None else out
+            if trace.shape != shape:
+                raise ValueError(f"out must have shape {shape}, got {trace.shape}")
+            trace[0] = self.V
+        for k in range(1, n_steps + 1):
+            self.Step(dt, I_inj(self.t) if callable(I_inj) else I_inj)
+            if record_every and k % record_every == 0:
+                trace[k // record_every] = self.V
+        return trace
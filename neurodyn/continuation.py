@@ -0,0 +1,461 @@
+'''
+Numerical continuation of equilibria and limit cycles (Chapters 4 and 5)
+
+Instead of simulating a model at many parameter values to find where it
+starts spiking, continuation follows the fixed points and limit cycles of the
+model directly as a parameter changes:
+
+    ContinueEquilibria   traces a branch of fixed points by pseudo-arclength
+                         continuation, classifies their stability from the
+                         eigenvalues of the Jacobian (computed for every point of
+                         the branch in one batched call), and detects saddle-node
+                         (fold) and Hopf bifurcations along the way.
+    ContinueLimitCycles  starts from a Hopf point and traces the branch of
+                         periodic orbits born there, representing each orbit by
+                         piecewise polynomials fixed by orthogonal collocation.
+
+Models are vector fields f(y, p), where y has the state variables along its
+first axis and any number of states along the remaining axes, and p is the
+continuation parameter. ConductanceBasedVectorField builds one for a
+conductance-based model with the injected current as the parameter.
+'''
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from neurodyn.hh import T_squid, ConductanceBasedPopulation
+
+
+def ConductanceBasedVectorField(currents=None, C_m=1.0, T=T_squid):
+    '''
+    The vector field f(y, I_inj) of a single conductance-based neuron
+
+    Inputs
+        currents: list of Current
+            The model's currents (defaults to HH_CURRENTS)
+        C_m: float
+            The membrane capacitance (uF/cm^2)
+        T: float
+            The temperature in Kelvin
+
+    Outputs
+        f(y, p): y has V and then the gates along its first axis, p is the injected
+        current density (uA/cm^2). The underlying population is available as f.population.
+    '''
+    pop = ConductanceBasedPopulation(1, currents, C_m, T)
+
+    def f(y, p):
+        y = np.asarray(y, dtype=float)
+        dy = pop.Derivatives(y, 0.0, np.zeros(y.shape[1:], dtype=np.intp))
+        dy[0] += np.asarray(p) / pop.C_m[0]
+        return dy
+
+    f.population = pop
+    return f
+
+
+def _Jacobians(f, y, p, eps=1e-6):
+    '''
+    Forward-difference Jacobians with respect to y and p at many states in one call of f
+
+    Inputs
+        y: array of shape (d, n)
+        p: float or array of shape (n,)
+
+    Outputs
+        (J, f_p, f0): arrays of shape (n, d, d), (n, d), and (d, n)
+    '''
+    d, n = y.shape
+    p = np.broadcast_to(np.asarray(p, dtype=float), (n,))
+    h = eps * np.maximum(np.abs(y), 1.0)
+    h_p = eps * np.maximum(np.abs(p), 1.0)
+    # Stack the base state, d perturbed states, and the perturbed parameter side by side
+    Y = np.repeat(y[:, np.newaxis, :], d + 2, axis=1)
+    P = np.repeat(p[np.newaxis, :], d + 2, axis=0)
+    Y[np.arange(d), 1 + np.arange(d), :] += h
+    P[d + 1] += h_p
+    F = f(Y.reshape(d, -1), P.ravel()).reshape(d, d + 2, n)
+    f0 = F[:, 0]
+    J = ((F[:, 1:d + 1] - f0[:, np.newaxis]) / h[np.newaxis]).transpose(2, 0, 1)
+    f_p = ((F[:, d + 1] - f0) / h_p).T
+    return J, f_p, f0
+
+
+def FindEquilibrium(f, y0, p, tol=1e-10, max_iter=50):
+    '''
+    Solves f(y, p) = 0 by Newton's method from the initial guess y0
+
+    Outputs
+        The equilibrium y as an array of shape (d,)
+    '''
+    y = np.array(y0, dtype=float)
+    for _ in range(max_iter):
+        J, _, f0 = _Jacobians(f, y[:, np.newaxis], p)
+        step = np.linalg.solve(J[0], f0[:, 0])
+        y -= step
+        if np.max(np.abs(step)) < tol:
+            return y
+    raise RuntimeError(f"Newton's method did not converge to an equilibrium at p = {p}")
+
+
+def _CorrectEquilibrium(f, u, tangent, ds, tol, max_iter=10):
+    '''
+    Newton's method for the point a distance ds along the tangent from u
+
+    Outputs
+        (v, converged, n_iter)
+    '''
+    d = len(u) - 1
+    v = u + ds * tangent
+    for n_iter in range(max_iter):
+        J, f_p, f0 = _Jacobians(f, v[:d, np.newaxis], v[d])
+        G = np.append(f0[:, 0], tangent @ (v - u) - ds)
+        M = np.vstack([np.hstack([J[0], f_p[0][:, np.newaxis]]), tangent])
+        step = np.linalg.solve(M, G)
+        v -= step
+        if np.max(np.abs(step)) < tol:
+            return v, True, n_iter
+    return v, False, n_iter
+
+
+@dataclass
+class EquilibriumBranch:
+    '''
+    A branch of fixed points y(p) and their stability
+
+    Attributes
+        p: array of shape (n,)
+            The parameter value of each point
+        y: array of shape (n, d)
+            The fixed points
+        eigenvalues: array of shape (n, d)
+            The eigenvalues of the Jacobian at each point
+        stable: boolean array of shape (n,)
+            Whether every eigenvalue has a negative real part
+        bifurcations: list of dict
+            Each detected bifurcation, with its "type" ("SN" for a saddle-node,
+            "H" for a Hopf), interpolated parameter "p" and state "y", the branch
+            "index" just before it, and for Hopf points the frequency "omega" (rad/ms)
+    '''
+    p: np.ndarray
+    y: np.ndarray
+    eigenvalues: np.ndarray
+    stable: np.ndarray
+    bifurcations: list = field(default_factory=list)
+
+
+def ContinueEquilibria(f, y0, p0, p_min, p_max, ds=0.1, ds_min=1e-5, ds_max=1.0, max_points=2000,
+                       direction=1, tol=1e-9):
+    '''
+    Traces a branch of equilibria of f by pseudo-arclength continuation
+
+    Each new point is predicted along the branch's tangent in (y, p) space and
+    corrected by Newton's method on f(y, p) = 0 together with the constraint
+    that it lies a distance ds along the tangent, which lets the branch turn
+    around saddle-node folds where p itself stops increasing.
+
+    Inputs
+        f: callable f(y, p)
+            The vector field
+        y0: array of shape (d,)
+            An initial guess of the equilibrium at p0
+        p0: float
+            The starting parameter value
+        p_min, p_max: float
+            The branch is traced until p leaves [p_min, p_max]
+        ds, ds_min, ds_max: float
+            The initial, smallest, and largest arclength steps
+        max_points: int
+            The maximum number of branch points
+        direction: +1 or -1
+            Whether to start towards increasing or decreasing p
+        tol: float
+            The Newton tolerance
+
+    Outputs
+        An EquilibriumBranch
+    '''
+    y = FindEquilibrium(f, y0, p0)
+    d = len(y)
+    u = np.append(y, p0)
+    # The initial tangent points along p; it is corrected to the true tangent below
+    tangent = np.zeros(d + 1)
+    tangent[-1] = direction
+    points = [u.copy()]
+    tangents = []
+
+    for _ in range(max_points - 1):
+        J, f_p, _ = _Jacobians(f, u[:d, np.newaxis], u[d])
+        F_u = np.hstack([J[0], f_p[0][:, np.newaxis]])
+        # The tangent spans the null space of F_u, oriented like the previous tangent
+        tangent = np.linalg.solve(np.vstack([F_u, tangent]), np.append(np.zeros(d), 1.0))
+        tangent /= np.linalg.norm(tangent)
+        tangents.append(tangent)
+
+        while True:
+            v, converged, n_iter = _CorrectEquilibrium(f, u, tangent, ds, tol)
+            if converged:
+                break
+            ds *= 0.5
+            if ds < ds_min:
+                raise RuntimeError(f"Continuation failed near p = {u[d]}")
+
+        u = v
+        points.append(u.copy())
+        # Grow the step after easy corrections
+        if n_iter < 3:
+            ds = min(ds * 1.5, ds_max)
+        if not p_min <= u[d] <= p_max:
+            break
+
+    J, f_p, _ = _Jacobians(f, u[:d, np.newaxis], u[d])
+    tangent = np.linalg.solve(np.vstack([np.hstack([J[0], f_p[0][:, np.newaxis]]), tangent]), np.append(np.zeros(d), 1.0))
+    tangents.append(tangent / np.linalg.norm(tangent))
+    points = np.array(points)
+    tangents = np.array(tangents)
+
+    # Stability of every point at once
+    J, _, _ = _Jacobians(f, points[:, :d].T, points[:, d])
+    eigenvalues = np.linalg.eigvals(J)
+    order = np.argsort(-eigenvalues.real, axis=1)
+    eigenvalues = np.take_along_axis(eigenvalues, order, axis=1)
+    branch = EquilibriumBranch(points[:, d], points[:, :d], eigenvalues, np.all(eigenvalues.real < 0, axis=1))
+    branch.bifurcations = _DetectBifurcations(f, branch, tangents, tol)
+    return branch
+
+
+def _DetectBifurcations(f, branch, tangents, tol):
+    '''
+    Locates saddle-node and Hopf points between consecutive branch points
+
+    A saddle-node is where the branch turns back in p (dp/ds changes sign). Its
+    arclength position is estimated from the cubic Hermite interpolant of p(s)
+    and then corrected onto the branch. A Hopf point is where the largest real
+    part among complex-conjugate eigenvalue pairs changes sign; it is placed by
+    linear interpolation and corrected at fixed p.
+    '''
+    bifurcations = []
+    d = branch.y.shape[1]
+    u = np.hstack([branch.y, branch.p[:, np.newaxis]])
+    dp_ds = tangents[:, d]
+    ev = branch.eigenvalues
+    complex_pair = np.abs(ev.imag) > 1e-8
+    hopf_test = np.max(np.where(complex_pair, ev.real, -np.inf), axis=1)
+    for i in range(len(branch.p) - 1):
+        if np.sign(dp_ds[i]) != np.sign(dp_ds[i + 1]):
+            s1 = tangents[i] @ (u[i + 1] - u[i])
+            # p'(s) of the Hermite cubic through both points is a quadratic in s
+            dp = (branch.p[i + 1] - branch.p[i]) / s1
+            a = 3 * (dp_ds[i] + dp_ds[i + 1] - 2 * dp) / s1**2
+            b = 2 * (3 * dp - 2 * dp_ds[i] - dp_ds[i + 1]) / s1
+            roots = np.roots([a, b, dp_ds[i]]) if a != 0 else np.array([-dp_ds[i] / b])
+            roots = roots[np.isreal(roots)].real
+            roots = roots[(roots >= 0) & (roots <= s1)]
+            s = roots[0] if len(roots) else s1 * dp_ds[i] / (dp_ds[i] - dp_ds[i + 1])
+            v, converged, _ = _CorrectEquilibrium(f, u[i], tangents[i], s, tol)
+            if not converged:
+                w = s / s1
+                v = (1 - w) * u[i] + w * u[i + 1]
+            bifurcations.append({"type": "SN", "index": i, "p": v[d], "y": v[:d]})
+        a, b = hopf_test[i], hopf_test[i + 1]
+        if np.isfinite(a) and np.isfinite(b) and np.sign(a) != np.sign(b):
+            w = a / (a - b)
+            p = (1 - w) * branch.p[i] + w * branch.p[i + 1]
+            y = FindEquilibrium(f, (1 - w) * branch.y[i] + w * branch.y[i + 1], p)
+            J, _, _ = _Jacobians(f, y[:, np.newaxis], p)
+            lam, vec = np.linalg.eig(J[0])
+            k = np.argmin(np.where(lam.imag > 0, np.abs(lam.real), np.inf))
+            bifurcations.append({"type": "H", "index": i, "p": p, "y": y,
+                                 "omega": lam[k].imag, "eigenvector": vec[:, k]})
+    return bifurcations
+
+
+class _Collocation:
+    '''
+    Orthogonal collocation of a periodic orbit on n_intervals mesh intervals
+
+    Time is rescaled to [0, 1] and the orbit is a continuous piecewise polynomial
+    of degree m, stored by its values at m+1 equally spaced nodes per interval
+    (n_intervals*m + 1 nodes in total). The differential equation
+    dx/dt = T f(x, p) is enforced at the m Gauss-Legendre points of each interval.
+    '''
+
+    def __init__(self, n_intervals=40, m=4):
+        self.n, self.m = n_intervals, m
+        self.h = 1.0 / n_intervals
+        nodes = np.linspace(0, 1, m + 1)
+        gauss, weights = np.polynomial.legendre.leggauss(m)
+        gauss = (gauss + 1) / 2
+        self.weights = weights / 2
+        # Lagrange basis on the nodes and its derivative, evaluated at the Gauss points
+        self.L = np.empty((m, m + 1))
+        self.D = np.empty((m, m + 1))
+        for l in range(m + 1):
+            others = np.delete(nodes, l)
+            basis = np.polynomial.Polynomial.fromroots(others) / np.prod(nodes[l] - others)
+            self.L[:, l] = basis(gauss)
+            self.D[:, l] = basis.deriv()(gauss)
+        self.n_nodes = n_intervals * m + 1
+        self.t = np.linspace(0, 1, self.n_nodes)
+        # Node indices of each interval, shape (n_intervals, m + 1)
+        self.blocks = np.arange(n_intervals)[:, np.newaxis] * m + np.arange(m + 1)
+
+    def AtGauss(self, X):
+        '''
+        The orbit and its derivative (per unit rescaled time) at every Gauss point, shape (n, m, d)
+        '''
+        Xb = X[self.blocks]
+        return np.einsum("kl,jld->jkd", self.L, Xb), np.einsum("kl,jld->jkd", self.D, Xb) / self.h
+
+    def Integrate(self, values):
+        '''
+        Integrates values given at the Gauss points, of shape (n, m), over [0, 1]
+        '''
+        return self.h * np.sum(values * self.weights)
+
+
+@dataclass
+class LimitCycleBranch:
+    '''
+    A branch of periodic orbits
+
+    Attributes
+        p: array of shape (n,)
+            The parameter value of each orbit
+        period: array of shape (n,)
+            The period of each orbit (ms when f is in 1/ms)
+        orbits: array of shape (n, n_nodes, d)
+            Each orbit sampled at the collocation nodes, uniform in phase over one period
+        amplitude: array of shape (n, d)
+            The peak-to-peak amplitude of each state variable
+    '''
+    p: np.ndarray
+    period: np.ndarray
+    orbits: np.ndarray
+    amplitude: np.ndarray
+
+
+def ContinueLimitCycles(f, hopf, p_min, p_max, ds=0.05, ds_min=1e-6, ds_max=2.0, max_points=200,
+                        T_max=1e3, n_intervals=40, m=4, tol=1e-8):
+    '''
+    Traces the branch of periodic orbits born at a Hopf bifurcation
+
+    Every orbit is found by Newton's method on the collocation equations, a
+    periodicity condition, an integral phase condition that pins the orbit's
+    phase to the previous one, and a pseudo-arclength condition in
+    (orbit, period, parameter) space.
+
+    Inputs
+        f: callable f(y, p)
+            The vector field
+        hopf: dict
+            A Hopf point from EquilibriumBranch.bifurcations
+        p_min, p_max: float
+            The branch is traced until p leaves [p_min, p_max]
+        ds, ds_min, ds_max: float
+            The initial, smallest, and largest arclength steps
+        max_points: int
+            The maximum number of orbits
+        T_max: float
+            The branch stops when the period exceeds T_max, e.g. near a homoclinic orbit
+        n_intervals, m: int
+            The number of mesh intervals and the collocation degree
+        tol: float
+            The Newton tolerance
+
+    Outputs
+        A LimitCycleBranch
+    '''
+    mesh = _Collocation(n_intervals, m)
+    y_H, v = hopf["y"], hopf["eigenvector"]
+    d = len(y_H)
+    N = mesh.n_nodes * d
+    # The orbit part of the arclength inner product approximates an integral over the orbit
+    weight = np.concatenate([np.full(N, 1.0 / mesh.n_nodes), [1.0, 1.0]])
+
+    # At the Hopf point the orbit is the equilibrium, and it grows along the critical eigenvector
+    phase = 2 * np.pi * mesh.t[:, np.newaxis]
+    direction = v.real * np.cos(phase) - v.imag * np.sin(phase)
+    direction /= np.sqrt(np.sum(direction**2) / mesh.n_nodes)
+    u = np.concatenate([np.tile(y_H, mesh.n_nodes), [2 * np.pi / abs(hopf["omega"]), hopf["p"]]])
+    tangent = np.concatenate([direction.ravel(), [0.0, 0.0]])
+
+    points = []
+    for _ in range(max_points):
+        while True:
+            v_new, converged = _CorrectOrbit(f, mesh, u, tangent, ds, weight, tol)
+            if converged:
+                break
+            ds *= 0.5
+            if ds < ds_min:
+                return _Branch(mesh, points, d)
+        secant = (v_new - u) * weight
+        tangent = (v_new - u) / np.sqrt(np.sum(secant * (v_new - u)))
+        u = v_new
+        points.append(u.copy())
+        ds = min(ds * 1.3, ds_max)
+        if not p_min <= u[-1] <= p_max or u[-2] > T_max:
+            break
+    return _Branch(mesh, points, d)
+
+
+def _CorrectOrbit(f, mesh, u_prev, tangent, ds, weight, tol, max_iter=12):
+    '''
+    Newton's method for the next orbit of a limit cycle branch
+    '''
+    n, m = mesh.n, mesh.m
+    N = mesh.n_nodes
+    d = (len(u_prev) - 2) // N
+    X_prev = u_prev[:-2].reshape(N, d)
+    dX_prev = tangent[:-2].reshape(N, d)
+    # The reference orbit's derivative, for the phase condition
+    X_ref, X_ref_dot = mesh.AtGauss(X_prev + ds * dX_prev)
+
+    v = u_prev + ds * tangent
+    n_u = len(v)
+    for _ in range(max_iter):
+        X, T, p = v[:-2].reshape(N, d), v[-2], v[-1]
+        Xg, Xg_dot = mesh.AtGauss(X)
+        J, f_p, f0 = _Jacobians(f, Xg.reshape(-1, d).T, p)
+        f0 = f0.T.reshape(n, m, d)
+
+        # Residuals: collocation, periodicity, phase, and arclength
+        R = np.concatenate([(Xg_dot - T * f0).ravel(),
+                            X[0] - X[-1],
+                            [mesh.Integrate(np.sum((Xg - X_ref) * X_ref_dot, axis=2))],
+                            [np.sum(weight * tangent * (v - u_prev)) - ds]])
+
+        M = np.zeros((n_u, n_u))
+        J = J.reshape(n, m, d, d)
+        for j in range(n):
+            rows = slice(j * m * d, (j + 1) * m * d)
+            # d(collocation)/d(nodes) = D/h I - T J L
+            block = (np.einsum("kl,ab->kalb", mesh.D / mesh.h, np.eye(d))
+                     - T * np.einsum("kab,kl->kalb", J[j], mesh.L))
+            cols = slice(j * m * d, (j * m + m + 1) * d)
+            M[rows, cols] = block.reshape(m * d, (m + 1) * d)
+            M[rows, -2] = -f0[j].ravel()
+            M[rows, -1] = -T * f_p.reshape(n, m, d)[j].ravel()
+        r = n * m * d
+        M[r:r + d, :d] = np.eye(d)
+        M[r:r + d, N * d - d:N * d] = -np.eye(d)
+        # Phase condition: integral of <x, x_ref'> over the Gauss points, linear in the nodes
+        phase_row = np.einsum("jkd,kl,k->jld", X_ref_dot, mesh.L, mesh.weights) * mesh.h
+        np.add.at(M[r + d], (mesh.blocks[..., np.newaxis] * d + np.arange(d)).ravel(), phase_row.ravel())
+        M[r + d + 1] = weight * tangent
+
+        step = np.linalg.solve(M, R)
+        v -= step
+        if not np.all(np.isfinite(v)):
+            return v, False
+        if np.max(np.abs(step)) < tol:
+            return v, True
+    return v, False
+
+
+def _Branch(mesh, points, d):
+    if not points:
+        return LimitCycleBranch(np.empty(0), np.empty(0), np.empty((0, mesh.n_nodes, d)), np.empty((0, d)))
+    points = np.array(points)
+    orbits = points[:, :-2].reshape(len(points), mesh.n_nodes, d)
+    return LimitCycleBranch(points[:, -1], points[:, -2], orbits, orbits.max(axis=1) - orbits.min(axis=1))
@@ -0,0 +1,125 @@
+'''
+Lightweight rich-display objects for the book's pages
+
+YouTubeVideo is a drop-in replacement for IPython.display.YouTubeVideo. Instead
+of an iframe that loads YouTube's player as soon as the page opens, it renders
+a thumbnail with a play button, and the player is only inserted when the
+reader clicks it. The page references a thumbnail in _static/youtube/ (which
+the book build copies into the HTML output); without it, the facade falls
+back to YouTube's image server, and then to a plain dark box.
+
+Creating a YouTubeVideo never touches the network, so executing a chapter
+offline costs nothing. The thumbnails are fetched by an explicit prefetch
+step, run once before building (and again when videos are added):
+
+    python -c "from neurodyn.display import PrefetchThumbnails; PrefetchThumbnails()"
+'''
+import glob
+import html
+import os
+import re
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+# Where thumbnails are cached, relative to the book's root (the notebooks' working directory)
+THUMBNAIL_DIR = "_static/youtube"
+_VIDEO_CALL = re.compile(r"""YouTubeVideo\(\s*["']([\w-]+)["']""")
+
+_PLAY_BUTTON = ('<svg viewBox="0 0 68 48" width="68" height="48" style="position:absolute;left:50%;top:50%;'
+                'transform:translate(-50%,-50%)"><path d="M66.5 7.7c-.8-2.9-3-5.2-5.9-6C55.3.2 34 .2 34 .2S12.7.2 '
+                '7.4 1.7c-2.9.8-5.1 3.1-5.9 6C0 13 0 24 0 24s0 11 1.5 16.3c.8 2.9 3 5.2 5.9 6C12.7 47.8 34 47.8 34 '
+                '47.8s21.3 0 26.6-1.5c2.9-.8 5.1-3.1 5.9-6C68 35 68 24 68 24s0-11-1.5-16.3z" fill="#f00"/>'
+                '<path d="M45 24 27 14v20" fill="#fff"/></svg>')
+
+
+def CacheThumbnail(id, directory=THUMBNAIL_DIR, timeout=5.0):
+    '''
+    Downloads the thumbnail of a YouTube video into the cache, unless it is already there
+
+    Inputs
+        id: str
+            The video's YouTube id
+        directory: str
+            The cache directory
+        timeout: float
+            The download timeout (s)
+
+    Outputs
+        The path of the cached thumbnail, or None if it could not be downloaded
+    '''
+    path = os.path.join(directory, f"{id}.jpg")
+    if os.path.exists(path):
+        return path
+    try:
+        with urlopen(f"https://i.ytimg.com/vi/{id}/hqdefault.jpg", timeout=timeout) as response:
+            data = response.read()
+    except OSError:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def PrefetchThumbnails(root=".", directory=None, timeout=5.0):
+    '''
+    Caches the thumbnail of every video shown by the book's pages
+
+    Inputs
+        root: str
+            The book's root; its .md and .ipynb files are searched for YouTubeVideo("<id>", ...) calls
+        directory: str, optional
+            The cache directory (defaults to THUMBNAIL_DIR under root)
+        timeout: float
+            The download timeout per thumbnail (s)
+
+    Outputs
+        The ids whose thumbnails could not be downloaded
+    '''
+    directory = os.path.join(root, THUMBNAIL_DIR) if directory is None else directory
+    ids = set()
+    for path in glob.glob(os.path.join(root, "*.md")) + glob.glob(os.path.join(root, "*.ipynb")):
+        with open(path) as f:
+            ids.update(_VIDEO_CALL.findall(f.read()))
+    return sorted(id for id in ids if CacheThumbnail(id, directory, timeout) is None)
+
+
+class YouTubeVideo:
+    '''
+    A YouTube video shown as a click-to-load thumbnail
+
+    Inputs
+        id: str
+            The video's YouTube id
+        width, height: int
+            The size of the player in pixels
+        kwargs:
+            Player parameters added to the embed URL, e.g. start=30
+    '''
+
+    def __init__(self, id, width=400, height=300, **kwargs):
+        self.id = id
+        self.width = width
+        self.height = height
+        self.params = kwargs
+
+    @property
+    def src(self):
+        params = dict(self.params, autoplay=1)
+        return f"https://www.youtube-nocookie.com/embed/{self.id}?{urlencode(params)}"
+
+    def _repr_html_(self):
+        iframe = (f'<iframe width="{self.width}" height="{self.height}" src="{self.src}" frameborder="0" '
+                  f'allow="autoplay; encrypted-media; picture-in-picture" allowfullscreen></iframe>')
+        remote = f"https://i.ytimg.com/vi/{self.id}/hqdefault.jpg"
+        # The cached thumbnail, then YouTube's copy, then nothing
+        fallback = (f"if (!this.dataset.remote) {{ this.dataset.remote = 1; this.src = '{remote}'; }} "
+                    f"else {{ this.remove(); }}")
+        return (f'<button type="button" title="Play video" aria-label="Play video" '
+                f'onclick="this.outerHTML = {html.escape(repr(iframe))};" '
+                f'style="position:relative;display:block;width:{self.width}px;max-width:100%;'
+                f'aspect-ratio:{self.width}/{self.height};padding:0;border:0;background:#000;cursor:pointer">'
+                f'<img src="{THUMBNAIL_DIR}/{self.id}.jpg" alt="" loading="lazy" '
+                f'onerror="{html.escape(fallback)}" style="width:100%;height:100%;object-fit:cover">'
+                f'{_PLAY_BUTTON}</button>')
+
@@ -0,0 +1,299 @@
+'''
+F-I curves and rheobase of many cells at once (Chapter 5, excitability)
+
+How a neuron's firing rate grows with the injected current, its F-I curve,
+and the smallest current step that makes it fire, its rheobase, summarize its
+excitability. Both are measured here for a whole database of parameter sets
+at once: every (parameter set, current level) pair is one neuron of a single
+vectorized ConductanceBasedPopulation, switched from rest to a constant
+current at t = 0.
+
+Most cells settle into their final firing state long before the end of a
+protocol, so every neuron is checked every check_interval and stops once it
+has settled:
+
+    tonic   the last n_isi interspike intervals agree within isi_tol; the
+            rate is the inverse of their mean
+    rest    no spike over the last two check intervals, and V has moved by
+            less than V_tol over each of them; the rate is 0
+
+A neuron that does not settle (bursting, irregular, or still approaching
+rest) runs to t_stop, and its rate is its spike count after the transient
+over the time it was counted. Settled neurons are dropped by repacking the
+ones still running into a smaller population, with their state, whenever the
+running fraction falls below repack, so a protocol gets cheaper as it goes.
+
+FindRheobase searches the current of every cell in lock step. Each round
+simulates n_probe currents evenly spaced inside every cell's bracket as one
+population, a probe stops at its first spike or once it rests, and every
+bracket shrinks n_probe + 1 fold.
+
+Parameter names are those of sweeps.py: "C_m", "T", "g_bar.<current>" and
+"E.<current>", each given as an array with one value per parameter set.
+'''
+from dataclasses import dataclass
+
+import numpy as np
+
+from neurodyn.hh import T_squid, HH_CURRENTS, ConductanceBasedPopulation
+from neurodyn.sweeps import ApplyParameters
+
+
+def _Population(params, currents, index, V_thresh):
+    '''
+    A population of the neurons index, whose parameters are params[name][index]
+    '''
+    subset = {name: values[index] for name, values in params.items()}
+    currents = ApplyParameters(currents, subset, ("C_m", "T"))
+    return ConductanceBasedPopulation(len(index), currents, C_m=subset.get("C_m", 1.0),
+                                      T=subset.get("T", T_squid), V_thresh=V_thresh)
+
+
+def _RunUntilSettled(params, currents, I_inj, t_stop, dt, V_thresh, check_interval, V_tol, repack,
+                     OnSpikes, Settled):
+    '''
+    Runs one neuron per entry of I_inj until each has settled or t_stop is reached
+
+    Inputs
+        params: dict of name -> array of shape (n,)
+            The parameters of every neuron
+        I_inj: array of shape (n,)
+            The step current of every neuron (uA/cm^2)
+        OnSpikes: callable
+            OnSpikes(neurons, t) is told of the neurons that spiked at time t
+        Settled: callable
+            Settled(neurons, t, resting) returns which of the neurons have
+            settled, given which of them are at rest
+        The rest are as for ComputeFICurves
+
+    Outputs
+        t_settled: array of shape (n,)
+            The time each neuron stopped (ms), t_stop for those that never settled
+    '''
+    n = len(I_inj)
+    t_settled = np.full(n, float(t_stop))
+    index = np.arange(n)    # The neurons still running, in population order
+    pop = _Population(params, currents, index, V_thresh)
+    I = np.array(I_inj, dtype=pop.dtype)
+    # V at the last two checks, and whether each neuron spiked since the one before last
+    V_checks = [np.full(n, np.nan), pop.V.copy()]
+    spiked_since = [np.ones(n, dtype=bool), np.zeros(n, dtype=bool)]
+    check_steps = max(int(round(check_interval / dt)), 1)
+    # Settled neurons keep being stepped until the next repack, but are no longer reported
+    running = np.ones(n, dtype=bool)
+    for k in range(1, int(round(t_stop / dt)) + 1):
+        spiked = pop.Step(dt, I)
+        if spiked.any():
+            spiked &= running
+            OnSpikes(index[spiked], pop.t)
+            spiked_since[1] |= spiked
+        if k % check_steps:
+            continue
+
+        resting = ~(spiked_since[0] | spiked_since[1]) & (np.abs(pop.V - V_checks[1]) < V_tol) & \
+            (np.abs(V_checks[1] - V_checks[0]) < V_tol)
+        active = np.flatnonzero(running)
+        settled = active[Settled(index[active], pop.t, resting[active])]
+        t_settled[index[settled]] = pop.t
+        running[settled] = False
+        if not running.any():
+            break
+        V_checks = [V_checks[1], pop.V.copy()]
+        spiked_since = [spiked_since[1], np.zeros(len(index), dtype=bool)]
+        if running.mean() >= repack:
+            continue
+        keep = np.flatnonzero(running)
+        new = _Population(params, currents, index[keep], V_thresh)
+        new.V[:] = pop.V[keep]
+        new.gates[:] = pop.gates[:, keep]
+        new.t = pop.t
+        pop, index, running, I = new, index[keep], running[keep], I[keep]
+        V_checks = [V[keep] for V in V_checks]
+        spiked_since = [s[keep] for s in spiked_since]
+    return t_settled
+
+
+def _Expand(params, n_repeat):
+    '''
+    Repeats the values of every parameter set n_repeat times, one neuron per repeat
+    '''
+    return {name: np.repeat(values, n_repeat) for name, values in params.items()}
+
+
+def _ParameterSets(params):
+    '''
+    The parameter arrays, and the number of sets they hold
+    '''
+    params = {} if params is None else {name: np.atleast_1d(np.asarray(values)) for name, values in params.items()}
+    return params, len(next(iter(params.values()))) if params else 1
+
+
+@dataclass
+class FICurves:
+    '''
+    The F-I curves of a set of cells
+
+    Attributes
+        I: array of shape (n_levels,)
+            The injected current levels (uA/cm^2)
+        rate: array of shape (n_sets, n_levels)
+            The steady firing rate (Hz) of each parameter set at each level
+        settled: array of shape (n_sets, n_levels)
+            Whether the run settled before t_stop; otherwise rate is its mean rate after the transient
+        t_settled: array of shape (n_sets, n_levels)
+            The time each run stopped (ms)
+    '''
+    I: np.ndarray
+    rate: np.ndarray
+    settled: np.ndarray
+    t_settled: np.ndarray
+
+    def Rheobase(self):
+        '''
+        The smallest current level at which each parameter set keeps firing, NaN if none does
+        '''
+        firing = self.rate > 0
+        return np.where(firing.any(axis=1), self.I[np.argmax(firing, axis=1)], np.nan)
+
+
+def ComputeFICurves(I_levels, params=None, currents=None, t_stop=2000.0, dt=0.01, t_transient=100.0,
+                    V_thresh=0.0, n_isi=4, isi_tol=0.01, V_tol=1e-3, check_interval=20.0, repack=0.5):
+    '''
+    Runs a step-current protocol at every current level for every parameter set
+
+    Inputs
+        I_levels: array of shape (n_levels,)
+            The injected current densities (uA/cm^2)
+        params: dict of name -> array of shape (n_sets,), optional
+            The parameter sets (defaults to the unmodified model)
+        currents: list of Current
+            The model's currents (defaults to HH_CURRENTS)
+        t_stop: float
+            The longest run (ms)
+        dt: float
+            The step size (ms)
+        t_transient: float
+            Spikes before this time (ms) are not counted
+        V_thresh: float
+            The spike detection threshold (mV)
+        n_isi: int
+            The number of consecutive intervals that must agree for tonic firing to be settled
+        isi_tol: float
+            The largest relative spread (max - min)/mean of those intervals
+        V_tol: float
+            The largest change of V (mV) over a check interval of a resting cell
+        check_interval: float
+            How often the firing states are checked (ms)
+        repack: float
+            The running neurons are repacked when they fall below this fraction of the population
+
+    Outputs
+        An FICurves
+    '''
+    I_levels = np.atleast_1d(np.asarray(I_levels, dtype=np.float64))
+    currents = HH_CURRENTS if currents is None else currents
+    params, n_sets = _ParameterSets(params)
+    n_levels = len(I_levels)
+    n = n_sets * n_levels
+
+    rate = np.zeros(n)
+    settled = np.zeros(n, dtype=bool)
+    counted = np.zeros(n, dtype=np.int64)
+    # The times of the last n_isi + 1 counted spikes of every neuron, oldest first
+    last = np.full((n, n_isi + 1), np.nan)
+
+    def OnSpikes(neurons, t):
+        if t >= t_transient:
+            counted[neurons] += 1
+            last[neurons] = np.roll(last[neurons], -1, axis=1)
+            last[neurons, -1] = t
+
+    def Settled(neurons, t, resting):
+        isi = np.diff(last[neurons], axis=1)
+        mean = isi.mean(axis=1)
+        tonic = (counted[neurons] > n_isi) & (isi.max(axis=1) - isi.min(axis=1) < isi_tol * mean)
+        rate[neurons[tonic]] = 1e3 / mean[tonic]
+        resting &= t >= t_transient
+        rate[neurons[resting]] = 0.0
+        done = tonic | resting
+        settled[neurons[done]] = True
+        return done
+
+    t_settled = _RunUntilSettled(_Expand(params, n_levels), currents, np.tile(I_levels, n_sets), t_stop, dt,
+                                 V_thresh, check_interval, V_tol, repack, OnSpikes, Settled)
+    window = np.maximum(t_settled - t_transient, dt) * 1e-3
+    rate[~settled] = counted[~settled] / window[~settled]
+    return FICurves(I_levels, rate.reshape(n_sets, n_levels), settled.reshape(n_sets, n_levels),
+                    t_settled.reshape(n_sets, n_levels))
+
+
+def FindRheobase(params=None, currents=None, I_low=0.0, I_high=20.0, tol=0.01, n_probe=3, t_stop=500.0,
+                 dt=0.01, V_thresh=0.0, V_tol=1e-3, check_interval=10.0, repack=0.5):
+    '''
+    Finds the smallest step current that makes each parameter set spike
+
+    A cell counts as firing at a current if it spikes at least once within
+    t_stop of the step. The brackets of all cells shrink together; a cell whose
+    bracket is already narrower than tol is not probed again.
+
+    Inputs
+        params: dict of name -> array of shape (n_sets,), optional
+            The parameter sets (defaults to the unmodified model)
+        currents: list of Current
+            The model's currents (defaults to HH_CURRENTS)
+        I_low, I_high: float or array of shape (n_sets,)
+            The initial bracket (uA/cm^2); cells that spike at I_low get I_low,
+            and cells that do not spike at I_high get NaN
+        tol: float
+            The width of the final brackets (uA/cm^2)
+        n_probe: int
+            The number of currents probed per cell and round
+        t_stop: float
+            The longest run of a probe (ms)
+        dt, V_thresh, V_tol, check_interval, repack:
+            As for ComputeFICurves
+
+    Outputs
+        (rheobase, bracket): the upper end of each final bracket (uA/cm^2), and
+        the brackets as an array of shape (n_sets, 2)
+    '''
+    currents = HH_CURRENTS if currents is None else currents
+    params, n_sets = _ParameterSets(params)
+    lo = np.broadcast_to(np.asarray(I_low, dtype=np.float64), (n_sets,)).copy()
+    hi = np.broadcast_to(np.asarray(I_high, dtype=np.float64), (n_sets,)).copy()
+
+    def Fires(cells, I):
+        '''
+        Whether each cell spikes at its current I
+        '''
+        fired = np.zeros(len(I), dtype=bool)
+
+        def OnSpikes(neurons, t):
+            fired[neurons] = True
+
+        def Settled(neurons, t, resting):
+            return fired[neurons] | resting
+
+        subset = {name: values[cells] for name, values in params.items()}
+        _RunUntilSettled(subset, currents, I, t_stop, dt, V_thresh, check_interval, V_tol, repack,
+                         OnSpikes, Settled)
+        return fired
+
+    # Check both ends of the brackets, as one population
+    cells = np.arange(n_sets)
+    fired = Fires(np.concatenate([cells, cells]), np.concatenate([lo, hi]))
+    hi[fired[:n_sets]] = lo[fired[:n_sets]]
+    lo[~fired[n_sets:]], hi[~fired[n_sets:]] = np.nan, np.nan
+
+    fractions = np.arange(1, n_probe + 1) / (n_probe + 1)
+    while True:
+        cells = np.flatnonzero(hi - lo > tol)
+        if not cells.size:
+            break
+        I = lo[cells, None] + (hi - lo)[cells, None] * fractions
+        fired = Fires(np.repeat(cells, n_probe), I.ravel()).reshape(-1, n_probe)
+        # The bracket becomes the probes either side of the first that fired
+        first = np.where(fired.any(axis=1), np.argmax(fired, axis=1), n_probe)
+        lo[cells] = np.where(first > 0, I[np.arange(len(cells)), np.maximum(first - 1, 0)], lo[cells])
+        hi[cells] = np.where(first < n_probe, I[np.arange(len(cells)), np.minimum(first, n_probe - 1)], hi[cells])
+    return hi, np.stack([lo, hi], axis=1)
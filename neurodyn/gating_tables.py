@@ -0,0 +1,162 @@
+'''
+Tabulated gating kinetics for the conductance-based models of Chapter 5
+
+Evaluating the alpha/beta rate functions is the most expensive part of every
+Hodgkin-Huxley step. A GatingTable samples x_inf(V), tau_x(V), and the
+Rush-Larsen decay factor exp(-dt/tau_x(V)) once on a fine voltage grid, after
+which every step only needs a vectorized linear interpolation. All tables on
+the same grid share one index computation per step.
+'''
+from functools import lru_cache
+
+import numpy as np
+
+from neurodyn.hh import T_squid
+
+
+class VoltageGrid:
+    '''
+    A uniform voltage grid and the interpolation weights of a set of voltages on it
+
+    Voltages outside [V_min, V_max] are clamped to the ends of the grid.
+    '''
+
+    def __init__(self, V_min=-100.0, V_max=60.0, dV=0.01):
+        self.V_min, self.V_max, self.dV = V_min, V_max, dV
+        self.n = int(round((V_max - V_min) / dV)) + 1
+        self.V = V_min + dV * np.arange(self.n)
+
+    def Weights(self, V, dtype=np.float64):
+        '''
+        Computes the left grid index and fractional offset of each voltage
+
+        Outputs
+            (index, frac): integer and float arrays with the shape of V
+        '''
+        u = (np.asarray(V, dtype=dtype) - dtype(self.V_min)) * dtype(1 / self.dV)
+        np.clip(u, 0, self.n - 1.000001, out=u)
+        index = u.astype(np.intp)
+        u -= index
+        return index, u
+
+
+class GatingTable:
+    '''
+    x_inf, tau_x, and exp(-dt/tau_x) of one gate, tabulated on a VoltageGrid
+
+    Inputs
+        kinetics: GateKinetics
+            The gate to tabulate
+        T: float
+            The temperature in Kelvin
+        grid: VoltageGrid
+            The voltage grid
+    '''
+
+    def __init__(self, kinetics, T=T_squid, grid=None):
+        self.kinetics = kinetics
+        self.T = T
+        self.grid = VoltageGrid() if grid is None else grid
+        self.x_inf, self.tau = kinetics.SteadyState(self.grid.V, T)
+        # exp(-dt/tau), and x_inf (1 - exp(-dt/tau)), for each step size dt that has been requested
+        self.decay = {}
+        self.drive = {}
+        self._segments = {}
+
+    def _Interpolate(self, key, values, weights, dtype, out=None):
+        '''
+        Linearly interpolates tabulated values, whose (value, slope) segments are cached under key per dtype
+        '''
+        key = (key, np.dtype(dtype))
+        if key not in self._segments:
+            self._segments[key] = tuple(s.astype(dtype) for s in _Segments(values))
+        value, slope = self._segments[key]
+        index, frac = weights
+        # Indices are already clamped to the grid, so skip numpy's bounds check
+        out = np.take(slope, index, out=out, mode="clip")
+        out *= frac
+        out += np.take(value, index, mode="clip")
+        return out
+
+    def XInf(self, V, weights=None, out=None):
+        '''
+        Interpolates the steady state x_inf(V)
+        '''
+        V = np.asarray(V)
+        weights = self.grid.Weights(V, V.dtype.type) if weights is None else weights
+        return self._Interpolate("x_inf", self.x_inf, weights, V.dtype.type, out)
+
+    def Tau(self, V, weights=None, out=None):
+        '''
+        Interpolates the time constant tau_x(V) (ms)
+        '''
+        V = np.asarray(V)
+        weights = self.grid.Weights(V, V.dtype.type) if weights is None else weights
+        return self._Interpolate("tau", self.tau, weights, V.dtype.type, out)
+
+    def Decay(self, V, dt, weights=None, out=None):
+        '''
+        Interpolates the Rush-Larsen decay factor exp(-dt/tau_x(V)), tabulated once per dt
+        '''
+        V = np.asarray(V)
+        self._Tabulate(dt)
+        weights = self.grid.Weights(V, V.dtype.type) if weights is None else weights
+        return self._Interpolate(("decay", dt), self.decay[dt], weights, V.dtype.type, out)
+
+    def _Tabulate(self, dt):
+        '''
+        Tabulates the decay factor and drive of a step of size dt, once per dt
+        '''
+        if dt not in self.decay:
+            self.decay[dt] = np.exp(-dt / self.tau)
+            self.drive[dt] = self.x_inf * (1 - self.decay[dt])
+
+    def Step(self, x, V, dt, weights=None):
+        '''
+        Advances the gate state x in place by one Rush-Larsen step of size dt
+        '''
+        V = np.asarray(V)
+        weights = self.grid.Weights(V, V.dtype.type) if weights is None else weights
+        # x <- x_inf (1 - d) + d x, with x_inf (1 - d) tabulated alongside d = exp(-dt/tau)
+        d = self.Decay(V, dt, weights)
+        x *= d
+        x += self._Interpolate(("drive", dt), self.drive[dt], weights, V.dtype.type, d)
+        return x
+
+    def MaxError(self, n_samples=100001):
+        '''
+        Reports the maximum interpolation error against the analytic rate functions
+
+        The error is measured on a grid n_samples points fine spanning the table,
+        which includes points midway between table nodes where linear
+        interpolation is least accurate.
+
+        Outputs
+            A dict with the maximum absolute errors of x_inf and tau (ms), and of
+            tau relative to its value
+        '''
+        V = np.linspace(self.grid.V_min, self.grid.V_max, n_samples)
+        x_inf, tau = self.kinetics.SteadyState(V, self.T)
+        tau_err = np.abs(self.Tau(V) - tau)
+        return {"x_inf": np.max(np.abs(self.XInf(V) - x_inf)),
+                "tau": np.max(tau_err),
+                "tau_relative": np.max(tau_err / tau)}
+
+
+def _Segments(values):
+    '''
+    The (value, slope) pairs of each grid cell for linear interpolation
+    '''
+    slope = np.append(np.diff(values), 0.0)
+    return values, slope
+
+
+@lru_cache(maxsize=None)
+def GetGatingTable(kinetics, T=T_squid, V_min=-100.0, V_max=60.0, dV=0.01):
+    '''
+    Returns the GatingTable of a gate, building it only the first time it is requested
+
+    Tables are cached by the gate's kinetics parameters, the temperature, and the
+    voltage grid, so populations and sweeps with the same kinetics share one table.
+    '''
+    return GatingTable(kinetics, T, VoltageGrid(V_min, V_max, dV))
@@ -0,0 +1,178 @@
+'''
+Batched Goldman-Hodgkin-Katz current and voltage equations (Chapter 2)
+
+The last axis of every permeability and concentration array indexes ion
+species; all leading axes index membrane configurations and are evaluated
+together, so 10^6 configurations cost one call and no Python loop.
+'''
+import numpy as np
+
+from neurodyn.ions import F, RF_mV, T_phys, MAMMALIAN_IONS, NernstPotential
+
+
+def _GHKFlux(u, C_in, C_out):
+    '''
+    u (C_in - C_out exp(-u)) / (1 - exp(-u)), with its limit of C_in - C_out at u = 0
+    '''
+    # A single expm1 gives both 1 - exp(-u) and exp(-u)
+    d = -np.expm1(-u)
+    small = np.abs(u) < 1e-8
+    ratio = np.where(small, 1.0, u / np.where(small, 1.0, d))
+    return ratio * (C_in - C_out * (1.0 - d))
+
+
+def GHKCurrent(V, P, z, C_in, C_out, T=T_phys):
+    '''
+    Computes the Goldman-Hodgkin-Katz current equation
+
+    Inputs
+        V: float or array
+            The membrane potential in millivolts (mV)
+        P: float or array
+            The permeability of the membrane to the ion species (cm/s)
+        z: float or array
+            The valence (charge) of the ion species
+        C_in: float or array
+            The intracellular ion concentration (mM)
+        C_out: float or array
+            The extracellular ion concentration (mM)
+        T: float or array
+            The temperature in Kelvin
+
+    Outputs
+        The outward current density in microamperes per square centimeter (uA/cm^2),
+        with the broadcast shape of the inputs
+    '''
+    # Dimensionless potential zFV/RT
+    u = np.asarray(z) * np.asarray(V) / (RF_mV * np.asarray(T))
+    # P z F u (C_in - C_out exp(-u)) / (1 - exp(-u)), in uA/cm^2 when C is in mM
+    return P * z * F * _GHKFlux(u, C_in, C_out)
+
+
+def GHKVoltage(P, z, C_in, C_out, T=T_phys, tol=1e-9, max_iter=100):
+    '''
+    Computes the Goldman-Hodgkin-Katz resting potential of many membrane configurations
+
+    For monovalent ions the closed-form GHK voltage equation is used. When any
+    species has |z| != 1 (e.g. Ca2+) the resting potential is instead found as the
+    zero of the total GHK current by a vectorized bracketed root search between the smallest
+    and largest Nernst potentials of the permeant species.
+
+    Inputs
+        P: array
+            The permeabilities (cm/s), with ion species along the last axis
+        z: array
+            The valences of the ion species, broadcast against P
+        C_in: array
+            The intracellular ion concentrations (mM), broadcast against P
+        C_out: array
+            The extracellular ion concentrations (mM), broadcast against P
+        T: float or array
+            The temperature in Kelvin, broadcast against the configuration axes
+        tol: float
+            The largest change in any resting potential, in millivolts, at which to stop
+        max_iter: int
+            The maximum number of root-finding steps
+
+    Outputs
+        The resting membrane potential of each configuration in millivolts (mV),
+        with the broadcast shape of the inputs minus the species axis
+    '''
+    P, z, C_in, C_out = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (P, z, C_in, C_out)))
+    T = np.asarray(T, dtype=float)
+
+    if np.all(np.abs(z) == 1):
+        # Cations enter the numerator with their extracellular concentration,
+        # anions with their intracellular concentration
+        cation = z > 0
+        num = np.sum(P * np.where(cation, C_out, C_in), axis=-1)
+        den = np.sum(P * np.where(cation, C_in, C_out), axis=-1)
+        return RF_mV * T * np.log(num / den)
+
+    # The total GHK current increases monotonically with V, and its zero lies
+    # between the extreme reversal potentials of the permeant species
+    T_s = T[..., np.newaxis]
+    E = NernstPotential(z, T_s, C_in, C_out)
+    permeant = P > 0
+    lo = np.min(np.where(permeant, E, np.inf), axis=-1)
+    hi = np.max(np.where(permeant, E, -np.inf), axis=-1)
+
+    # Hoist everything that does not depend on V out of the iteration
+    PzF = P * z * F
+    k = z / (RF_mV * T_s)
+
+    def TotalCurrent(V):
+        return np.sum(PzF * _GHKFlux(k * V[..., np.newaxis], C_in, C_out), axis=-1)
+
+    # Illinois (modified regula falsi) iteration, which keeps the bracket of
+    # bisection but converges superlinearly
+    f_lo, f_hi = TotalCurrent(lo), TotalCurrent(hi)
+    side = np.zeros(lo.shape, dtype=np.int8)
+    V = 0.5 * (lo + hi)
+    for _ in range(max_iter):
+        V_prev = V
+        span = f_hi - f_lo
+        V = np.where(span > 0, (lo*f_hi - hi*f_lo) / np.where(span > 0, span, 1.0), 0.5*(lo + hi))
+        f = TotalCurrent(V)
+        above = f > 0
+        # Halve the function value at the endpoint that was kept twice in a row
+        f_lo = np.where(above & (side == -1), 0.5*f_lo, f_lo)
+        f_hi = np.where(~above & (side == 1), 0.5*f_hi, f_hi)
+        hi, f_hi = np.where(above, V, hi), np.where(above, f, f_hi)
+        lo, f_lo = np.where(above, lo, V), np.where(above, f_lo, f)
+        side = np.where(above, -1, 1).astype(np.int8)
+        if np.max(np.abs(V - V_prev)) < tol:
+            break
+    return V
+
+
+def GHKTableVoltage(P, ions=MAMMALIAN_IONS, T=T_phys, **kwargs):
+    '''
+    Computes GHKVoltage for permeabilities applied to a structured ion table
+
+    Inputs
+        P: array
+            The permeabilities (cm/s), with the species of the ion table along the last axis
+        ions: structured array of dtype ION_DTYPE
+            The ion table, broadcast against P
+        T: float or array
+            The temperature in Kelvin
+
+    Outputs
+        The resting membrane potential of each configuration in millivolts (mV)
+    '''
+    return GHKVoltage(P, ions["z"], ions["C_in"], ions["C_out"], T=T, **kwargs)
+
+
+def CheckSingleIonLimit(ions=MAMMALIAN_IONS, T=T_phys, atol=1e-6):
+    '''
+    Checks the GHK equations against NernstPotential in the single-ion limit
+
+    With only one permeant species, the GHK voltage must equal that species'
+    Nernst potential, and the GHK current must vanish there.
+
+    Inputs
+        ions: structured array of dtype ION_DTYPE
+            The ion table to check, with species along the last axis
+        T: float or array
+            The temperature in Kelvin, broadcast against all but the species axis of ions
+        atol: float
+            The tolerance in millivolts (and uA/cm^2 for the current)
+
+    Outputs
+        The maximum absolute deviation of the GHK voltage from the Nernst potential (mV);
+        raises a ValueError if it, or the GHK current there, exceeds atol
+    '''
+    n_species = ions.shape[-1]
+    T = np.asarray(T, dtype=float)
+    E = NernstPotential(ions["z"], T[..., np.newaxis], ions["C_in"], ions["C_out"])
+    # One permeability vector per species, with only that species permeant
+    P = np.eye(n_species).reshape((n_species,) + (1,)*(ions.ndim - 1) + (n_species,))
+    V = np.moveaxis(GHKTableVoltage(P, ions, T), 0, -1)
+    err = np.max(np.abs(V - E))
+    I = GHKCurrent(E, 1.0, ions["z"], ions["C_in"], ions["C_out"], T[..., np.newaxis])
+    if not err < atol:
+        raise ValueError(f"GHK voltage deviates from the Nernst potential by {err} mV")
+    if not np.max(np.abs(I)) < atol:
+        raise ValueError(f"GHK current at the Nernst potential is {np.max(np.abs(I))} uA/cm^2")
+    return err
@@ -0,0 +1,363 @@
+'''
+Population-scale conductance-based (Hodgkin-Huxley) models of Chapter 5
+
+    C_m dV/dt = -sum_j g_bar_j m_j^p h_j^q (V - E_j) + I_inj
+
+Each ionic current is declared generically by its maximal conductance,
+reversal potential, exponents p and q, and the kinetics of its activation and
+inactivation gates. A population of N neurons keeps its state as a structure
+of arrays: one contiguous array for V and one contiguous row per gating
+variable, all advanced together by exponential-Euler (Rush-Larsen) steps.
+
+Units follow the rest of the book: mV, ms, uF/cm^2, mS/cm^2, uA/cm^2, and Kelvin.
+'''
+from dataclasses import dataclass, field
+
+import numpy as np
+
+# Temperature of Hodgkin and Huxley's squid axon recordings (6.3 deg Celsius)
+T_squid = 279.45
+
+
+@dataclass(frozen=True)
+class RateFunction:
+    '''
+    An opening (alpha) or closing (beta) rate of a gate, in 1/ms
+
+    Hodgkin and Huxley fit all of their rates with one of three forms:
+        "exponential": A exp((V - V_half)/k)
+        "sigmoid":     A / (1 + exp((V - V_half)/k))
+        "linoid":      A (V - V_half) / (1 - exp(-(V - V_half)/k))
+    '''
+    form: str
+    A: float
+    V_half: float
+    k: float
+
+    def __call__(self, V):
+        x = (np.asarray(V) - self.V_half) / self.k
+        if self.form == "exponential":
+            return self.A * np.exp(x)
+        if self.form == "sigmoid":
+            return self.A / (1 + np.exp(x))
+        if self.form == "linoid":
+            # x / (1 - exp(-x)) has the limit 1 at x = 0
+            small = np.abs(x) < 1e-6
+            denom = -np.expm1(-np.where(small, 1.0, x))
+            return self.A * self.k * np.where(small, 1 + 0.5*x, x / denom)
+        raise ValueError(f"Unknown rate function form {self.form!r}")
+
+
+@dataclass(frozen=True)
+class GateKinetics:
+    '''
+    The first-order kinetics dx/dt = phi(T) (alpha(V) (1 - x) - beta(V) x) of a gating variable
+
+    The rates are scaled from the reference temperature T_ref (K) by phi(T) = Q10^((T - T_ref)/10).
+    Gates compare (and hash) by their kinetics alone, so a gate shared by two
+    currents is only integrated once.
+    '''
+    alpha: RateFunction
+    beta: RateFunction
+    Q10: float = 3.0
+    T_ref: float = T_squid
+    name: str = field(default="x", compare=False)
+
+    def Phi(self, T):
+        '''
+        The temperature factor of the rates
+        '''
+        return self.Q10 ** ((np.asarray(T) - self.T_ref) / 10)
+
+    def SteadyState(self, V, T=T_squid):
+        '''
+        Computes the steady state x_inf(V) and time constant tau_x(V) (ms) of the gate
+        '''
+        a, b = self.alpha(V), self.beta(V)
+        s = a + b
+        return a / s, 1 / (self.Phi(T) * s)
+
+
+@dataclass
+class Current:
+    '''
+    An ionic current I_j = g_bar m^p h^q (V - E)
+
+    g_bar (mS/cm^2) and E (mV) may be scalars or arrays with one entry per neuron.
+    A current without gates (p = q = 0) is a passive leak.
+    '''
+    name: str
+    g_bar: object
+    E: object
+    p: int = 0
+    m: GateKinetics = None
+    q: int = 0
+    h: GateKinetics = None
+
+
+# Hodgkin and Huxley's squid giant axon, with the resting potential shifted to -65 mV
+HH_m = GateKinetics(RateFunction("linoid", 0.1, -40.0, 10.0), RateFunction("exponential", 4.0, -65.0, -18.0), name="m")
+HH_h = GateKinetics(RateFunction("exponential", 0.07, -65.0, -20.0), RateFunction("sigmoid", 1.0, -35.0, -10.0), name="h")
+HH_n = GateKinetics(RateFunction("linoid", 0.01, -55.0, 10.0), RateFunction("exponential", 0.125, -65.0, -80.0), name="n")
+
+HH_CURRENTS = [Current("Na", 120.0, 50.0, p=3, m=HH_m, q=1, h=HH_h),
+               Current("K", 36.0, -77.0, p=4, m=HH_n),
+               Current("leak", 0.3, -54.387)]
+
+
+class ConductanceBasedPopulation:
+    '''
+    N independent conductance-based point neurons sharing a set of current declarations
+
+    Inputs
+        N: int
+            The number of neurons
+        currents: list of Current
+            The ionic currents of every neuron (defaults to HH_CURRENTS)
+        C_m: float or array of shape (N,)
+            The membrane capacitance (uF/cm^2)
+        T: float
+            The temperature in Kelvin
+        V0: float or array of shape (N,)
+            The initial membrane potential (mV); gates start at their steady states
+        V_thresh: float
+            The upward crossing of this voltage (mV) that counts as a spike
+        dtype: np.float32 or np.float64
+            The floating point precision of the state arrays
+
+    Call UseGatingTables to replace the analytic rate functions by interpolated tables.
+
+    Attributes
+        V: array of shape (N,)
+            The membrane potentials (mV)
+        gates: array of shape (n_gates, N)
+            One contiguous row per distinct gating variable
+        spike_count: array of shape (N,)
+            The number of spikes emitted by each neuron so far
+        t: float
+            The current simulation time (ms)
+    '''
+
+    def __init__(self, N, currents=None, C_m=1.0, T=T_squid, V0=-65.0, V_thresh=0.0, dtype=np.float64):
+        self.N = N
+        self.currents = list(HH_CURRENTS if currents is None else currents)
+        self.dtype = np.dtype(dtype)
+        self.C_m = np.broadcast_to(np.asarray(C_m, dtype=self.dtype), (N,))
+        self.T = T
+        self.V_thresh = V_thresh
+        self.t = 0.0
+        self.tables = None
+
+        # Distinct gates, in order of first appearance, and each current's gate rows
+        self.kinetics = []
+        self._gate_rows = []
+        for current in self.currents:
+            rows = []
+            for gate, power in ((current.m, current.p), (current.h, current.q)):
+                if gate is None or power == 0:
+                    continue
+                if gate not in self.kinetics:
+                    self.kinetics.append(gate)
+                rows.append((self.kinetics.index(gate), power))
+            self._gate_rows.append(rows)
+        self._phi = np.array([gate.Phi(T) for gate in self.kinetics], dtype=self.dtype)
+
+        self._g_bar = [np.broadcast_to(np.asarray(c.g_bar, dtype=self.dtype), (N,)) for c in self.currents]
+        self._E = [np.broadcast_to(np.asarray(c.E, dtype=self.dtype), (N,)) for c in self.currents]
+
+        # State arrays
+        self.V = np.empty(N, dtype=self.dtype)
+        self.gates = np.empty((len(self.kinetics), N), dtype=self.dtype)
+        self.spike_count = np.zeros(N, dtype=np.int64)
+        self.Reset(V0)
+
+        # Scratch buffers reused by every step
+        self._g = np.empty(N, dtype=self.dtype)
+        self._G = np.empty(N, dtype=self.dtype)
+        self._GE = np.empty(N, dtype=self.dtype)
+        self._V_prev = np.empty(N, dtype=self.dtype)
+
+    @property
+    def gate_names(self):
+        return [gate.name for gate in self.kinetics]
+
+    def Gate(self, name):
+        '''
+        Returns the (writable) state row of the gate with the given name
+        '''
+        return self.gates[self.gate_names.index(name)]
+
+    def UseGatingTables(self, V_min=-100.0, V_max=60.0, dV=0.01):
+        '''
+        Switches the gate updates to tabulated kinetics on a shared voltage grid
+
+        The tables are shared with every other population using the same kinetics
+        and temperature. Calling with V_min=None switches back to the analytic rates.
+
+        Outputs
+            The list of GatingTable objects, one per gate, in the order of the gates rows
+        '''
+        from neurodyn.gating_tables import GetGatingTable
+
+        if V_min is None:
+            self.tables = None
+        else:
+            self.tables = [GetGatingTable(gate, self.T, V_min, V_max, dV) for gate in self.kinetics]
+        return self.tables
+
+    def Reset(self, V0=-65.0):
+        '''
+        Puts every neuron at V0 with its gates at steady state, and clears the spike counts
+        '''
+        self.V[:] = V0
+        for i, gate in enumerate(self.kinetics):
+            self.gates[i] = gate.SteadyState(self.V, self.T)[0]
+        self.spike_count[:] = 0
+        self.t = 0.0
+
+    def Conductances(self, out=None):
+        '''
+        Computes the total conductance G = sum_j g_j and the sum sum_j g_j E_j over all currents
+        '''
+        G, GE, g = (self._G, self._GE, self._g) if out is None else out
+        G.fill(0)
+        GE.fill(0)
+        for g_bar, E, rows in zip(self._g_bar, self._E, self._gate_rows):
+            g[:] = g_bar
+            for row, power in rows:
+                for _ in range(power):
+                    g *= self.gates[row]
+            G += g
+            g *= E
+            GE += g
+        return G, GE
+
+    def Derivatives(self, y, I_inj=0.0, index=slice(None)):
+        '''
+        Evaluates the vector field of the model for a stack of states
+
+        Inputs
+            y: array of shape (1 + n_gates, ...)
+                V in the first row and the gates in the following rows, for the neurons index
+            I_inj: float or array of shape (N,)
+                The injected current density (uA/cm^2)
+            index: slice or integer array
+                The neurons of the population whose parameters apply to the columns of y
+
+        Outputs
+            The time derivatives dy/dt, with the shape of y
+        '''
+        V = y[0]
+        I_inj = np.asarray(I_inj)
+        I = I_inj[index] if I_inj.ndim else I_inj
+        for g_bar, E, rows in zip(self._g_bar, self._E, self._gate_rows):
+            g = g_bar[index]
+            for row, power in rows:
+                g = g * y[1 + row]**power
+            I = I - g * (V - E[index])
+        dy = np.empty_like(y)
+        dy[0] = I / self.C_m[index]
+        for i, gate in enumerate(self.kinetics):
+            x = y[1 + i]
+            dy[1 + i] = self._phi[i] * (gate.alpha(V) * (1 - x) - gate.beta(V) * x)
+        return dy
+
+    def StepGates(self, dt):
+        '''
+        Advances every gate by dt with the membrane potential held fixed
+
+        Each gate relaxes exactly towards x_inf(V) with time constant tau_x(V),
+        using the gating tables if UseGatingTables has been called.
+        '''
+        V = self.V
+        # Gates: x <- x_inf + (x - x_inf) exp(-dt phi (alpha + beta))
+        if self.tables:
+            # One interpolation index for all tables, since they share a grid
+            weights = self.tables[0].grid.Weights(V, self.dtype.type)
+            for x, table in zip(self.gates, self.tables):
+                table.Step(x, V, dt, weights)
+            return
+        for i, gate in enumerate(self.kinetics):
+            a, b = gate.alpha(V), gate.beta(V)
+            s = a + b
+            x_inf = a / s
+            x = self.gates[i]
+            x -= x_inf
+            s *= -dt * self._phi[i]
+            x *= np.exp(s, out=s)
+            x += x_inf
+
+    def Step(self, dt, I_inj=0.0):
+        '''
+        Advances every neuron by dt with exponential-Euler (Rush-Larsen) updates
+
+        Each gate relaxes exactly towards x_inf(V) with time constant tau_x(V), and
+        V relaxes exactly towards (sum_j g_j E_j + I_inj)/G with time constant C_m/G,
+        both with V and the gates frozen at the start of the step. This remains
+        stable at step sizes where forward Euler would blow up.
+
+        Inputs
+            dt: float
+                The step size (ms)
+            I_inj: float or array of shape (N,)
+                The injected current density (uA/cm^2)
+
+        Outputs
+            A boolean array marking the neurons that spiked during the step
+        '''
+        V = self.V
+        G, GE = self.Conductances()
+        np.copyto(self._V_prev, V)
+
+        self.StepGates(dt)
+
+        # Voltage: V <- V + (GE + I - G V)/G (1 - exp(-dt G/C_m))
+        z = G * (dt / self.C_m)
+        relax = np.where(z > 1e-12, -np.expm1(-z) / np.where(z > 1e-12, z, 1.0), 1.0) * (dt / self.C_m)
+        GE += I_inj
+        GE -= G * V
+        GE *= relax
+        V += GE
+
+        self.t += dt
+        spiked = (self._V_prev < self.V_thresh) & (V >= self.V_thresh)
+        self.spike_count += spiked
+        return spiked
+
+    def Run(self, t_stop, dt, I_inj=0.0, record_every=0, out=None, recorder=None):
+        '''
+        Advances the population for t_stop milliseconds
+
+        Inputs
+            t_stop: float
+                The duration of the run (ms)
+            dt: float
+                The step size (ms)
+            I_inj: float, array of shape (N,), or callable
+                The injected current density (uA/cm^2), or a function of time returning it
+            record_every: int
+                Record V every this many steps (0 records nothing)
+            out: array of shape (n_steps // record_every + 1, N), optional
+                A preallocated buffer for the recorded voltages
+            recorder: TraceWriter, optional
+                Streams the chosen state variables to disk after every step (see traces.py)
+
+        Outputs
+            The recorded voltage trace (mV) with the initial state in the first row,
+            or None if nothing was recorded
+        '''
+        n_steps = int(round(t_stop / dt))
+        trace = None
+        if record_every:
+            shape = (n_steps // record_every + 1, self.N)
+            trace = np.empty(shape, dtype=self.dtype) if out is None else out
+            if trace.shape != shape:
+                raise ValueError(f"out must have shape {shape}, got {trace.shape}")
+            trace[0] = self.V
+        for k in range(1, n_steps + 1):
+            self.Step(dt, I_inj(self.t) if callable(I_inj) else I_inj)
+            if record_every and k % record_every == 0:
+                trace[k // record_every] = self.V
+            if recorder is not None:
+                recorder.Record(self)
+        return trace
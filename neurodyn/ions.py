@@ -0,0 +1,118 @@
+'''
+Vectorized ion-species tables and reversal potentials (Chapter 2)
+
+Ion tables are structured NumPy arrays with one record per ion species, so a
+whole sweep over species, temperatures, and concentrations can be evaluated in
+a single broadcast pass instead of a Python loop around NernstPotential.
+'''
+import numpy as np
+
+# Universal gas constant
+R = 8.31446261815324    # J / K*mol
+
+# Faraday's constant
+F = 96485.3321233100184 # C / mol
+
+# R/F in millivolts per Kelvin, computed once instead of on every call
+RF_mV = (R / F) * 1e3   # mV / K
+
+# Physiological temperature (37 deg Celsius, 310.15 Kelvin)
+T_phys = 310.15
+
+# One record per ion species
+ION_DTYPE = np.dtype([("name", "U8"),
+                      ("z", "f8"),
+                      ("C_in", "f8"),
+                      ("C_out", "f8")])
+
+
+def IonTable(name, z, C_in, C_out):
+    '''
+    Builds a structured ion table, broadcasting the fields against each other
+
+    Inputs
+        name: str or array of str
+            The label of each ion species, e.g. "K+"
+        z: float or array
+            The valence (charge) of each ion species
+        C_in: float or array
+            The intracellular ion concentrations (mM)
+        C_out: float or array
+            The extracellular ion concentrations (mM)
+
+    Outputs
+        A structured array of dtype ION_DTYPE with the broadcast shape of the inputs
+    '''
+    name, z, C_in, C_out = np.broadcast_arrays(np.asarray(name, dtype="U8"), z, C_in, C_out)
+    table = np.empty(name.shape, dtype=ION_DTYPE)
+    table["name"] = name
+    table["z"] = z
+    table["C_in"] = C_in
+    table["C_out"] = C_out
+    return table
+
+
+# Typical mammalian neuron concentrations (mM)
+MAMMALIAN_IONS = IonTable(["K+", "Na+", "Cl-", "Ca2+"],
+                          [1, 1, -1, 2],
+                          [140.0, 12.0, 7.0, 1e-4],
+                          [5.0, 145.0, 110.0, 2.0])
+
+
+def NernstPotential(z, T, C_in, C_out, dtype=np.float64, out=None):
+    '''
+    Computes the Nernst equation for any number of ion species in one broadcast pass
+
+    Inputs
+        z: float or array
+            The valence (charge) of the ion species
+        T: float or array
+            The temperature in Kelvin
+        C_in: float or array
+            The intracellular ion concentration
+        C_out: float or array
+            The extracellular ion concentration
+        dtype: np.float32 or np.float64
+            The floating point precision of the computation
+        out: array, optional
+            A preallocated buffer with the broadcast shape of the inputs and the given dtype
+
+    Outputs
+        The Nernst potentials in millivolts (mV), with the broadcast shape of the inputs
+    '''
+    dtype = np.dtype(dtype)
+    z, T, C_in, C_out = (np.asarray(x, dtype=dtype) for x in (z, T, C_in, C_out))
+    shape = np.broadcast_shapes(z.shape, T.shape, C_in.shape, C_out.shape)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape or out.dtype != dtype:
+        raise ValueError(f"out must have shape {shape} and dtype {dtype}, "
+                         f"got {out.shape} and {out.dtype}")
+
+    # Nernst equation, evaluated in place: (R/F) * T/z * log(C_out/C_in)
+    np.divide(C_out, C_in, out=out)
+    np.log(out, out=out)
+    np.multiply(out, T, out=out)
+    np.divide(out, z, out=out)
+    np.multiply(out, dtype.type(RF_mV), out=out)
+    return out
+
+
+def ReversalPotentials(ions, T=T_phys, dtype=np.float64, out=None):
+    '''
+    Computes the Nernst potential of every record in an ion table
+
+    Inputs
+        ions: structured array of dtype ION_DTYPE
+            The ion table, of any shape (e.g. concentrations x species)
+        T: float or array
+            The temperature in Kelvin, broadcast against the ion table
+        dtype: np.float32 or np.float64
+            The floating point precision of the computation
+        out: array, optional
+            A preallocated buffer with the broadcast shape of ions and T
+
+    Outputs
+        The reversal potentials in millivolts (mV)
+    '''
+    return NernstPotential(ions["z"], T, ions["C_in"], ions["C_out"], dtype=dtype, out=out)
@@ -0,0 +1,359 @@
+'''
+Networks of point neurons coupled by chemical and electrical synapses
+
+Chapter 5 treats the compartments of a neuron as point neurons joined by
+electrical synapses (gap junctions); the same picture, with chemical synapses
+added, describes a network of neurons. A Network wraps a population of point
+neurons (e.g. a ConductanceBasedPopulation) and couples them through sparse
+connectivity matrices stored in compressed sparse row (CSR) form, one row of
+outgoing synapses per presynaptic neuron:
+
+    chemical synapses  each spike adds the synapse's weight to a conductance
+                       of its target after the synapse's delay; every synapse
+                       type has its own exponentially decaying conductance g and
+                       reversal potential E, and drives I = g (E - V)
+    electrical synapses (gap junctions) drive I_i = sum_j g_ij (V_j - V_i)
+                       without delay
+
+Spikes are propagated as events: only the rows of the neurons that spiked in
+a step are read, and their weights are scattered into a ring buffer of
+future conductance increments, with one slot per step of delay. The neuron
+and synapse updates are vectorized over the whole network. Indices are stored
+as int32 and weights and delays as float32, so 10^7 synapses take about 120 MB,
+and the ring buffer takes 4 bytes per neuron, synapse type, and step of the
+longest delay.
+'''
+from dataclasses import dataclass
+
+import numpy as np
+
+from neurodyn.spikes import SpikeTrains
+
+
+@dataclass
+class SynapseMatrix:
+    '''
+    Synapses in compressed sparse row form, one row per presynaptic neuron
+
+    The synapses of presynaptic neuron i are entries indptr[i] to indptr[i + 1] - 1.
+
+    Attributes
+        indptr: int64 array of shape (N_pre + 1,)
+        indices: int32 array of shape (n_synapses,)
+            The postsynaptic neuron of each synapse
+        weights: float32 array of shape (n_synapses,)
+            The conductance of each synapse (mS/cm^2)
+        delays: float32 array of shape (n_synapses,), or None
+            The transmission delay of each synapse (ms); None for gap junctions
+        N_post: int
+            The number of postsynaptic neurons
+    '''
+    indptr: np.ndarray
+    indices: np.ndarray
+    weights: np.ndarray
+    delays: np.ndarray
+    N_post: int
+
+    @classmethod
+    def FromEdges(cls, pre, post, weights, delays=None, N_pre=None, N_post=None):
+        '''
+        Builds a synapse matrix from unordered (pre, post) pairs
+
+        Inputs
+            pre, post: integer arrays of shape (n_synapses,)
+                The presynaptic and postsynaptic neuron of each synapse
+            weights: float or array of shape (n_synapses,)
+                The conductance of each synapse (mS/cm^2)
+            delays: float or array of shape (n_synapses,), optional
+                The delay of each synapse (ms)
+            N_pre, N_post: int, optional
+                The numbers of neurons; default to one more than the largest index
+        '''
+        pre = np.asarray(pre, dtype=np.int64)
+        post = np.asarray(post, dtype=np.int32)
+        N_pre = int(pre.max()) + 1 if N_pre is None else N_pre
+        N_post = int(post.max()) + 1 if N_post is None else N_post
+        order = np.argsort(pre, kind="stable")
+        indptr = np.zeros(N_pre + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pre, minlength=N_pre), out=indptr[1:])
+        weights = np.broadcast_to(np.asarray(weights, dtype=np.float32), pre.shape)[order]
+        if delays is not None:
+            delays = np.broadcast_to(np.asarray(delays, dtype=np.float32), pre.shape)[order]
+        return cls(indptr, post[order], weights, delays, N_post)
+
+    @property
+    def N_pre(self):
+        return len(self.indptr) - 1
+
+    @property
+    def n_synapses(self):
+        return len(self.indices)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.indptr, self.indices, self.weights, self.delays) if a is not None)
+
+    def Rows(self, neurons):
+        '''
+        The positions of the synapses of the given presynaptic neurons
+
+        Inputs
+            neurons: integer array
+                The presynaptic neurons
+
+        Outputs
+            An int64 array of positions into indices, weights, and delays
+        '''
+        starts = self.indptr[neurons]
+        lengths = self.indptr[np.asarray(neurons) + 1] - starts
+        total = lengths.sum()
+        if total == 0:
+            return np.empty(0, dtype=np.int64)
+        # The start of each row, shifted back by the entries before it, plus a running count
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return offsets + np.arange(total)
+
+    def Symmetrized(self):
+        '''
+        The matrix with every synapse also added in the reverse direction, for gap junctions
+        '''
+        pre = np.repeat(np.arange(self.N_pre), np.diff(self.indptr))
+        return SynapseMatrix.FromEdges(np.concatenate([pre, self.indices]), np.concatenate([self.indices, pre]),
+                                       np.concatenate([self.weights, self.weights]),
+                                       N_pre=max(self.N_pre, self.N_post), N_post=max(self.N_pre, self.N_post))
+
+
+def RandomSynapses(N_pre, N_post, k, weight, delay=None, seed=None, autapses=False):
+    '''
+    Connects every presynaptic neuron to k random postsynaptic neurons
+
+    The rows are generated directly in CSR order, without an edge list to sort.
+
+    Inputs
+        N_pre, N_post: int
+            The numbers of neurons
+        k: int
+            The number of outgoing synapses of each presynaptic neuron
+        weight: float or (float, float)
+            The conductance of every synapse (mS/cm^2), or the range it is drawn from uniformly
+        delay: float or (float, float), optional
+            The delay of every synapse (ms), or the range it is drawn from uniformly
+        seed: int, optional
+            The seed of the random number generator
+        autapses: bool
+            Whether a neuron may connect to itself (when N_pre == N_post)
+
+    Outputs
+        A SynapseMatrix
+    '''
+    rng = np.random.default_rng(seed)
+    n = N_pre * k
+
+    def Draw(value):
+        if value is None:
+            return None
+        if np.ndim(value):
+            return rng.uniform(value[0], value[1], n).astype(np.float32)
+        return np.full(n, value, dtype=np.float32)
+
+    if autapses or N_pre != N_post:
+        indices = rng.integers(0, N_post, n, dtype=np.int32)
+    else:
+        # Skip the neuron itself by drawing among the other N - 1
+        pre = np.repeat(np.arange(N_pre, dtype=np.int32), k)
+        indices = rng.integers(0, N_post - 1, n, dtype=np.int32)
+        indices += indices >= pre
+    indptr = np.arange(N_pre + 1, dtype=np.int64) * k
+    return SynapseMatrix(indptr, indices, Draw(weight), Draw(delay), N_post)
+
+
+@dataclass
+class SynapseType:
+    '''
+    A population of chemical synapses with a shared conductance time course
+
+    Inputs
+        name: str
+            e.g. "AMPA" or "GABA_A"
+        E: float
+            The reversal potential (mV)
+        tau: float
+            The decay time constant of the conductance (ms)
+        matrix: SynapseMatrix
+            The connectivity, weights, and delays
+    '''
+    name: str
+    E: float
+    tau: float
+    matrix: SynapseMatrix
+
+
+class Network:
+    '''
+    A population of point neurons coupled by chemical and electrical synapses
+
+    Inputs
+        population: ConductanceBasedPopulation (or any population with V, N, t, dtype,
+                    and a Step(dt, I_inj) method returning the neurons that spiked)
+            The neurons
+        synapses: list of SynapseType
+            The chemical synapses, each with its own conductance per neuron
+        gap_junctions: SynapseMatrix, optional
+            The electrical synapses; pass a symmetric matrix (see SynapseMatrix.Symmetrized)
+        dt: float
+            The step size (ms); delays are rounded to whole steps of at least one
+
+    Attributes
+        g: array of shape (n_types, N)
+            The conductance of each synapse type in each neuron (mS/cm^2)
+    '''
+
+    def __init__(self, population, synapses=(), gap_junctions=None, dt=0.025):
+        self.population = population
+        self.N = N = population.N
+        self.dt = dt
+        self.synapses = list(synapses)
+        dtype = population.dtype
+        for synapse in self.synapses:
+            # Presynaptic neurons beyond N are those of other partitions of a ParallelNetwork
+            if synapse.matrix.N_pre < N or synapse.matrix.N_post != N:
+                raise ValueError(f"Synapses {synapse.name!r} connect {synapse.matrix.N_pre} to "
+                                 f"{synapse.matrix.N_post} neurons, but the network has {N}")
+        self.E = np.array([[s.E] for s in self.synapses], dtype=dtype)
+        self.decay = np.array([np.exp(-dt / s.tau) for s in self.synapses], dtype=dtype).reshape(-1, 1)
+        self.g = np.zeros((len(self.synapses), N), dtype=dtype)
+
+        # Delays in whole steps, and a ring buffer of conductance increments with one slot per step
+        self._delay_steps = []
+        for synapse in self.synapses:
+            steps = np.maximum(np.rint(synapse.matrix.delays / dt), 1) if synapse.matrix.delays is not None \
+                else np.ones(synapse.matrix.n_synapses)
+            self._delay_steps.append(steps.astype(np.int32))
+        n_slots = 1 + max((int(steps.max()) for steps in self._delay_steps if len(steps)), default=1)
+        self._ring = np.zeros((n_slots, len(self.synapses), N), dtype=np.float32)
+        self._step = 0
+
+        # The membrane potentials the gap junction indices refer to
+        self.V_pre = population.V
+        self.gap_junctions = gap_junctions
+        if gap_junctions is not None:
+            matrix = gap_junctions
+            self._gap_rows = np.repeat(np.arange(matrix.N_pre, dtype=np.int32), np.diff(matrix.indptr))
+            self._gap_total = np.bincount(self._gap_rows, matrix.weights, minlength=N).astype(dtype)
+        self._I = np.empty(N, dtype=dtype)
+
+    @property
+    def t(self):
+        return self.population.t
+
+    def SynapticCurrent(self, out=None):
+        '''
+        Computes the total synaptic current into each neuron (uA/cm^2)
+        '''
+        V = self.population.V
+        I = np.zeros(self.N, dtype=V.dtype) if out is None else out
+        I.fill(0)
+        # One synapse type at a time, so every neuron's sum is taken in the same order
+        for g, E in zip(self.g, self.E):
+            I += g * (E - V)
+        if self.gap_junctions is not None:
+            matrix = self.gap_junctions
+            I += np.bincount(self._gap_rows, matrix.weights * self.V_pre[matrix.indices], minlength=self.N)
+            I -= self._gap_total * V
+        return I
+
+    def Deliver(self, neurons, steps):
+        '''
+        Schedules the conductance increments of the synapses of the neurons that spiked
+
+        A spike in step k arrives at the start of step k + 1 + delay. Increments
+        into the same neuron and slot are summed in the order of the spikes.
+
+        Inputs
+            neurons: integer array
+                The presynaptic neurons that spiked, ordered by step and then by neuron
+            steps: int or integer array like neurons
+                The step in which each neuron spiked
+        '''
+        if not len(neurons):
+            return
+        n_slots, n_types, N = self._ring.shape
+        ring = self._ring.reshape(-1)
+        for s, (synapse, delays) in enumerate(zip(self.synapses, self._delay_steps)):
+            rows = synapse.matrix.Rows(neurons)
+            if np.ndim(steps):
+                lengths = synapse.matrix.indptr[np.asarray(neurons) + 1] - synapse.matrix.indptr[neurons]
+                spike_steps = np.repeat(steps, lengths)
+            else:
+                spike_steps = steps
+            slots = (spike_steps + 1 + delays[rows]) % n_slots
+            np.add.at(ring, (slots * n_types + s) * N + synapse.matrix.indices[rows], synapse.matrix.weights[rows])
+
+    def Step(self, I_inj=0.0):
+        '''
+        Advances the network by one step of dt
+
+        The synaptic conductances decay, take up the increments arriving in this
+        step, and drive the neurons together with I_inj; the spikes of the step
+        are then delivered to the ring buffer.
+
+        Outputs
+            A boolean array marking the neurons that spiked during the step
+        '''
+        spiked = self.population.Step(self.dt, self.Input(I_inj))
+        self.Deliver(np.flatnonzero(spiked), self._step)
+        self._step += 1
+        return spiked
+
+    def Input(self, I_inj=0.0):
+        '''
+        Advances the synaptic conductances to the current step and returns the total input current
+
+        Outputs
+            The synaptic current plus I_inj (uA/cm^2), in a buffer reused by every step
+        '''
+        slot = self._step % self._ring.shape[0]
+        self.g *= self.decay
+        self.g += self._ring[slot]
+        self._ring[slot] = 0
+        I = self.SynapticCurrent(out=self._I)
+        I += I_inj
+        return I
+
+    def Run(self, t_stop, I_inj=0.0, record_every=0, recorder=None):
+        '''
+        Advances the network for t_stop milliseconds
+
+        Inputs
+            t_stop: float
+                The duration of the run (ms)
+            I_inj: float, array of shape (N,), or callable
+                The injected current density (uA/cm^2), or a function of time returning it
+            record_every: int
+                Record V every this many steps (0 records nothing)
+            recorder: TraceWriter, optional
+                Streams the chosen state variables of the population to disk after every step
+
+        Outputs
+            (spikes, trace): the SpikeTrains of the run, with times from the start of
+            the network, and the recorded voltages (or None)
+        '''
+        n_steps = int(round(t_stop / self.dt))
+        trace = None
+        if record_every:
+            trace = np.empty((n_steps // record_every + 1, self.N), dtype=self.population.dtype)
+            trace[0] = self.population.V
+        neurons, times = [], []
+        for k in range(1, n_steps + 1):
+            spiked = self.Step(I_inj(self.t) if callable(I_inj) else I_inj)
+            fired = np.flatnonzero(spiked)
+            if fired.size:
+                neurons.append(fired)
+                times.append(np.full(fired.size, self.t))
+            if record_every and k % record_every == 0:
+                trace[k // record_every] = self.population.V
+            if recorder is not None:
+                recorder.Record(self.population)
+        neurons = np.concatenate(neurons) if neurons else np.empty(0, dtype=np.int64)
+        times = np.concatenate(times) if times else np.empty(0)
+        return SpikeTrains.FromEvents(neurons, times, self.N), trace
@@ -0,0 +1,418 @@
+'''
+Domain-decomposed network runs on several cores
+
+A ParallelNetwork splits the neurons of a Network into contiguous partitions,
+one per worker process. Each worker owns the neurons of its partition and the
+synapses onto them (the part of every CSR row whose targets it owns), and
+advances them with an ordinary Network. The membrane potentials, the
+recorded traces, and the spikes exchanged between workers live in
+shared-memory arrays.
+
+A spike cannot reach any neuron sooner than the shortest synaptic delay, so
+the workers run that many steps independently, without locks, and exchange
+spikes once per such epoch: every worker publishes the spikes of its
+partition, waits on a barrier, and then delivers all the spikes of the epoch
+onto its own neurons, in the order of (step, neuron). A network without
+chemical synapses exchanges no spikes at all. Gap junctions have no delay, so
+a network with gap junctions also synchronizes twice per step around the
+voltage update.
+
+The exchange buffers are sized for every neuron firing at most once per
+refractory period. A worker with more spikes in an epoch spills the excess
+into a shared-memory block of its own, sized to fit, which the other workers
+read by name.
+
+Every neuron sees the same operations in the same order as in a single
+Network, so a run gives bit-for-bit the same spikes and voltages for any
+number of workers. Partition boundaries fall on multiples of align neurons,
+which keeps the blocks of the counter-based random streams of
+StochasticPopulation (see stochastic.py) intact when make_population passes
+first_neuron=start.
+'''
+import multiprocessing
+import os
+import traceback
+from dataclasses import replace
+from multiprocessing import shared_memory
+from queue import Empty
+from threading import BrokenBarrierError
+
+import numpy as np
+
+from neurodyn.hh import ConductanceBasedPopulation
+from neurodyn.network import SynapseMatrix, Network
+from neurodyn.spikes import SpikeTrains
+
+
+def DefaultPopulation(start, stop, dtype=np.float64):
+    '''
+    The population of a partition: Hodgkin-Huxley neurons start to stop - 1
+    '''
+    return ConductanceBasedPopulation(stop - start, dtype=dtype)
+
+
+def Partitions(N, n_workers, align=256):
+    '''
+    Splits N neurons into contiguous, nearly equal ranges starting on multiples of align
+
+    Outputs
+        A list of (start, stop), one per worker with at least one neuron
+    '''
+    n_blocks = -(-N // align)
+    edges = np.minimum(np.rint(np.linspace(0, n_blocks, n_workers + 1)).astype(int) * align, N)
+    return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
+def PartitionSynapses(matrix, start, stop):
+    '''
+    The synapses onto neurons start to stop - 1, with targets renumbered from 0
+
+    Every presynaptic row is kept, and the entries of each row stay in their original order.
+    '''
+    keep = (matrix.indices >= start) & (matrix.indices < stop)
+    pre = np.repeat(np.arange(matrix.N_pre, dtype=np.int32), np.diff(matrix.indptr))[keep]
+    indptr = np.zeros(matrix.N_pre + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pre, minlength=matrix.N_pre), out=indptr[1:])
+    delays = None if matrix.delays is None else matrix.delays[keep]
+    return SynapseMatrix(indptr, matrix.indices[keep] - np.int32(start), matrix.weights[keep], delays, stop - start)
+
+
+def PartitionRows(matrix, start, stop):
+    '''
+    The rows start to stop - 1 of a gap-junction matrix, whose indices stay global
+    '''
+    lo, hi = matrix.indptr[start], matrix.indptr[stop]
+    return SynapseMatrix(matrix.indptr[start:stop + 1] - lo, matrix.indices[lo:hi], matrix.weights[lo:hi],
+                         None, matrix.N_post)
+
+
+class _SharedArrays:
+    '''
+    Named arrays in shared-memory blocks, re-attached by name in the workers
+    '''
+
+    def __init__(self, specs):
+        self.specs = {name: (tuple(shape), np.dtype(dtype).str) for name, (shape, dtype) in specs.items()}
+        self._blocks = {}
+        self.names = {}
+        for name, (shape, dtype) in self.specs.items():
+            nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+            block = shared_memory.SharedMemory(create=True, size=nbytes)
+            self._blocks[name] = block
+            self.names[name] = block.name
+
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k != "_blocks"} | {"_blocks": {}}
+
+    def Array(self, name):
+        if name not in self._blocks:
+            self._blocks[name] = shared_memory.SharedMemory(name=self.names[name])
+        shape, dtype = self.specs[name]
+        return np.ndarray(shape, dtype, buffer=self._blocks[name].buf)
+
+    def Close(self, unlink=False):
+        for block in self._blocks.values():
+            block.close()
+            if unlink:
+                block.unlink()
+        self._blocks = {}
+
+
+def _Worker(rank, bounds, spec, shared, ready, barrier, commands, results):
+    '''
+    Worker process: owns one partition and runs it on command until told to stop
+    '''
+    start, stop = bounds[rank]
+    try:
+        pop = spec["make_population"](start, stop, spec["dtype"])
+        V = shared.Array("V")
+        V[start:stop] = pop.V
+        pop.V = V[start:stop]
+        synapses = [replace(s, matrix=PartitionSynapses(s.matrix, start, stop)) for s in spec["synapses"]]
+        gap = spec["gap_junctions"]
+        net = Network(pop, synapses, None if gap is None else PartitionRows(gap, start, stop), spec["dt"])
+        net.V_pre = V
+        exchange = spec["epoch"] is not None
+        if exchange:
+            spike_neuron, spike_step = shared.Array("spike_neuron"), shared.Array("spike_step")
+            spike_count = shared.Array("spike_count")
+            spill_count, spill_name = shared.Array("spill_count"), shared.Array("spill_name")
+            capacity = spike_neuron.shape[2]
+        # This worker's overflow block for each parity
+        spills = [None, None]
+        n_workers = len(bounds)
+        epoch = 0
+        ready.wait()
+    except Exception:
+        ready.abort()
+        results.put((rank, "error", traceback.format_exc()))
+        return
+
+    def Spill(parity, neurons, steps):
+        '''
+        Publishes the spikes that did not fit in the exchange buffers in a new shared block
+        '''
+        block = shared_memory.SharedMemory(create=True, size=16 * len(neurons))
+        spilled = np.ndarray((2, len(neurons)), np.int64, buffer=block.buf)
+        spilled[0], spilled[1] = neurons, steps
+        del spilled
+        spills[parity] = block
+        spill_name[parity, rank] = block.name.encode()
+        spill_count[parity, rank] = len(neurons)
+
+    def Spilled(parity, worker):
+        '''
+        A copy of the spikes another worker spilled, as (neurons, steps)
+        '''
+        block = shared_memory.SharedMemory(name=spill_name[parity, worker].decode())
+        spilled = np.array(np.ndarray((2, spill_count[parity, worker]), np.int64, buffer=block.buf))
+        block.close()
+        return spilled[0], spilled[1]
+
+    def FreeSpill(parity):
+        if spills[parity] is not None:
+            spills[parity].close()
+            spills[parity].unlink()
+            spills[parity] = None
+
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+        n_steps, I_inj, record_every, trace_store = command
+        try:
+            trace = None if trace_store is None else trace_store.Array("trace")
+            I_local = I_inj[start:stop] if np.ndim(I_inj) else I_inj
+            neurons, times = [], []
+            k = 0
+            while k < n_steps:
+                parity = epoch % 2
+                count = 0
+                extra_neurons, extra_steps = [], []
+                if exchange:
+                    # The other workers read this parity's spill two barriers ago
+                    FreeSpill(parity)
+                for _ in range(min(spec["epoch"], n_steps - k) if exchange else n_steps):
+                    I = net.Input(I_inj(net.t)[start:stop] if callable(I_inj) else I_local)
+                    if gap is not None:
+                        barrier.wait()
+                    spiked = pop.Step(spec["dt"], I)
+                    if gap is not None:
+                        barrier.wait()
+                    fired = np.flatnonzero(spiked)
+                    if fired.size:
+                        fired += start
+                        neurons.append(fired)
+                        times.append(np.full(fired.size, net.t))
+                    if fired.size and exchange:
+                        fit = min(fired.size, capacity - count)
+                        spike_neuron[parity, rank, count:count + fit] = fired[:fit]
+                        spike_step[parity, rank, count:count + fit] = net._step
+                        count += fit
+                        if fit < fired.size:
+                            extra_neurons.append(fired[fit:])
+                            extra_steps.append(np.full(fired.size - fit, net._step))
+                    net._step += 1
+                    k += 1
+                    if trace is not None and k % record_every == 0:
+                        trace[k // record_every, start:stop] = pop.V
+                if not exchange:
+                    continue
+                spike_count[parity, rank] = count
+                spill_count[parity, rank] = 0
+                if extra_neurons:
+                    Spill(parity, np.concatenate(extra_neurons), np.concatenate(extra_steps))
+                # Every worker has published the epoch's spikes; the other parity's buffers are free
+                barrier.wait()
+                all_neurons, all_steps = [], []
+                for w in range(n_workers):
+                    all_neurons.append(spike_neuron[parity, w, :spike_count[parity, w]])
+                    all_steps.append(spike_step[parity, w, :spike_count[parity, w]])
+                    if spill_count[parity, w]:
+                        spilled_neurons, spilled_steps = Spilled(parity, w)
+                        all_neurons.append(spilled_neurons)
+                        all_steps.append(spilled_steps)
+                all_neurons, all_steps = np.concatenate(all_neurons), np.concatenate(all_steps)
+                order = np.lexsort((all_neurons, all_steps))
+                net.Deliver(all_neurons[order], all_steps[order])
+                epoch += 1
+            if trace is not None:
+                del trace
+                trace_store.Close()
+            results.put((rank, np.concatenate(neurons) if neurons else np.empty(0, dtype=np.int64),
+                         np.concatenate(times) if times else np.empty(0), net.t))
+        except Exception:
+            barrier.abort()
+            results.put((rank, "error", traceback.format_exc()))
+            break
+    for parity in (0, 1):
+        FreeSpill(parity)
+
+
+class ParallelNetwork:
+    '''
+    A Network of N point neurons run by several worker processes
+
+    Inputs
+        N: int
+            The number of neurons
+        synapses: list of SynapseType
+            The chemical synapses, with delays (see network.py)
+        gap_junctions: SynapseMatrix, optional
+            The electrical synapses, a symmetric matrix
+        dt: float
+            The step size (ms)
+        make_population: callable, optional
+            make_population(start, stop, dtype) builds the population of neurons
+            start to stop - 1 in a worker; it must be picklable (a module-level
+            function or a functools.partial of one). Defaults to Hodgkin-Huxley neurons
+        n_workers: int, optional
+            The number of worker processes (defaults to the number of CPUs)
+        dtype: np.float32 or np.float64
+            The precision of the membrane potentials
+        align: int
+            Partition boundaries fall on multiples of this many neurons
+        epoch: int, optional
+            The number of steps between spike exchanges; defaults to, and may not
+            exceed, the shortest synaptic delay in steps
+        refractory: float
+            The shortest interval between two spikes of a neuron (ms) that the
+            exchange buffers are sized for; spikes beyond that are spilled
+
+    Attributes
+        epoch: int or None
+            The number of steps between spike exchanges, None without chemical synapses
+
+    Use as a context manager, or call Close when done, to stop the workers.
+    '''
+
+    def __init__(self, N, synapses=(), gap_junctions=None, dt=0.025, make_population=None, n_workers=None,
+                 dtype=np.float64, align=256, epoch=None, refractory=1.0):
+        self.N = N
+        self.dt = dt
+        self.t = 0.0
+        self.bounds = Partitions(N, n_workers or os.cpu_count(), align)
+        # As in Network, a synapse without delays delivers at the next step
+        delays = [np.maximum(np.rint(s.matrix.delays / dt), 1).min() if s.matrix.delays is not None else 1
+                  for s in synapses if s.matrix.n_synapses]
+        self.epoch = None
+        if delays:
+            if epoch is not None and epoch > min(delays):
+                raise ValueError(f"epoch must not exceed the shortest delay of {int(min(delays))} steps, got {epoch}")
+            self.epoch = int(epoch or min(delays))
+        n_workers = len(self.bounds)
+        specs = {"V": ((N,), dtype)}
+        if self.epoch is not None:
+            # At most one spike per neuron every refractory period
+            spikes_per_neuron = -(-self.epoch // max(int(refractory / dt), 1))
+            capacity = max(stop - start for start, stop in self.bounds) * spikes_per_neuron
+            specs.update({"spike_neuron": ((2, n_workers, capacity), np.int32),
+                          "spike_step": ((2, n_workers, capacity), np.int64),
+                          "spike_count": ((2, n_workers), np.int64),
+                          "spill_count": ((2, n_workers), np.int64),
+                          "spill_name": ((2, n_workers), "S32")})
+        self._shared = _SharedArrays(specs)
+        spec = {"make_population": make_population or DefaultPopulation, "dtype": dtype, "dt": dt,
+                "synapses": list(synapses), "gap_junctions": gap_junctions, "epoch": self.epoch}
+        context = multiprocessing.get_context()
+        ready = context.Barrier(n_workers + 1)
+        barrier = context.Barrier(n_workers)
+        self._results = context.Queue()
+        self._commands = [context.Queue() for _ in range(n_workers)]
+        self._workers = [context.Process(target=_Worker, daemon=True,
+                                         args=(rank, self.bounds, spec, self._shared, ready,
+                                               barrier,
+                                               self._commands[rank], self._results))
+                         for rank in range(n_workers)]
+        for worker in self._workers:
+            worker.start()
+        # Wait until the workers have built their partitions
+        try:
+            ready.wait()
+        except BrokenBarrierError:
+            self._Fail()
+
+    @property
+    def n_workers(self):
+        return len(self._workers)
+
+    @property
+    def V(self):
+        '''
+        A copy of the membrane potentials (mV)
+        '''
+        return np.array(self._shared.Array("V"))
+
+    def _Fail(self):
+        errors = []
+        try:
+            while True:
+                result = self._results.get(timeout=1.0)
+                if isinstance(result[1], str):
+                    errors.append(f"Worker {result[0]}:\n{result[2]}")
+        except Empty:
+            pass
+        self.Close()
+        raise RuntimeError("A network worker failed\n" + "\n".join(errors))
+
+    def Run(self, t_stop, I_inj=0.0, record_every=0):
+        '''
+        Advances the network for t_stop milliseconds
+
+        Inputs
+            t_stop: float
+                The duration of the run (ms)
+            I_inj: float, array of shape (N,), or callable
+                The injected current density (uA/cm^2), or a picklable function of
+                time returning an array of shape (N,)
+            record_every: int
+                Record V every this many steps (0 records nothing)
+
+        Outputs
+            (spikes, trace): as for Network.Run
+        '''
+        n_steps = int(round(t_stop / self.dt))
+        trace_store = None
+        if record_every:
+            trace_store = _SharedArrays({"trace": ((n_steps // record_every + 1, self.N),
+                                                   self._shared.specs["V"][1])})
+            trace_store.Array("trace")[0] = self._shared.Array("V")
+        try:
+            for commands in self._commands:
+                commands.put((n_steps, I_inj, record_every, trace_store))
+            neurons, times = [], []
+            for _ in self._workers:
+                result = self._results.get()
+                if isinstance(result[1], str):
+                    self._results.put(result)
+                    self._Fail()
+                neurons.append(result[1])
+                times.append(result[2])
+                self.t = result[3]
+            trace = None if trace_store is None else np.array(trace_store.Array("trace"))
+        finally:
+            if trace_store is not None:
+                trace_store.Close(unlink=True)
+        return SpikeTrains.FromEvents(np.concatenate(neurons), np.concatenate(times), self.N), trace
+
+    def Close(self):
+        '''
+        Stops the workers and frees the shared memory
+        '''
+        for commands, worker in zip(self._commands, self._workers):
+            if worker.is_alive():
+                commands.put(None)
+        for worker in self._workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+        if self._shared is not None:
+            self._shared.Close(unlink=True)
+            self._shared = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
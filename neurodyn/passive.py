@@ -0,0 +1,159 @@
+'''
+The passive (RC circuit) point neuron of Chapter 5
+
+    C_m dV/dt = -g_L (V - E_L) + I_inj
+
+For a constant injected current the membrane potential relaxes exponentially
+towards V_inf = E_L + I_inj/g_L with time constant tau = C_m/g_L, so a
+piecewise-constant current protocol can be integrated exactly, one segment at
+a time, for any number of neurons at once.
+
+Units follow the rest of the book: mV, ms, uF/cm^2, mS/cm^2, and uA/cm^2.
+'''
+import numpy as np
+
+
+def PassiveTimeConstant(C_m, g_L):
+    '''
+    Computes the membrane time constant tau = C_m/g_L in milliseconds (ms)
+    '''
+    return np.asarray(C_m) / np.asarray(g_L)
+
+
+def PassiveStep(V, I_inj, dt, C_m=1.0, g_L=0.1, E_L=-65.0, out=None):
+    '''
+    Advances the passive neuron exactly by dt under a constant injected current
+
+    Inputs
+        V: array
+            The membrane potentials (mV) of the neurons
+        I_inj: float or array
+            The injected current density (uA/cm^2), held constant over the step
+        dt: float
+            The step size (ms)
+        C_m, g_L, E_L: float or array
+            The membrane capacitance (uF/cm^2), leak conductance (mS/cm^2),
+            and leak reversal potential (mV) of each neuron
+        out: array, optional
+            A preallocated buffer for the result, which may be V itself
+
+    Outputs
+        The membrane potentials after the step (mV)
+    '''
+    V_inf = E_L + np.asarray(I_inj) / g_L
+    decay = np.exp(-dt / PassiveTimeConstant(C_m, g_L))
+    # V_inf + (V - V_inf) exp(-dt/tau)
+    out = np.subtract(V, V_inf, out=out)
+    np.multiply(out, decay, out=out)
+    return np.add(out, V_inf, out=out)
+
+
+def PassiveTrace(I_inj, dt, C_m=1.0, g_L=0.1, E_L=-65.0, V0=None, out=None, dtype=np.float64):
+    '''
+    Integrates a population of passive neurons driven by sampled injected currents
+
+    The current is held constant between samples, so each step is exact. The
+    decay factor is computed once, leaving one fused multiply-add per sample for
+    the whole population.
+
+    Inputs
+        I_inj: array of shape (n_samples, N) or (n_samples,)
+            The injected current density (uA/cm^2) during each step
+        dt: float
+            The sampling interval (ms)
+        C_m, g_L, E_L: float or array of shape (N,)
+            The passive parameters of each neuron
+        V0: float or array of shape (N,), optional
+            The initial membrane potentials (mV); defaults to E_L. Passing the last
+            row of a previous call continues a trace chunk by chunk
+        out: array of shape (n_samples + 1, N), optional
+            A preallocated buffer for the voltage trace
+        dtype: np.float32 or np.float64
+            The floating point precision of the trace
+
+    Outputs
+        The voltage trace (mV), with the initial condition in the first row
+    '''
+    I_inj = np.asarray(I_inj, dtype=dtype)
+    N = np.broadcast_shapes(I_inj.shape[1:], np.shape(C_m), np.shape(g_L), np.shape(E_L), np.shape(V0))
+    out = _TraceBuffer(out, (I_inj.shape[0] + 1,) + N, dtype)
+    I_inj = _PerSample(I_inj, N)
+
+    tau = PassiveTimeConstant(C_m, g_L)
+    decay = np.broadcast_to(np.exp(-dt / tau), N).astype(dtype)
+    out[0] = E_L if V0 is None else V0
+    # V_{k+1} = V_inf,k + (V_k - V_inf,k) a = a V_k + (1 - a) (E_L + I_k/g_L)
+    drive = (1 - decay) * (E_L + I_inj / np.asarray(g_L, dtype=dtype))
+    for k in range(I_inj.shape[0]):
+        np.multiply(out[k], decay, out=out[k + 1])
+        out[k + 1] += drive[k]
+    return out
+
+
+def PassiveStepResponse(I_steps, durations, dt, C_m=1.0, g_L=0.1, E_L=-65.0, V0=None, out=None, dtype=np.float64):
+    '''
+    Computes the voltage traces of a population of passive neurons under a current-step protocol
+
+    Within each constant-current segment the trace is written in closed form,
+    V(t) = V_inf + (V_start - V_inf) exp(-t/tau), as one array operation over
+    every sample of the segment and every neuron, so the only Python loop is
+    over the (few) segments of the protocol.
+
+    Inputs
+        I_steps: array of shape (n_segments, N) or (n_segments,)
+            The injected current density (uA/cm^2) of each segment
+        durations: array of shape (n_segments,)
+            The duration (ms) of each segment, rounded to a whole number of samples
+        dt: float
+            The sampling interval (ms) of the returned traces
+        C_m, g_L, E_L: float or array of shape (N,)
+            The passive parameters of each neuron
+        V0: float or array of shape (N,), optional
+            The initial membrane potentials (mV); defaults to E_L
+        out: array of shape (n_samples + 1, N), optional
+            A preallocated buffer for the voltage traces
+        dtype: np.float32 or np.float64
+            The floating point precision of the traces
+
+    Outputs
+        The voltage traces (mV), with the initial condition in the first row
+    '''
+    I_steps = np.asarray(I_steps, dtype=dtype)
+    n_samples = np.rint(np.asarray(durations) / dt).astype(int)
+    N = np.broadcast_shapes(I_steps.shape[1:], np.shape(C_m), np.shape(g_L), np.shape(E_L), np.shape(V0))
+    out = _TraceBuffer(out, (n_samples.sum() + 1,) + N, dtype)
+    I_steps = _PerSample(I_steps, N)
+
+    rate = np.broadcast_to(-1 / PassiveTimeConstant(C_m, g_L), N).astype(dtype)
+    V_inf = np.broadcast_to(E_L + I_steps / np.asarray(g_L, dtype=dtype), (len(n_samples),) + N)
+    out[0] = E_L if V0 is None else V0
+    start = 0
+    for k, n in enumerate(n_samples):
+        segment = out[start + 1:start + n + 1]
+        # exp(-t/tau) for every sample of the segment and every neuron, written in place
+        t = (np.arange(1, n + 1, dtype=dtype) * np.dtype(dtype).type(dt)).reshape((n,) + (1,)*len(N))
+        np.multiply(t, rate, out=segment)
+        np.exp(segment, out=segment)
+        segment *= out[start] - V_inf[k]
+        segment += V_inf[k]
+        start += n
+    return out
+
+
+def _TraceBuffer(out, shape, dtype):
+    '''
+    Allocates a trace buffer, or checks that a preallocated one fits
+    '''
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if out.shape != shape or out.dtype != np.dtype(dtype):
+        raise ValueError(f"out must have shape {shape} and dtype {np.dtype(dtype)}, "
+                         f"got {out.shape} and {out.dtype}")
+    return out
+
+
+def _PerSample(x, N):
+    '''
+    Reshapes a (n_samples, ...) array so that its trailing axes broadcast against the population shape N
+    '''
+    return x.reshape(x.shape[:1] + (1,)*(len(N) - x.ndim + 1) + x.shape[1:])
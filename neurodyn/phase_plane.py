@@ -0,0 +1,299 @@
+'''
+Phase portraits of two-dimensional models (Chapters 4 and 5)
+
+A phase portrait shows the vector field of a planar model, its nullclines
+(the curves where one of the two derivatives vanishes), and its fixed points
+(where the nullclines cross). ComputePhasePortrait evaluates the vector field
+on a whole grid in a single vectorized call, extracts both nullclines from the
+grid by marching squares, and refines every candidate fixed point with
+Newton's method before classifying it from its Jacobian. The results are
+flat arrays ready for Bokeh's line, segment, and scatter glyphs.
+
+ReducedModel builds a planar model out of a conductance-based one, e.g. the
+V-n reduction of the Hodgkin-Huxley model, where m is instantaneous and h is
+tied to n.
+'''
+from dataclasses import dataclass
+
+import numpy as np
+
+from neurodyn.hh import T_squid, ConductanceBasedPopulation
+
+# The approximately linear relation h = 0.89 - 1.1 n between the HH gates during a spike
+HH_H_OF_N = (0.89, -1.1)
+
+
+def ReducedModel(currents=None, C_m=1.0, T=T_squid, I_inj=0.0, slow="n", instantaneous=("m",), tied=None):
+    '''
+    The planar (V, x) reduction of a conductance-based model
+
+    Inputs
+        currents: list of Current
+            The model's currents (defaults to HH_CURRENTS)
+        C_m: float
+            The membrane capacitance (uF/cm^2)
+        T: float
+            The temperature in Kelvin
+        I_inj: float
+            The injected current density (uA/cm^2)
+        slow: str
+            The gate kept as the second state variable
+        instantaneous: tuple of str
+            Gates replaced by their steady state x_inf(V)
+        tied: dict of name -> (a, b)
+            Gates replaced by a + b * slow, clipped to [0, 1]; defaults to
+            h = 0.89 - 1.1 n for the Hodgkin-Huxley currents
+
+    Outputs
+        f(y): y has V and the slow gate along its first axis
+    '''
+    pop = ConductanceBasedPopulation(1, currents, C_m, T)
+    if tied is None:
+        tied = {"h": HH_H_OF_N} if currents is None else {}
+    names = pop.gate_names
+    for name in names:
+        if name != slow and name not in instantaneous and name not in tied:
+            raise ValueError(f"Gate {name!r} must be the slow variable, instantaneous, or tied to {slow!r}")
+    i_slow = names.index(slow)
+
+    def f(y):
+        V, x = np.asarray(y[0], dtype=float), np.asarray(y[1], dtype=float)
+        full = np.empty((1 + len(names),) + V.shape)
+        full[0] = V
+        for i, (name, gate) in enumerate(zip(names, pop.kinetics)):
+            if name == slow:
+                full[1 + i] = x
+            elif name in tied:
+                a, b = tied[name]
+                full[1 + i] = np.clip(a + b * x, 0, 1)
+            else:
+                full[1 + i] = gate.SteadyState(V, T)[0]
+        dy = pop.Derivatives(full, I_inj, np.zeros(V.shape, dtype=np.intp))
+        return np.stack([dy[0], dy[1 + i_slow]])
+
+    f.population = pop
+    return f
+
+
+# Marching squares: for each of the 16 sign patterns of a cell's corners
+# (bit 0 bottom-left, 1 bottom-right, 2 top-right, 3 top-left), the pairs of
+# crossed edges (0 bottom, 1 right, 2 top, 3 left) to join. The ambiguous
+# saddle patterns 5 and 10 are listed for a negative cell center; the pairs
+# are swapped when the center is positive.
+_EDGE_PAIRS = {1: [(3, 0)], 2: [(0, 1)], 3: [(3, 1)], 4: [(1, 2)], 5: [(3, 0), (1, 2)], 6: [(0, 2)],
+               7: [(3, 2)], 8: [(2, 3)], 9: [(2, 0)], 10: [(0, 1), (2, 3)], 11: [(2, 1)], 12: [(1, 3)],
+               13: [(1, 0)], 14: [(0, 3)]}
+_SADDLE_SWAP = {5: [(3, 2), (0, 1)], 10: [(0, 3), (1, 2)]}
+
+
+def MarchingSquares(x, y, values):
+    '''
+    Extracts the zero contour of a field sampled on a rectilinear grid
+
+    Inputs
+        x: array of shape (n_x,)
+        y: array of shape (n_y,)
+        values: array of shape (n_y, n_x)
+            The field, with rows along y
+
+    Outputs
+        An array of shape (n_segments, 2, 2) holding the (x, y) end points of each contour segment
+    '''
+    v = np.asarray(values, dtype=float)
+    above = v > 0
+    a, b, c, d = above[:-1, :-1], above[:-1, 1:], above[1:, 1:], above[1:, :-1]
+    case = a * 1 + b * 2 + c * 4 + d * 8
+
+    X0, Y0 = x[np.newaxis, :-1], y[:-1, np.newaxis]
+    X1, Y1 = x[np.newaxis, 1:], y[1:, np.newaxis]
+    v00, v01, v11, v10 = v[:-1, :-1], v[:-1, 1:], v[1:, 1:], v[1:, :-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Linearly interpolated crossing along each edge of every cell
+        t_bottom, t_right = v00 / (v00 - v01), v01 / (v01 - v11)
+        t_top, t_left = v10 / (v10 - v11), v00 / (v00 - v10)
+    edges = [(X0 + t_bottom * (X1 - X0), np.broadcast_to(Y0, case.shape)),
+             (np.broadcast_to(X1, case.shape), Y0 + t_right * (Y1 - Y0)),
+             (X0 + t_top * (X1 - X0), np.broadcast_to(Y1, case.shape)),
+             (np.broadcast_to(X0, case.shape), Y0 + t_left * (Y1 - Y0))]
+
+    center_above = (v00 + v01 + v11 + v10) > 0
+    segments = []
+    for pattern, pairs in _EDGE_PAIRS.items():
+        cells = case == pattern
+        if pattern in _SADDLE_SWAP:
+            swapped = cells & center_above
+            cells = cells & ~center_above
+            for e0, e1 in _SADDLE_SWAP[pattern]:
+                segments.append(_Segments(edges, swapped, e0, e1))
+        for e0, e1 in pairs:
+            segments.append(_Segments(edges, cells, e0, e1))
+    return np.concatenate(segments)
+
+
+def _Segments(edges, cells, e0, e1):
+    (x0, y0), (x1, y1) = edges[e0], edges[e1]
+    return np.stack([np.stack([x0[cells], y0[cells]], axis=-1), np.stack([x1[cells], y1[cells]], axis=-1)], axis=1)
+
+
+def SegmentsToLine(segments):
+    '''
+    Flattens contour segments into x and y arrays separated by NaN, for a single Bokeh line glyph
+    '''
+    n = len(segments)
+    xs, ys = np.full(3 * n, np.nan), np.full(3 * n, np.nan)
+    xs[0::3], xs[1::3] = segments[:, 0, 0], segments[:, 1, 0]
+    ys[0::3], ys[1::3] = segments[:, 0, 1], segments[:, 1, 1]
+    return xs, ys
+
+
+def _Jacobian2(f, x, y, eps=1e-6):
+    '''
+    Forward-difference Jacobians of a planar vector field at many points in one call of f
+
+    Outputs
+        (J, f0): arrays of shape (n, 2, 2) and (2, n)
+    '''
+    h_x, h_y = eps * np.maximum(np.abs(x), 1.0), eps * np.maximum(np.abs(y), 1.0)
+    F = f(np.stack([np.concatenate([x, x + h_x, x]), np.concatenate([y, y, y + h_y])]))
+    f0, f_x, f_y = np.split(F, 3, axis=1)
+    J = np.stack([(f_x - f0) / h_x, (f_y - f0) / h_y], axis=-1).transpose(1, 0, 2)
+    return J, f0
+
+
+# Fixed-point classes from the Jacobian's trace and determinant
+FIXED_POINT_TYPES = ("saddle", "stable node", "unstable node", "stable focus", "unstable focus", "center")
+
+
+def FixedPoints(f, x, y, dx, dy, tol=1e-10, max_iter=30):
+    '''
+    Finds and classifies the fixed points of a planar vector field sampled on a grid
+
+    Cells crossed by both nullclines are candidates; every candidate is refined by
+    Newton's method (all of them at once). Candidates that leave the grid or do
+    not converge are dropped, and the others are merged when they fall within one
+    grid cell of each other.
+
+    Inputs
+        f: callable f(y)
+            The vector field, with the two state variables along the first axis
+        x, y: arrays of shape (n_x,) and (n_y,)
+            The grid axes
+        dx, dy: arrays of shape (n_y, n_x)
+            The vector field sampled on the grid
+        tol: float
+            The Newton step that ends the iterations, and the largest |f| at a fixed point
+        max_iter: int
+            The largest number of Newton iterations
+
+    Outputs
+        (points, eigenvalues, types): arrays of shape (k, 2), (k, 2), and (k,), where
+        types indexes FIXED_POINT_TYPES
+    '''
+    def Crossed(v):
+        s = v > 0
+        corners = s[:-1, :-1].astype(int) + s[:-1, 1:] + s[1:, 1:] + s[1:, :-1]
+        return (corners > 0) & (corners < 4)
+
+    j, i = np.nonzero(Crossed(dx) & Crossed(dy))
+    px, py = (x[i] + x[i + 1]) / 2, (y[j] + y[j + 1]) / 2
+    for _ in range(max_iter):
+        J, f0 = _Jacobian2(f, px, py)
+        det = J[:, 0, 0] * J[:, 1, 1] - J[:, 0, 1] * J[:, 1, 0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            step_x = (J[:, 1, 1] * f0[0] - J[:, 0, 1] * f0[1]) / det
+            step_y = (J[:, 0, 0] * f0[1] - J[:, 1, 0] * f0[0]) / det
+        px, py = px - step_x, py - step_y
+        if np.all(~np.isfinite(step_x) | (np.abs(step_x) + np.abs(step_y) < tol)):
+            break
+
+    cell = np.array([x[1] - x[0], y[1] - y[0]])
+    with np.errstate(invalid="ignore"):
+        residual = np.hypot(*f(np.stack([px, py])))
+    keep = np.isfinite(px) & np.isfinite(py) & (residual <= tol)
+    keep &= (px >= x[0]) & (px <= x[-1]) & (py >= y[0]) & (py <= y[-1])
+    points = []
+    for p in np.stack([px[keep], py[keep]], axis=1):
+        if all(np.any(np.abs(p - q) > np.abs(cell)) for q in points):
+            points.append(p)
+    points = np.array(points).reshape(-1, 2)
+
+    J, _ = _Jacobian2(f, points[:, 0], points[:, 1])
+    eigenvalues = np.linalg.eigvals(J)
+    tr = J[:, 0, 0] + J[:, 1, 1]
+    det = J[:, 0, 0] * J[:, 1, 1] - J[:, 0, 1] * J[:, 1, 0]
+    focus = tr**2 < 4 * det
+    types = np.where(det < 0, 0,
+                     np.where(np.isclose(tr, 0) & focus, 5,
+                              np.where(focus, 3, 1) + (tr > 0))).astype(np.int8)
+    return points, eigenvalues, types
+
+
+@dataclass
+class PhasePortrait:
+    '''
+    The vector field, nullclines, and fixed points of a planar model
+
+    Attributes
+        x, y: arrays of shape (n_x,) and (n_y,)
+            The grid axes
+        dx, dy: arrays of shape (n_y, n_x)
+            The vector field on the grid, rows along y (the layout of Bokeh's image glyph)
+        x_nullcline, y_nullcline: arrays of shape (n_segments, 2, 2)
+            The segments of the curves dx/dt = 0 and dy/dt = 0
+        fixed_points, eigenvalues, types:
+            See FixedPoints
+    '''
+    x: np.ndarray
+    y: np.ndarray
+    dx: np.ndarray
+    dy: np.ndarray
+    x_nullcline: np.ndarray
+    y_nullcline: np.ndarray
+    fixed_points: np.ndarray
+    eigenvalues: np.ndarray
+    types: np.ndarray
+
+    def Arrows(self, n=20, length=0.04):
+        '''
+        A coarse field of direction arrows for a Bokeh segment glyph
+
+        The arrows are subsampled to about n per axis, and each one points along the
+        flow with a length that is a fixed fraction of the plot size, since dx/dt and
+        dy/dt usually have very different units.
+
+        Outputs
+            (x0, y0, x1, y1): flat arrays of arrow start and end points
+        '''
+        sj = slice(None, None, max(len(self.y) // n, 1))
+        si = slice(None, None, max(len(self.x) // n, 1))
+        X, Y = np.meshgrid(self.x[si], self.y[sj])
+        span_x, span_y = self.x[-1] - self.x[0], self.y[-1] - self.y[0]
+        u, v = self.dx[sj, si] / span_x, self.dy[sj, si] / span_y
+        norm = np.hypot(u, v)
+        norm[norm == 0] = 1
+        return (X.ravel(), Y.ravel(), (X + length * span_x * u / norm).ravel(),
+                (Y + length * span_y * v / norm).ravel())
+
+
+def ComputePhasePortrait(f, x_range, y_range, shape=(500, 500)):
+    '''
+    Evaluates a planar vector field on a grid and extracts its nullclines and fixed points
+
+    Inputs
+        f: callable f(y)
+            The vector field, with the two state variables along the first axis
+        x_range, y_range: (float, float)
+            The extent of the grid along each state variable
+        shape: (int, int)
+            The number of grid points along x and y
+
+    Outputs
+        A PhasePortrait
+    '''
+    x = np.linspace(*x_range, shape[0])
+    y = np.linspace(*y_range, shape[1])
+    X, Y = np.meshgrid(x, y)
+    dx, dy = f(np.stack([X, Y]))
+    points, eigenvalues, types = FixedPoints(f, x, y, dx, dy)
+    return PhasePortrait(x, y, dx, dy, MarchingSquares(x, y, dx), MarchingSquares(x, y, dy),
+                         points, eigenvalues, types)
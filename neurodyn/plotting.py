@@ -0,0 +1,347 @@
+'''
+Bokeh plotting of long simulation traces
+
+A 10-second trace at dt = 0.01 ms has a million samples per line, far more than
+a figure has pixels. Instead of sending every sample to the browser, each line
+is decimated to a few points per pixel column:
+
+    M4    keeps the first, last, minimum, and maximum sample of each pixel
+          column, which draws exactly the same line as the full trace at the
+          figure's resolution
+    LTTB  (largest triangle three buckets) keeps one sample per bucket, chosen
+          to preserve the visual shape; fewer points, but not pixel exact
+
+The amount of data sent therefore depends on the width of the figure, not on
+the length of the simulation. When the figure is served by a Bokeh server (or
+a notebook with a live kernel), zooming or panning triggers a range callback
+that re-decimates the visible window from the full-resolution trace, so detail
+appears as you zoom in. A static page, like the built book, gets the decimated
+overview only.
+
+Show replaces bokeh.io.show for figures embedded in the book. Numeric columns
+are sent as binary (base64) arrays, and arrays of at least SHARED_BYTES are
+stored once per page, or once for the whole book as content-addressed
+sidecar files (see _ext/bokeh_payloads.py) that are fetched when the figure
+scrolls into view.
+'''
+import base64
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+from bokeh.embed import json_item
+from bokeh.io import curdoc
+from bokeh.models import ColumnDataSource
+from bokeh.palettes import Colorblind
+from bokeh.plotting import figure
+
+
+def M4(t, y, n_bins, start=0, stop=None):
+    '''
+    Decimates y[start:stop] to the first, last, minimum, and maximum sample of n_bins bins
+
+    Inputs
+        t, y: arrays of shape (n,)
+            The sample times and values
+        n_bins: int
+            The number of bins, usually the width of the figure in pixels
+        start, stop: int
+            The index range to decimate
+
+    Outputs
+        (t, y) of the kept samples, in time order (at most 4 * n_bins of them)
+    '''
+    stop = len(y) if stop is None else stop
+    n = stop - start
+    if n <= 4 * n_bins:
+        return t[start:stop], y[start:stop]
+    k = -(-n // n_bins)
+    n_bins = -(-n // k)
+    # Padding with the last sample changes neither the minimum nor the maximum of the last bin
+    segment = y[start:stop]
+    if n_bins * k > n:
+        segment = np.concatenate([segment, np.full(n_bins * k - n, segment[-1])])
+    bins = segment.reshape(n_bins, k)
+    first = np.arange(n_bins) * k
+    index = np.stack([first,
+                      first + np.argmin(bins, axis=1),
+                      first + np.argmax(bins, axis=1),
+                      np.minimum(first + k - 1, n - 1)], axis=1)
+    index = np.unique(np.minimum(index, n - 1)) + start
+    return t[index], y[index]
+
+
+def LTTB(t, y, n_out, start=0, stop=None):
+    '''
+    Decimates y[start:stop] to n_out samples by the largest-triangle-three-buckets algorithm
+
+    The first and last samples are kept; every bucket in between keeps the sample
+    forming the largest triangle with the sample kept in the previous bucket and
+    the average of the next bucket.
+
+    Outputs
+        (t, y) of the kept samples, in time order
+    '''
+    stop = len(y) if stop is None else stop
+    n = stop - start
+    if n <= n_out or n_out < 3:
+        return t[start:stop], y[start:stop]
+    edges = start + 1 + np.linspace(0, n - 2, n_out - 1).astype(np.int64)
+    # Averages of every bucket, for the third corner of the triangles
+    sums_t = np.add.reduceat(t[start + 1:stop - 1], edges[:-1] - start - 1)
+    sums_y = np.add.reduceat(y[start + 1:stop - 1], edges[:-1] - start - 1)
+    counts = np.diff(edges)
+    mean_t = np.append(sums_t / counts, t[stop - 1])
+    mean_y = np.append(sums_y / counts, y[stop - 1])
+
+    index = np.empty(n_out, dtype=np.int64)
+    index[0], index[-1] = start, stop - 1
+    for b in range(n_out - 2):
+        a = index[b]
+        lo, hi = edges[b], edges[b + 1]
+        area = np.abs((t[a] - mean_t[b + 1]) * (y[lo:hi] - y[a]) - (t[a] - t[lo:hi]) * (mean_y[b + 1] - y[a]))
+        index[b + 1] = lo + np.argmax(area)
+    return t[index], y[index]
+
+
+DECIMATORS = {"m4": M4, "lttb": LTTB}
+
+
+class DecimatedTrace:
+    '''
+    A long trace shown at the resolution of the figure it is drawn in
+
+    Inputs
+        t, y: arrays of shape (n,)
+            The sample times (sorted) and values at full resolution
+        n_pixels: int
+            The width of the plotting area in pixels
+        method: "m4" or "lttb"
+            The decimation algorithm
+
+    Attributes
+        source: ColumnDataSource
+            The decimated data, with columns "t" and "y"
+    '''
+
+    def __init__(self, t, y, n_pixels=700, method="m4"):
+        self.t = np.asarray(t)
+        self.y = np.asarray(y)
+        self.n_pixels = n_pixels
+        self.method = method
+        self.source = ColumnDataSource(self.Data())
+
+    def Data(self, t_start=None, t_end=None):
+        '''
+        Decimates the part of the trace between t_start and t_end (defaults to all of it)
+
+        One sample on each side of the window is included so that the line runs to the edges of the figure.
+
+        Outputs
+            A dict with the columns "t" and "y"
+        '''
+        start = 0 if t_start is None else max(np.searchsorted(self.t, t_start) - 1, 0)
+        stop = len(self.t) if t_end is None else min(np.searchsorted(self.t, t_end) + 1, len(self.t))
+        if self.method == "m4":
+            t, y = M4(self.t, self.y, self.n_pixels, start, stop)
+        else:
+            t, y = LTTB(self.t, self.y, 4 * self.n_pixels, start, stop)
+        return {"t": t, "y": y}
+
+    def AddTo(self, fig, live=None, **line_options):
+        '''
+        Draws the trace as a line in a Bokeh figure
+
+        Inputs
+            fig: figure
+            live: bool, optional
+                Re-decimate on zoom and pan through Python range callbacks; these
+                only run in a Bokeh server or a notebook with a live kernel, which
+                is detected automatically when live is None
+            line_options:
+                Passed on to fig.line
+
+        Outputs
+            The line's glyph renderer
+        '''
+        renderer = fig.line("t", "y", source=self.source, **line_options)
+        if live is None:
+            live = curdoc().session_context is not None
+        if live:
+            def Update(attr, old, new):
+                self.source.data = self.Data(fig.x_range.start, fig.x_range.end)
+            fig.x_range.on_change("start", Update)
+            fig.x_range.on_change("end", Update)
+        return renderer
+
+
+def PlotTraces(t, V, labels=None, width=700, height=400, method="m4", live=None):
+    '''
+    Plots one or more long voltage traces with per-pixel decimation
+
+    Inputs
+        t: array of shape (n,)
+            The sample times (ms)
+        V: array of shape (n,) or (n, k)
+            The membrane potential (mV) of k traces
+        labels: list of str, optional
+            The legend label of each trace
+        width, height: int
+            The size of the figure in pixels
+        method: "m4" or "lttb"
+            The decimation algorithm
+        live: bool, optional
+            See DecimatedTrace.AddTo
+
+    Outputs
+        (fig, traces): the Bokeh figure and the list of DecimatedTrace objects
+    '''
+    V = np.asarray(V)
+    V = V[:, np.newaxis] if V.ndim == 1 else V
+    fig = figure(width=width,
+                 height=height,
+                 x_range=(t[0], t[-1]),
+                 background_fill_color="#fffff1")
+    traces = []
+    for j, color in zip(range(V.shape[1]), Colorblind[8] * (V.shape[1] // 8 + 1)):
+        trace = DecimatedTrace(t, V[:, j], width, method)
+        options = {} if labels is None else {"legend_label": labels[j]}
+        trace.AddTo(fig, live=live, line_width=2, color=color, **options)
+        traces.append(trace)
+    fig.xaxis.axis_label = r"$$\textsf{Time (ms)}$$"
+    fig.yaxis.axis_label = r"$$\textsf{Membrane Potential (mV)}$$"
+    return fig, traces
+
+
+# Arrays at least this large (base64 characters) are stored once and shared between figures
+SHARED_BYTES = 1024
+# Set by the book build to write shared arrays to sidecar files instead of inlining them
+SIDECAR_DIR_VARIABLE = "NEURODYN_BOKEH_SIDECARS"
+SIDECAR_URL_VARIABLE = "NEURODYN_BOKEH_URL"
+
+# The shared arrays already inlined into this kernel's outputs, by hash
+_inlined = set()
+
+_LOADER = """
+<div id="%(target)s"></div>
+<script type="text/javascript">
+(function() {
+  var arrays = window.neurodynArrays = window.neurodynArrays || {};
+  Object.assign(arrays, %(inline)s);
+  var item = %(item)s, refs = %(refs)s, url = %(url)s;
+  function toBase64(buffer) {
+    var bytes = new Uint8Array(buffer), s = "";
+    for (var i = 0; i < bytes.length; i += 0x8000) {
+      s += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+    }
+    return btoa(s);
+  }
+  function fill(node) {
+    if (Array.isArray(node)) { node.forEach(fill); return; }
+    if (node === null || typeof node !== "object") { return; }
+    for (var key in node) {
+      var value = node[key];
+      if (value !== null && typeof value === "object" && "$shared" in value) {
+        node[key] = {type: "bytes", data: arrays[value["$shared"]]};
+      } else {
+        fill(value);
+      }
+    }
+  }
+  function load() {
+    return Promise.all(refs.filter(function(h) { return !(h in arrays); }).map(function(h) {
+      return fetch(url + h + ".bin").then(function(r) { return r.arrayBuffer(); })
+        .then(function(buffer) { arrays[h] = toBase64(buffer); });
+    }));
+  }
+  function embed() {
+    if (!window.Bokeh) { setTimeout(embed, 50); return; }
+    load().then(function() { fill(item.doc); Bokeh.embed.embed_item(item, "%(target)s"); });
+  }
+  var el = document.getElementById("%(target)s");
+  if ("IntersectionObserver" in window) {
+    new IntersectionObserver(function(entries, observer) {
+      if (entries.some(function(e) { return e.isIntersecting; })) { observer.disconnect(); embed(); }
+    }, {rootMargin: "400px"}).observe(el);
+  } else {
+    embed();
+  }
+})();
+</script>
+"""
+
+
+def _BinaryColumns(fig):
+    '''
+    Converts numeric list columns of the figure's data sources to arrays, which Bokeh sends as binary
+    '''
+    for source in fig.select(type=ColumnDataSource):
+        for name, values in list(source.data.items()):
+            if isinstance(values, (list, tuple)) and len(values) and all(
+                    isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+                source.data[name] = np.asarray(values, dtype=float)
+
+
+def _ShareArrays(node, shared):
+    '''
+    Replaces every large binary array in a serialized document by a reference to its content hash
+    '''
+    if isinstance(node, (list, tuple)):
+        for value in node:
+            _ShareArrays(value, shared)
+    elif isinstance(node, dict):
+        for key, value in node.items():
+            if isinstance(value, dict) and value.get("type") == "bytes" and isinstance(value.get("data"), str) \
+                    and len(value["data"]) >= SHARED_BYTES:
+                digest = hashlib.sha256(value["data"].encode()).hexdigest()[:32]
+                shared[digest] = value["data"]
+                node[key] = {"$shared": digest}
+            else:
+                _ShareArrays(value, shared)
+
+
+def Show(fig):
+    '''
+    Displays a Bokeh figure in a notebook with binary, deduplicated data
+
+    Inputs
+        fig: a Bokeh figure or layout
+
+    Outputs
+        None; outside of IPython this falls back to bokeh.io.show
+    '''
+    try:
+        from IPython import get_ipython
+        from IPython.display import HTML, display
+    except ImportError:
+        get_ipython = lambda: None
+    if get_ipython() is None:
+        import bokeh.io
+        return bokeh.io.show(fig)
+
+    _BinaryColumns(fig)
+    target = f"neurodyn-{uuid.uuid4().hex}"
+    item = json_item(fig, target)
+    shared = {}
+    _ShareArrays(item["doc"], shared)
+
+    sidecars = os.environ.get(SIDECAR_DIR_VARIABLE)
+    inline = {}
+    if sidecars:
+        os.makedirs(sidecars, exist_ok=True)
+        for digest, data in shared.items():
+            path = os.path.join(sidecars, f"{digest}.bin")
+            if not os.path.exists(path):
+                with open(path, "wb") as f:
+                    f.write(base64.b64decode(data))
+    else:
+        inline = {digest: data for digest, data in shared.items() if digest not in _inlined}
+        _inlined.update(inline)
+
+    # Escape "</" so that no string in the data can close the script element
+    values = {"inline": inline, "item": item, "refs": sorted(shared),
+              "url": os.environ.get(SIDECAR_URL_VARIABLE, "_static/bokeh/")}
+    values = {key: json.dumps(value).replace("</", "<\\/") for key, value in values.items()}
+    display(HTML(_LOADER % dict(values, target=target)))
@@ -0,0 +1,410 @@
+'''
+Streaming spike-train analysis in fixed memory
+
+ClassifySpikeTrains (spikes.py) needs every spike time of a run at once. The
+stages here instead pass spikes along chunk by chunk, as generators, so
+arbitrarily long runs of many neurons are analyzed with memory proportional
+to the number of neurons only:
+
+    SimulatedSpikes   runs a population and yields the spikes of every chunk of steps
+    VoltageChunks     runs a population and yields chunks of its voltage trace
+    StoredVoltage     yields the voltage trace of a TraceStore chunk by chunk,
+                      with the neuron of each column
+    DetectSpikes      turns voltage chunks into spikes (upward threshold crossings,
+                      with the crossing time interpolated between samples)
+    SpikeStreamStats  accumulates per-neuron statistics from the spikes
+
+Every chunk of spikes is a tuple (neurons, times, t_end): the neuron and time
+(ms) of each spike in the chunk, in time order, and the time the chunk ends.
+
+SpikeStreamStats keeps, for every neuron, its spike count, a running mean and
+variance of its interspike intervals (Welford's method), and the state of the
+burst detector. Bursts are detected online: a candidate burst is a run of
+consecutive intervals shorter than isi_fraction times the neuron's running
+mean interval (or than max_isi, in ms, if given). The mean of the first few
+intervals says little, so the first warmup_intervals spike times of every
+neuron are held (a fixed amount of memory per neuron) and tested together
+against the mean of those intervals once they are all in; a train that starts
+with a burst then has that burst detected. When the run ends it is accepted
+as a burst by one of two criteria:
+
+    "isi"       it holds at least min_burst_spikes spikes
+    "surprise"  its Poisson surprise -log10 P(n or more spikes in its duration),
+                at the neuron's firing rate outside the run, is at least min_surprise
+                (Legendy and Salcman's criterion, applied to the candidate runs)
+
+A neuron is classified as in Chapter 5: at rest if it fires fewer than
+min_spikes spikes, bursting if it fires at least two bursts that hold at least
+burst_fraction of its spikes, and tonic spiking otherwise.
+'''
+import math
+
+import numpy as np
+
+from neurodyn.spikes import REST, TONIC, BURSTING
+
+BURST_CRITERIA = ("isi", "surprise")
+
+
+def SimulatedSpikes(population, t_stop, dt, I_inj=0.0, chunk_steps=1000):
+    '''
+    Runs a population and yields its spikes chunk by chunk
+
+    Inputs
+        population: ConductanceBasedPopulation (or any population with t and a
+                    Step(dt, I_inj) method returning the neurons that spiked)
+        t_stop: float
+            The duration of the run (ms)
+        dt: float
+            The step size (ms)
+        I_inj: float, array of shape (N,), or callable
+            The injected current density (uA/cm^2), or a function of time returning it
+        chunk_steps: int
+            The number of steps per chunk
+
+    Yields
+        (neurons, times, t_end) for every chunk
+    '''
+    n_steps = int(round(t_stop / dt))
+    neurons, times = [], []
+    for k in range(1, n_steps + 1):
+        spiked = population.Step(dt, I_inj(population.t) if callable(I_inj) else I_inj)
+        fired = np.flatnonzero(spiked)
+        if fired.size:
+            neurons.append(fired)
+            times.append(np.full(fired.size, population.t))
+        if k % chunk_steps == 0 or k == n_steps:
+            yield (np.concatenate(neurons) if neurons else np.empty(0, dtype=np.int64),
+                   np.concatenate(times) if times else np.empty(0), population.t)
+            neurons, times = [], []
+
+
+def VoltageChunks(population, t_stop, dt, I_inj=0.0, chunk_steps=1000):
+    '''
+    Runs a population and yields its voltage trace chunk by chunk
+
+    Yields
+        (t, V): the times of the chunk's samples, of shape (n,), and V of shape (n, N),
+        in a buffer that is reused for the next chunk
+    '''
+    n_steps = int(round(t_stop / dt))
+    t = np.empty(chunk_steps)
+    V = np.empty((chunk_steps, population.N), dtype=population.V.dtype)
+    n = 0
+    for k in range(1, n_steps + 1):
+        population.Step(dt, I_inj(population.t) if callable(I_inj) else I_inj)
+        t[n] = population.t
+        V[n] = population.V
+        n += 1
+        if n == chunk_steps or k == n_steps:
+            yield t[:n], V[:n]
+            n = 0
+
+
+def StoredVoltage(store, neurons=None, chunk_duration=None):
+    '''
+    Yields the voltage trace of a TraceStore (see traces.py) chunk by chunk
+
+    Inputs
+        store: TraceStore
+        neurons: integer array, optional
+            The neurons to read (defaults to every recorded neuron)
+        chunk_duration: float, optional
+            The duration (ms) of each chunk; defaults to the store's own chunks
+
+    Yields
+        (t, V, neurons) for every chunk: the sample times, the voltages of shape
+        (n, n_neurons), and the neuron of each column of V
+    '''
+    ids = store.neurons if neurons is None else np.asarray(neurons)
+    t_first, t_last = store.t_range
+    if chunk_duration is None:
+        for index in range(store.n_chunks):
+            t = store.Chunk("t", index)
+            yield store.Read("V", t[0], t[-1], neurons) + (ids,)
+        return
+    start = t_first
+    while start <= t_last:
+        t, V = store.Read("V", start, start + chunk_duration, neurons)
+        # Windows share their end points; keep each sample once
+        keep = t < start + chunk_duration if start + chunk_duration <= t_last else slice(None)
+        yield t[keep], V[keep], ids
+        start += chunk_duration
+
+
+def DetectSpikes(chunks, V_thresh=0.0):
+    '''
+    Detects the upward crossings of V_thresh in a stream of voltage chunks
+
+    The last sample of every chunk is kept, so crossings between chunks are
+    found too. The crossing time is interpolated linearly between the samples
+    on either side of the threshold.
+
+    Inputs
+        chunks: iterable of (t, V) or (t, V, neurons)
+            Sample times of shape (n,) and voltages of shape (n, N), and optionally
+            the neuron of each column of V (as from StoredVoltage); without it the
+            columns are neurons 0 to N - 1
+        V_thresh: float
+            The spike detection threshold (mV)
+
+    Yields
+        (neurons, times, t_end) for every chunk
+    '''
+    t_prev = V_prev = None
+    for chunk in chunks:
+        t, V = chunk[:2]
+        ids = chunk[2] if len(chunk) > 2 else None
+        if not len(t):
+            continue
+        if V_prev is None:
+            t_all, V_all = t, V
+        else:
+            t_all, V_all = np.concatenate([[t_prev], t]), np.concatenate([V_prev[np.newaxis], V])
+        steps, neurons = np.nonzero((V_all[:-1] < V_thresh) & (V_all[1:] >= V_thresh))
+        V0, V1 = V_all[steps, neurons], V_all[steps + 1, neurons]
+        times = t_all[steps] + (t_all[steps + 1] - t_all[steps]) * (V_thresh - V0) / (V1 - V0)
+        t_prev, V_prev = t[-1], np.array(V[-1])
+        yield (neurons if ids is None else ids[neurons]), times, t[-1]
+
+
+def PoissonSurprise(n, rate, duration):
+    '''
+    The Poisson surprise -log10 P(N >= n) of n spikes in a window, with N ~ Poisson(rate * duration)
+
+    Inputs
+        n: integer array
+            The numbers of spikes
+        rate: array
+            The expected firing rates (spikes/ms)
+        duration: array
+            The window durations (ms)
+    '''
+    n = np.asarray(n, dtype=np.float64)
+    lam = np.asarray(rate, dtype=np.float64) * np.asarray(duration, dtype=np.float64)
+    lam, n = np.broadcast_arrays(np.maximum(lam, 1e-300), n)
+    surprise = np.zeros(n.shape)
+    # When n <= lam the event is not surprising; otherwise sum the tail from k = n up
+    tail = n > lam
+    lgamma = np.vectorize(math.lgamma, otypes=[float])
+    log_first = -lam[tail] + n[tail] * np.log(lam[tail]) - lgamma(n[tail] + 1)
+    term = np.ones(tail.sum())
+    total = np.ones(tail.sum())
+    for k in range(1, 200):
+        term *= lam[tail] / (n[tail] + k)
+        total += term
+        if np.all(term < 1e-12 * total):
+            break
+    surprise[tail] = -(log_first + np.log(total)) / np.log(10)
+    return surprise
+
+
+class SpikeStreamStats:
+    '''
+    Per-neuron spike statistics, burst detection, and firing-pattern classes, accumulated chunk by chunk
+
+    Inputs
+        N: int
+            The number of neurons
+        t_start: float
+            The time (ms) the analysis starts; earlier spikes are ignored as transients
+        criterion: str
+            "isi" or "surprise", the burst acceptance criterion
+        isi_fraction: float
+            Intervals shorter than this fraction of the running mean interval can be part of a burst
+        max_isi: float, optional
+            An absolute bound (ms) on the intervals within a burst, used instead of isi_fraction
+        min_burst_spikes: int
+            The smallest number of spikes in a burst
+        min_surprise: float
+            The smallest Poisson surprise of a burst, for criterion="surprise"
+        min_spikes: int
+            Neurons with fewer spikes are at rest
+        burst_fraction: float
+            The fraction of its spikes a bursting neuron fires within bursts
+        warmup_intervals: int
+            The number of first intervals of each neuron that are held until their
+            mean is known, then tested against it (not needed with max_isi)
+    '''
+
+    def __init__(self, N, t_start=0.0, criterion="isi", isi_fraction=0.5, max_isi=None, min_burst_spikes=3,
+                 min_surprise=2.0, min_spikes=3, burst_fraction=0.5, warmup_intervals=8):
+        if criterion not in BURST_CRITERIA:
+            raise ValueError(f"Unknown burst criterion {criterion!r}, expected one of {BURST_CRITERIA}")
+        self.N = N
+        self.t_start = t_start
+        self.t_end = t_start
+        self.criterion = criterion
+        self.isi_fraction = isi_fraction
+        self.max_isi = max_isi
+        self.min_burst_spikes = min_burst_spikes
+        self.min_surprise = min_surprise
+        self.min_spikes = min_spikes
+        self.burst_fraction = burst_fraction
+
+        self.count = np.zeros(N, dtype=np.int64)
+        self.t_first = np.full(N, np.nan)
+        self.t_last = np.full(N, np.nan)
+        self.isi_mean = np.zeros(N)
+        self._isi_m2 = np.zeros(N)
+        self.n_bursts = np.zeros(N, dtype=np.int64)
+        self.burst_spikes = np.zeros(N, dtype=np.int64)
+        # The open candidate burst: its number of spikes (0 if none) and first spike time
+        self._run = np.zeros(N, dtype=np.int64)
+        self._run_start = np.zeros(N)
+        # The first spike times of every neuron, held until its first warmup intervals are in
+        self.warmup = 0 if max_isi is not None else warmup_intervals
+        self._held = np.full((N, self.warmup + 1), np.nan)
+
+    def Update(self, neurons, times, t_end=None):
+        '''
+        Takes the spikes of one chunk, in time order
+        '''
+        neurons = np.asarray(neurons, dtype=np.int64)
+        times = np.asarray(times, dtype=np.float64)
+        keep = times >= self.t_start
+        neurons, times = neurons[keep], times[keep]
+        if t_end is not None:
+            self.t_end = max(self.t_end, t_end)
+        if not neurons.size:
+            return
+        self.t_end = max(self.t_end, times.max())
+        # A neuron's spikes must be taken in order: the r-th spike of every neuron in round r
+        order = np.lexsort((times, neurons))
+        neurons, times = neurons[order], times[order]
+        first = np.r_[True, neurons[1:] != neurons[:-1]]
+        rank = np.arange(len(neurons)) - np.maximum.accumulate(np.where(first, np.arange(len(neurons)), 0))
+        for r in range(rank.max() + 1):
+            at = rank == r
+            self._Spike(neurons[at], times[at])
+
+    def _Spike(self, i, t):
+        '''
+        Takes one spike of each of the (distinct) neurons i
+        '''
+        held = self.count[i] <= self.warmup
+        self._held[i[held], self.count[i[held]]] = t[held]
+        has_previous = self.count[i] > 0
+        j, tj = i[has_previous], t[has_previous]
+        isi = tj - self.t_last[j]
+
+        # Welford's update of the interval mean and variance
+        n = self.count[j]   # the number of intervals including this one
+        bound = np.full(j.size, self.max_isi) if self.max_isi is not None else self.isi_fraction * self.isi_mean[j]
+        delta = isi - self.isi_mean[j]
+        self.isi_mean[j] += delta / n
+        self._isi_m2[j] += delta * (isi - self.isi_mean[j])
+
+        # Past the warmup, the interval is tested against the mean of the intervals before it
+        online = n > self.warmup
+        self._Test(j[online], isi[online], self.t_last[j[online]], n[online], bound[online], self._run,
+                   self._run_start, self.n_bursts, self.burst_spikes)
+        # At the end of the warmup, the held intervals are tested against their mean
+        ending = n == self.warmup
+        self._Replay(j[ending], n[ending], self._run, self._run_start, self.n_bursts, self.burst_spikes)
+
+        self.t_first[i[~has_previous]] = t[~has_previous]
+        self.t_last[i] = t
+        self.count[i] += 1
+
+    def _Test(self, j, isi, t_previous, n_previous, bound, run, run_start, n_bursts, burst_spikes):
+        '''
+        Runs the burst detector of neurons j over one interval each
+
+        isi ends a spike at t_previous, the n_previous-th spike of the neuron. A
+        short interval opens or extends a candidate burst; a long one closes it.
+        '''
+        short = isi < bound
+        opening = short & (run[j] == 0)
+        run_start[j[opening]] = t_previous[opening]
+        run[j[opening]] = 1
+        run[j[short]] += 1
+        closing = ~short
+        self._CloseRuns(j[closing], t_previous[closing], n_previous[closing], run, run_start, n_bursts,
+                        burst_spikes)
+
+    def _Replay(self, j, n_held, run, run_start, n_bursts, burst_spikes):
+        '''
+        Runs the burst detector of neurons j over their n_held held intervals, against the mean of all their intervals
+        '''
+        bound = self.isi_fraction * self.isi_mean[j]
+        for k in range(1, n_held.max(initial=0) + 1):
+            at = n_held >= k
+            t_previous = self._held[j[at], k - 1]
+            self._Test(j[at], self._held[j[at], k] - t_previous, t_previous, np.full(at.sum(), k), bound[at],
+                       run, run_start, n_bursts, burst_spikes)
+
+    def _Bursts(self, j, t_last, count, run, run_start):
+        '''
+        Ends the open candidate bursts of neurons j at their last spike, at t_last, the count-th spike
+
+        Outputs
+            (j, n, accepted): the neurons with an open candidate, its number of
+            spikes, and whether it is accepted as a burst
+        '''
+        is_open = run[j] > 0
+        j, t_last, count = j[is_open], t_last[is_open], count[is_open]
+        n = run[j]
+        accepted = n >= self.min_burst_spikes
+        if self.criterion == "surprise" and j.size:
+            # The firing rate outside the candidate, so that it does not explain itself
+            duration = t_last - run_start[j]
+            rate = (count - n) / np.maximum(t_last - self.t_start - duration, 1e-12)
+            surprise = PoissonSurprise(n, rate, duration)
+            accepted &= surprise >= self.min_surprise
+        return j, n, accepted
+
+    def _CloseRuns(self, j, t_last, count, run, run_start, n_bursts, burst_spikes):
+        j, n, accepted = self._Bursts(j, t_last, count, run, run_start)
+        n_bursts[j[accepted]] += 1
+        burst_spikes[j[accepted]] += n[accepted]
+        run[j] = 0
+
+    def Results(self):
+        '''
+        The statistics of every neuron so far, counting the candidate bursts still open as ended
+
+        Outputs
+            A dict of arrays of shape (N,): spike_count, rate (Hz), isi_mean (ms),
+            cv, n_bursts, burst_spikes, and pattern (REST, TONIC, or BURSTING)
+        '''
+        n_bursts, burst_spikes = self.n_bursts.copy(), self.burst_spikes.copy()
+        run, run_start = self._run.copy(), self._run_start.copy()
+        # Neurons still in their warmup are tested against the mean of the intervals they have
+        warming = np.flatnonzero((self.count >= 2) & (self.count <= self.warmup))
+        self._Replay(warming, self.count[warming] - 1, run, run_start, n_bursts, burst_spikes)
+        everyone = np.arange(self.N)
+        self._CloseRuns(everyone, self.t_last, self.count, run, run_start, n_bursts, burst_spikes)
+        n_isi = np.maximum(self.count - 1, 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            isi_mean = np.where(n_isi > 0, self.isi_mean, np.nan)
+            cv = np.sqrt(self._isi_m2 / n_isi) / isi_mean
+        duration = self.t_end - self.t_start
+        bursting = (n_bursts >= 2) & (burst_spikes >= self.burst_fraction * self.count)
+        pattern = np.where(bursting, BURSTING, TONIC).astype(np.int8)
+        pattern[self.count < self.min_spikes] = REST
+        return {"spike_count": self.count.copy(),
+                "rate": self.count / (duration * 1e-3) if duration > 0 else np.zeros(self.N),
+                "isi_mean": isi_mean, "cv": cv, "n_bursts": n_bursts, "burst_spikes": burst_spikes,
+                "pattern": pattern}
+
+
+def AnalyzeSpikeStream(chunks, N, **options):
+    '''
+    Runs SpikeStreamStats over a stream of spike chunks
+
+    Inputs
+        chunks: iterable of (neurons, times, t_end)
+            e.g. from SimulatedSpikes or DetectSpikes
+        N: int
+            The number of neurons
+        options:
+            Passed to SpikeStreamStats
+
+    Outputs
+        The dict of SpikeStreamStats.Results
+    '''
+    stats = SpikeStreamStats(N, **options)
+    for neurons, times, t_end in chunks:
+        stats.Update(neurons, times, t_end)
+    return stats.Results()
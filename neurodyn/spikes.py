@@ -0,0 +1,110 @@
+'''
+Compressed spike trains
+
+Instead of dense voltage traces, simulations can return only the spike times
+of each neuron. They are stored like a compressed sparse row matrix: one flat
+array of spike times sorted by neuron and then by time, and an index pointer
+array marking where each neuron's spikes start.
+'''
+import numpy as np
+
+
+class SpikeTrains:
+    '''
+    The spike times of N neurons in compressed sparse row form
+
+    Inputs
+        times: array of shape (n_spikes,)
+            The spike times (ms), grouped by neuron and sorted within each neuron
+        indptr: integer array of shape (N + 1,)
+            The spikes of neuron i are times[indptr[i]:indptr[i + 1]]
+    '''
+
+    def __init__(self, times, indptr):
+        self.times = np.asarray(times, dtype=np.float64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+
+    @classmethod
+    def FromEvents(cls, neurons, times, N):
+        '''
+        Builds spike trains from unordered (neuron, time) events
+
+        Inputs
+            neurons: integer array
+                The index of the neuron that emitted each spike
+            times: array
+                The time (ms) of each spike
+            N: int
+                The number of neurons
+        '''
+        neurons = np.asarray(neurons, dtype=np.int64)
+        times = np.asarray(times, dtype=np.float64)
+        order = np.lexsort((times, neurons))
+        indptr = np.zeros(N + 1, dtype=np.int64)
+        np.cumsum(np.bincount(neurons, minlength=N), out=indptr[1:])
+        return cls(times[order], indptr)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, i):
+        return self.times[self.indptr[i]:self.indptr[i + 1]]
+
+    def Counts(self):
+        '''
+        Returns the number of spikes of each neuron
+        '''
+        return np.diff(self.indptr)
+
+    def Neurons(self):
+        '''
+        Returns the neuron index of every entry of times
+        '''
+        return np.repeat(np.arange(len(self)), self.Counts())
+
+    def __repr__(self):
+        return f"SpikeTrains(N={len(self)}, n_spikes={len(self.times)})"
+
+
+# Firing-pattern classes of Chapter 5
+REST, TONIC, BURSTING = 0, 1, 2
+FIRING_PATTERNS = ("rest", "tonic", "bursting")
+
+
+def InterspikeIntervalStats(spikes):
+    '''
+    Computes the mean and coefficient of variation of each neuron's interspike intervals
+
+    Outputs
+        (mean, cv): arrays of shape (N,), NaN for neurons with fewer than two spikes
+    '''
+    N = len(spikes)
+    neurons = spikes.Neurons()
+    # Intervals between consecutive spikes of the same neuron
+    same = neurons[1:] == neurons[:-1]
+    isi = np.diff(spikes.times)[same]
+    owner = neurons[1:][same]
+    n = np.bincount(owner, minlength=N).astype(float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(owner, isi, minlength=N) / n
+        var = np.bincount(owner, isi**2, minlength=N) / n - mean**2
+        cv = np.sqrt(np.maximum(var, 0)) / mean
+    return mean, cv
+
+
+def ClassifySpikeTrains(spikes, min_spikes=3, burst_cv=0.5):
+    '''
+    Classifies each spike train as rest, tonic spiking, or bursting
+
+    A neuron at rest fires fewer than min_spikes spikes. Tonic spiking repeats a
+    single interspike interval, while bursting alternates short intra-burst
+    intervals with long inter-burst pauses, which shows up as a large
+    coefficient of variation of the intervals.
+
+    Outputs
+        An int8 array of shape (N,) holding REST, TONIC, or BURSTING
+    '''
+    _, cv = InterspikeIntervalStats(spikes)
+    pattern = np.where(cv > burst_cv, BURSTING, TONIC).astype(np.int8)
+    pattern[spikes.Counts() < min_spikes] = REST
+    return pattern
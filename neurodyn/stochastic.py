@@ -0,0 +1,381 @@
+'''
+Stochastic ion channels: channel noise in conductance-based models
+
+The gating variables of Chapter 5 are the average open fractions of a very
+large number of channels. A patch of membrane with a finite number of
+channels fluctuates around these averages, and with few enough channels the
+fluctuations alone can make a neuron fire. Here every gated current is
+modeled as n_channels identical channels, each made of p independent
+activation subunits and q independent inactivation subunits with the gate
+kinetics of the deterministic model, so a channel has (p + 1)(q + 1) states
+labeled by its numbers of open subunits, and it conducts when all of them are
+open (for HH sodium, the 8-state m3h1 scheme; for potassium, the 5-state n4 scheme).
+
+The channel counts of each current are advanced by one of two methods:
+
+    "gillespie"  the exact stochastic simulation algorithm: every single
+                 channel transition is drawn, with the voltage held fixed
+                 over each time step
+    "langevin"   the chemical Langevin equation: the counts change by the
+                 mean flux plus Gaussian noise of matching variance, one
+                 vectorized update per step, which is accurate for large
+                 numbers of channels
+
+With method="auto" each current uses Gillespie when it has at most
+langevin_threshold channels and Langevin otherwise.
+
+Random numbers come from counter-based Philox streams: the draws of a step are
+a pure function of (seed, block of neurons, step number), where blocks are
+fixed groups of block_size neurons. A population of neurons first_neuron to
+first_neuron + N - 1 therefore draws the same numbers however the neurons
+of a larger run are split among processes, as long as the split falls on
+block boundaries, and the results are reproducible across cores.
+'''
+from dataclasses import dataclass
+
+import numpy as np
+
+from neurodyn.hh import T_squid, ConductanceBasedPopulation
+
+METHODS = ("gillespie", "langevin")
+
+# Channel densities (channels per um^2) of the squid giant axon, for 20 pS sodium and potassium channels
+HH_CHANNEL_DENSITY = {"Na": 60.0, "K": 18.0}
+
+
+@dataclass
+class ChannelScheme:
+    '''
+    The Markov scheme of a current's channels, as a list of reactions
+
+    States are numbered i (q + 1) + j for i open activation and j open
+    inactivation subunits. Reaction r moves one channel from state src[r]
+    to state dst[r] at the per-channel rate mult[r] times the opening
+    (kind 0) or closing (kind 1) rate of gate row gate[r] of the population.
+    '''
+    current: int
+    n_channels: int
+    method: str
+    open_state: int
+    src: np.ndarray
+    dst: np.ndarray
+    gate: np.ndarray
+    kind: np.ndarray
+    mult: np.ndarray
+    subunits: list
+
+    @classmethod
+    def FromCurrent(cls, index, current, kinetics, n_channels, method):
+        '''
+        Builds the scheme of a current with p activation and q inactivation subunits
+
+        Inputs
+            index: int
+                The position of the current in the population's list of currents
+            current: Current
+                The current
+            kinetics: list of GateKinetics
+                The distinct gates of the population, whose positions are the gate rows
+            n_channels: int
+                The number of channels
+            method: str
+                "gillespie" or "langevin"
+        '''
+        p, q = current.p if current.m is not None else 0, current.q if current.h is not None else 0
+        row_m = kinetics.index(current.m) if p else -1
+        row_h = kinetics.index(current.h) if q else -1
+        reactions = []
+        for i in range(p + 1):
+            for j in range(q + 1):
+                s = i * (q + 1) + j
+                if i < p:
+                    reactions.append((s, s + q + 1, row_m, 0, p - i))
+                if i > 0:
+                    reactions.append((s, s - q - 1, row_m, 1, i))
+                if j < q:
+                    reactions.append((s, s + 1, row_h, 0, q - j))
+                if j > 0:
+                    reactions.append((s, s - 1, row_h, 1, j))
+        src, dst, gate, kind, mult = (np.array(column, dtype=dtype) for column, dtype in
+                                      zip(zip(*reactions), (np.intp, np.intp, np.intp, np.intp, np.float64)))
+        # The open subunits of each gate row in each state, to report the mean gate values
+        states = np.arange((p + 1) * (q + 1))
+        subunits = [(row, power, part) for row, power, part in
+                    ((row_m, p, states // (q + 1)), (row_h, q, states % (q + 1))) if power]
+        return cls(index, n_channels, method, (p + 1) * (q + 1) - 1, src, dst, gate, kind, mult, subunits)
+
+    @property
+    def n_states(self):
+        return self.open_state + 1
+
+    def StationaryDistribution(self, x):
+        '''
+        The fraction of channels in each state when the gates are at x
+
+        Inputs
+            x: array of shape (n_gates, N)
+                The gate values of the population
+
+        Outputs
+            An array of shape (N, n_states)
+        '''
+        from math import comb
+
+        P = np.ones((x.shape[1], self.n_states))
+        for row, power, part in self.subunits:
+            k = part[np.newaxis, :]
+            P *= np.array([comb(power, i) for i in part]) * x[row][:, np.newaxis]**k \
+                * (1 - x[row][:, np.newaxis])**(power - k)
+        return P
+
+    def Stoichiometry(self):
+        '''
+        The change of every state count by every reaction, an array of shape (n_states, n_reactions)
+        '''
+        S = np.zeros((self.n_states, len(self.src)))
+        reactions = np.arange(len(self.src))
+        S[self.src, reactions] -= 1
+        S[self.dst, reactions] += 1
+        return S
+
+
+def Streams(seed, first_neuron, N, step, block_size=256):
+    '''
+    The counter-based random number generators of a step, one per block of neurons
+
+    Inputs
+        seed: int
+            The seed of the whole run
+        first_neuron: int
+            The index of the first neuron in the whole run; must be a multiple of block_size
+        N: int
+            The number of neurons
+        step: int
+            The step number, which sets the counter of every stream
+        block_size: int
+            The number of neurons that share a stream
+
+    Outputs
+        A list of (slice, np.random.Generator), covering the N neurons in blocks
+    '''
+    if first_neuron % block_size:
+        raise ValueError(f"first_neuron must be a multiple of block_size ({block_size}), got {first_neuron}")
+    streams = []
+    for start in range(0, N, block_size):
+        key = np.array([seed, (first_neuron + start) // block_size], dtype=np.uint64)
+        counter = np.array([0, 0, step, 0], dtype=np.uint64)
+        streams.append((slice(start, min(start + block_size, N)),
+                        np.random.Generator(np.random.Philox(key=key, counter=counter))))
+    return streams
+
+
+def GillespieStep(scheme, X, rates, dt, rng):
+    '''
+    Advances the channel counts of a block of neurons by dt with the exact SSA
+
+    The rates are held fixed over the step, and all neurons of the block draw
+    their next event together until every neuron has passed dt.
+
+    Inputs
+        scheme: ChannelScheme
+            The channel scheme
+        X: int array of shape (n_states, n)
+            The number of channels in each state, updated in place
+        rates: array of shape (n_reactions, n)
+            The per-channel rate of every reaction (1/ms)
+        dt: float
+            The step size (ms)
+        rng: np.random.Generator
+            The random number generator of the block
+    '''
+    t = np.zeros(X.shape[1])
+    active = np.arange(X.shape[1])
+    last = len(scheme.src) - 1
+    while active.size:
+        propensity = np.cumsum(rates[:, active] * X[:, active][scheme.src], axis=0)
+        total = propensity[-1]
+        u = rng.random((2, active.size))
+        with np.errstate(divide="ignore"):
+            t[active] -= np.log1p(-u[0]) / total
+        fires = t[active] < dt
+        active = active[fires]
+        r = np.minimum((propensity[:, fires] < u[1, fires] * total[fires]).sum(axis=0), last)
+        X[scheme.src[r], active] -= 1
+        X[scheme.dst[r], active] += 1
+
+
+def LangevinStep(scheme, S, X, rates, dt, rng):
+    '''
+    Advances the channel counts of a block of neurons by dt with the chemical Langevin equation
+
+        dX = S a dt + S sqrt(a dt) xi,   a_r = rate_r X_src(r)
+
+    with one independent standard normal xi_r per reaction. Counts pushed below
+    zero by the noise are clipped, and the counts are rescaled to keep the total
+    number of channels.
+
+    Inputs
+        scheme: ChannelScheme
+            The channel scheme
+        S: array of shape (n_states, n_reactions)
+            The stoichiometry of the scheme
+        X: float array of shape (n_states, n)
+            The number of channels in each state, updated in place
+        rates: array of shape (n_reactions, n)
+            The per-channel rate of every reaction (1/ms)
+        dt: float
+            The step size (ms)
+        rng: np.random.Generator
+            The random number generator of the block
+    '''
+    a = rates * X[scheme.src]
+    np.maximum(a, 0, out=a)
+    a *= dt
+    flux = a + np.sqrt(a) * rng.standard_normal(a.shape)
+    X += S @ flux
+    np.maximum(X, 0, out=X)
+    X *= scheme.n_channels / X.sum(axis=0)
+
+
+class StochasticPopulation(ConductanceBasedPopulation):
+    '''
+    N independent neurons whose gated currents flow through finite numbers of stochastic channels
+
+    The membrane potential is advanced by the exponential-Euler update of
+    ConductanceBasedPopulation, with the conductance of each gated current set
+    by its fraction of open channels. Currents without gates stay deterministic.
+
+    Inputs
+        N: int
+            The number of neurons
+        area: float
+            The membrane area of each neuron (um^2), which sets the channel counts
+        currents: list of Current
+            The ionic currents of every neuron (defaults to HH_CURRENTS)
+        density: dict
+            The channel density (channels per um^2) of each gated current, by name
+            (defaults to HH_CHANNEL_DENSITY)
+        n_channels: dict, optional
+            Channel counts by current name, used instead of density * area
+        method: str
+            "gillespie", "langevin", or "auto"
+        langevin_threshold: int
+            With method="auto", the largest channel count simulated with Gillespie
+        seed: int
+            The seed of the run
+        first_neuron: int
+            The index of this population's first neuron in a larger run split among
+            processes; a multiple of block_size
+        block_size: int
+            The number of neurons that share a random number stream
+        C_m, T, V0, V_thresh:
+            As for ConductanceBasedPopulation
+
+    Attributes
+        channels: list of ChannelScheme
+            The scheme of every gated current
+        counts: list of arrays of shape (n_states, N)
+            The number of channels in each state, per scheme
+        gates: array of shape (n_gates, N)
+            The mean fraction of open subunits of each gate
+    '''
+
+    def __init__(self, N, area=100.0, currents=None, density=None, n_channels=None, method="auto",
+                 langevin_threshold=1000, C_m=1.0, T=T_squid, V0=-65.0, V_thresh=0.0, seed=0, first_neuron=0,
+                 block_size=256):
+        if method not in METHODS + ("auto",):
+            raise ValueError(f"Unknown method {method!r}, expected one of {METHODS + ('auto',)}")
+        self.channels = []
+        self.seed = seed
+        self.first_neuron = first_neuron
+        self.block_size = block_size
+        self._step = 0
+        super().__init__(N, currents, C_m, T, V0, V_thresh, dtype=np.float64)
+
+        density = HH_CHANNEL_DENSITY if density is None else density
+        n_channels = {} if n_channels is None else n_channels
+        for index, current in enumerate(self.currents):
+            if not self._gate_rows[index]:
+                continue
+            if current.name in n_channels:
+                count = int(n_channels[current.name])
+            elif current.name in density:
+                count = max(int(round(density[current.name] * area)), 1)
+            else:
+                raise ValueError(f"No channel density or count given for current {current.name!r}")
+            chosen = method if method != "auto" else ("gillespie" if count <= langevin_threshold else "langevin")
+            self.channels.append(ChannelScheme.FromCurrent(index, current, self.kinetics, count, chosen))
+        self._stoichiometry = [scheme.Stoichiometry() for scheme in self.channels]
+        self.Reset(V0)
+
+    @property
+    def methods(self):
+        '''
+        The method used for each gated current, by name
+        '''
+        return {self.currents[scheme.current].name: scheme.method for scheme in self.channels}
+
+    def UseGatingTables(self, V_min=-100.0, V_max=60.0, dV=0.01):
+        '''
+        Not supported: the channel transitions need the rate functions themselves, not tabulated relaxations
+        '''
+        raise TypeError("StochasticPopulation does not support gating tables; "
+                        "its channels use the analytic rate functions")
+
+    def Reset(self, V0=-65.0):
+        '''
+        Puts every neuron at V0 with its channels drawn from their steady state, and clears the spike counts
+        '''
+        super().Reset(V0)
+        self._step = 0
+        streams = Streams(self.seed, self.first_neuron, self.N, 0, self.block_size)
+        self.counts = []
+        for scheme in self.channels:
+            P = scheme.StationaryDistribution(self.gates)
+            X = np.empty((scheme.n_states, self.N), dtype=np.int64 if scheme.method == "gillespie" else np.float64)
+            for block, rng in streams:
+                X[:, block] = rng.multinomial(scheme.n_channels, P[block] / P[block].sum(axis=1, keepdims=True)).T
+            self.counts.append(X)
+        self._UpdateGates()
+
+    def _UpdateGates(self):
+        for scheme, X in zip(self.channels, self.counts):
+            for row, power, part in scheme.subunits:
+                self.gates[row] = part @ X / (power * scheme.n_channels)
+
+    def Conductances(self, out=None):
+        '''
+        Computes the total conductance G = sum_j g_j and the sum sum_j g_j E_j over all currents,
+        with g_j = g_bar_j times the open fraction of the channels of current j
+        '''
+        G, GE, g = (self._G, self._GE, self._g) if out is None else out
+        G.fill(0)
+        GE.fill(0)
+        open_fraction = {scheme.current: X[scheme.open_state] / scheme.n_channels
+                         for scheme, X in zip(self.channels, self.counts)}
+        for index, (g_bar, E) in enumerate(zip(self._g_bar, self._E)):
+            g[:] = g_bar
+            if index in open_fraction:
+                g *= open_fraction[index]
+            G += g
+            g *= E
+            GE += g
+        return G, GE
+
+    def StepGates(self, dt):
+        '''
+        Advances the channels of every neuron by dt with the membrane potential held fixed
+        '''
+        self._step += 1
+        V = self.V
+        gate_rates = np.stack([np.stack([gate.alpha(V), gate.beta(V)]) * phi
+                               for gate, phi in zip(self.kinetics, self._phi)])
+        streams = Streams(self.seed, self.first_neuron, self.N, self._step, self.block_size)
+        for scheme, S, X in zip(self.channels, self._stoichiometry, self.counts):
+            rates = scheme.mult[:, np.newaxis] * gate_rates[scheme.gate, scheme.kind]
+            for block, rng in streams:
+                if scheme.method == "gillespie":
+                    GillespieStep(scheme, X[:, block], rates[:, block], dt, rng)
+                else:
+                    LangevinStep(scheme, S, X[:, block], rates[:, block], dt, rng)
+        self._UpdateGates()
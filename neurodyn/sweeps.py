@@ -0,0 +1,309 @@
+'''
+Parallel parameter sweeps for bifurcation scans (Chapter 5, "A Note on Bifurcations")
+
+Twisting the "dials" of a conductance-based model (C_m, E_j, g_bar_j, or the
+injected current) moves it between rest, tonic spiking, and bursting. A
+ParameterSweep evaluates a grid or Latin hypercube of dial settings: the
+points are split into chunks, each chunk is simulated as one vectorized
+ConductanceBasedPopulation in a pool of worker processes, and every worker
+writes its spike counts, firing rates, and firing-pattern classes straight
+into shared result arrays. With a checkpoint directory the result arrays are
+memory-mapped files, and a rerun resumes from the chunks that are not done.
+
+Parameter names are "I_inj", "C_m", "T", or "g_bar.<current>" and "E.<current>"
+for any current of the model, e.g. "g_bar.Na" or "E.K".
+'''
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import replace
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from neurodyn.hh import T_squid, HH_CURRENTS, ConductanceBasedPopulation
+from neurodyn.spikes import SpikeTrains, ClassifySpikeTrains
+
+# The result arrays of a sweep, one entry per parameter point
+RESULT_FIELDS = {"spike_count": np.int64, "rate": np.float64, "pattern": np.int8}
+
+
+def ParameterGrid(**axes):
+    '''
+    Builds the full factorial grid of the given parameter axes
+
+    Inputs
+        axes: name=array
+            The values of each parameter
+
+    Outputs
+        A dict mapping each name to a flat array with one entry per grid point
+    '''
+    mesh = np.meshgrid(*axes.values(), indexing="ij")
+    return {name: values.ravel() for name, values in zip(axes, mesh)}
+
+
+def LatinHypercube(n, seed=None, **bounds):
+    '''
+    Draws a Latin hypercube sample of n parameter points
+
+    Each parameter range is cut into n equal strata and every stratum is
+    sampled exactly once, which covers the space more evenly than n
+    independent uniform draws.
+
+    Inputs
+        n: int
+            The number of points
+        seed: int, optional
+            The seed of the random number generator
+        bounds: name=(low, high)
+            The range of each parameter
+
+    Outputs
+        A dict mapping each name to an array of n values
+    '''
+    rng = np.random.default_rng(seed)
+    return {name: low + (high - low) * (rng.permutation(n) + rng.random(n)) / n
+            for name, (low, high) in bounds.items()}
+
+
+def ApplyParameters(currents, params, others=()):
+    '''
+    Returns copies of the current declarations with swept g_bar and E values substituted
+
+    Inputs
+        currents: list of Current
+            The model's currents
+        params: dict of name -> array of shape (n,)
+            The parameter values of each point, named "g_bar.<current>" or "E.<current>"
+        others: tuple of str
+            The names of the parameters the caller handles itself, which are skipped
+
+    Outputs
+        A list of Current, with the array of values of every swept g_bar and E
+    '''
+    currents = list(currents)
+    names = [c.name for c in currents]
+    for key, values in params.items():
+        if key in others:
+            continue
+        field, _, current = key.partition(".")
+        if field not in ("g_bar", "E") or current not in names:
+            valid = list(others) + [f"{kind}.{name}" for kind in ("g_bar", "E") for name in names]
+            raise KeyError(f"Unknown parameter {key!r}, expected one of {valid}")
+        j = names.index(current)
+        currents[j] = replace(currents[j], **{field: values})
+    return currents
+
+
+def SimulateChunk(params, currents=None, t_stop=500.0, dt=0.01, t_transient=100.0, V_thresh=0.0):
+    '''
+    Simulates one block of parameter points as a single vectorized population
+
+    Inputs
+        params: dict of name -> array of shape (n,)
+            The parameter values of each point
+        currents: list of Current
+            The model's currents (defaults to HH_CURRENTS)
+        t_stop: float
+            The duration of each simulation (ms)
+        dt: float
+            The step size (ms)
+        t_transient: float
+            Spikes before this time (ms) are discarded as transients
+        V_thresh: float
+            The spike detection threshold (mV)
+
+    Outputs
+        A dict with the spike_count, rate (Hz), and pattern of each point
+    '''
+    n = len(next(iter(params.values())))
+    currents = ApplyParameters(HH_CURRENTS if currents is None else currents, params, ("I_inj", "C_m", "T"))
+    pop = ConductanceBasedPopulation(n, currents, C_m=params.get("C_m", 1.0), T=params.get("T", T_squid),
+                                     V_thresh=V_thresh)
+    I_inj = params.get("I_inj", 0.0)
+
+    neurons, times = [], []
+    for k in range(int(round(t_stop / dt))):
+        spiked = pop.Step(dt, I_inj)
+        if pop.t >= t_transient and spiked.any():
+            idx = np.flatnonzero(spiked)
+            neurons.append(idx)
+            times.append(np.full(idx.size, pop.t))
+    if neurons:
+        spikes = SpikeTrains.FromEvents(np.concatenate(neurons), np.concatenate(times), n)
+    else:
+        spikes = SpikeTrains([], np.zeros(n + 1))
+    counts = spikes.Counts()
+    return {"spike_count": counts,
+            "rate": counts / ((t_stop - t_transient) * 1e-3),
+            "pattern": ClassifySpikeTrains(spikes)}
+
+
+class _ResultStore:
+    '''
+    Result arrays shared between processes: memory-mapped files in a checkpoint
+    directory, or anonymous shared-memory blocks when there is none
+    '''
+
+    def __init__(self, n_points, n_chunks, directory=None):
+        self.directory = directory
+        self.shapes = dict({name: (n_points,) for name in RESULT_FIELDS}, done=(n_chunks,))
+        self.dtypes = dict(RESULT_FIELDS, done=np.bool_)
+        self._blocks = {}
+        self.names = {}
+        for name in self.shapes:
+            if directory is None:
+                nbytes = max(int(np.prod(self.shapes[name])) * np.dtype(self.dtypes[name]).itemsize, 1)
+                block = shared_memory.SharedMemory(create=True, size=nbytes)
+                self._blocks[name] = block
+                self.names[name] = block.name
+                self.Array(name)[:] = 0
+            else:
+                path = os.path.join(directory, f"{name}.npy")
+                if not os.path.exists(path):
+                    np.lib.format.open_memmap(path, "w+", self.dtypes[name], self.shapes[name])
+                self.names[name] = path
+
+    def __getstate__(self):
+        # Workers re-attach by name instead of pickling the arrays
+        return {k: v for k, v in self.__dict__.items() if k != "_blocks"} | {"_blocks": {}}
+
+    def Array(self, name):
+        '''
+        Attaches to a result array by name
+        '''
+        if self.directory is not None:
+            return np.load(self.names[name], mmap_mode="r+")
+        if name not in self._blocks:
+            self._blocks[name] = shared_memory.SharedMemory(name=self.names[name])
+        return np.ndarray(self.shapes[name], self.dtypes[name], buffer=self._blocks[name].buf)
+
+    def Close(self, unlink=False):
+        if unlink and self.directory is None:
+            # Blocks closed by an in-process worker must be reattached to be unlinked
+            for name in self.names:
+                if name not in self._blocks:
+                    self._blocks[name] = shared_memory.SharedMemory(name=self.names[name])
+        for block in self._blocks.values():
+            block.close()
+            if unlink:
+                block.unlink()
+        self._blocks = {}
+
+
+def _RunChunk(store, chunk, start, params, options):
+    '''
+    Worker task: simulates one chunk and writes it into the shared result arrays
+    '''
+    results = SimulateChunk(params, **options)
+    stop = start + len(results["spike_count"])
+    for name, values in results.items():
+        array = store.Array(name)
+        array[start:stop] = values
+        if isinstance(array, np.memmap):
+            array.flush()
+    # Mark the chunk done only once its results are safely written
+    done = store.Array("done")
+    done[chunk] = True
+    if isinstance(done, np.memmap):
+        done.flush()
+    del array, done
+    store.Close()
+    return chunk
+
+
+class ParameterSweep:
+    '''
+    A sweep of a conductance-based model over a set of parameter points
+
+    Inputs
+        samples: dict of name -> array of shape (n_points,)
+            The parameter points, e.g. from ParameterGrid or LatinHypercube
+        currents: list of Current
+            The model's currents (defaults to HH_CURRENTS)
+        t_stop, dt, t_transient, V_thresh: float
+            The simulation protocol of every point (see SimulateChunk)
+        chunk_size: int
+            The number of points simulated together by one worker task
+    '''
+
+    def __init__(self, samples, currents=None, t_stop=500.0, dt=0.01, t_transient=100.0, V_thresh=0.0,
+                 chunk_size=1000):
+        self.samples = {name: np.asarray(values) for name, values in samples.items()}
+        self.n_points = len(next(iter(self.samples.values())))
+        self.chunk_size = chunk_size
+        self.options = dict(currents=currents, t_stop=t_stop, dt=dt, t_transient=t_transient, V_thresh=V_thresh)
+
+    @property
+    def n_chunks(self):
+        return -(-self.n_points // self.chunk_size)
+
+    def _Checkpoint(self, directory):
+        '''
+        Saves the sweep's samples and protocol to a checkpoint directory, or checks
+        that an existing checkpoint belongs to the same sweep
+        '''
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, "sweep.json")
+        meta = {"n_points": self.n_points, "chunk_size": self.chunk_size, "parameters": sorted(self.samples),
+                "protocol": {k: v for k, v in self.options.items() if k != "currents"}}
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                saved = json.load(f)
+            stored = np.load(os.path.join(directory, "samples.npz"))
+            same = saved == meta and all(np.array_equal(stored[k], v) for k, v in self.samples.items())
+            if not same:
+                raise ValueError(f"The checkpoint in {directory} belongs to a different sweep")
+            return
+        np.savez(os.path.join(directory, "samples.npz"), **self.samples)
+        with open(meta_path, "w") as f:
+            json.dump(meta, f, indent=2)
+
+    def Run(self, n_workers=None, checkpoint_dir=None, progress=None):
+        '''
+        Runs every chunk that is not yet done on a pool of worker processes
+
+        Inputs
+            n_workers: int, optional
+                The number of worker processes (defaults to the number of CPUs);
+                0 runs every chunk in the calling process
+            checkpoint_dir: str, optional
+                A directory holding memory-mapped results and the done flag of each
+                chunk; rerunning with the same directory resumes the sweep
+            progress: callable, optional
+                Called as progress(n_done, n_chunks) after every finished chunk
+
+        Outputs
+            A dict of result arrays (spike_count, rate, pattern), one entry per point
+        '''
+        if checkpoint_dir is not None:
+            self._Checkpoint(checkpoint_dir)
+        store = _ResultStore(self.n_points, self.n_chunks, checkpoint_dir)
+        try:
+            todo = np.flatnonzero(~store.Array("done"))
+            n_done = self.n_chunks - len(todo)
+            tasks = []
+            for chunk in todo:
+                start = chunk * self.chunk_size
+                stop = min(start + self.chunk_size, self.n_points)
+                params = {name: values[start:stop] for name, values in self.samples.items()}
+                tasks.append((store, chunk, start, params, self.options))
+
+            if n_workers == 0:
+                for task in tasks:
+                    _RunChunk(*task)
+                    n_done += 1
+                    if progress:
+                        progress(n_done, self.n_chunks)
+            else:
+                with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count()) as pool:
+                    for future in as_completed([pool.submit(_RunChunk, *task) for task in tasks]):
+                        future.result()
+                        n_done += 1
+                        if progress:
+                            progress(n_done, self.n_chunks)
+
+            return {name: np.array(store.Array(name)) for name in RESULT_FIELDS}
+        finally:
+            store.Close(unlink=checkpoint_dir is None)
@@ -0,0 +1,337 @@
+'''
+Chunked, memory-mapped storage for long simulation traces
+
+Recording V and every gate of many neurons over a long run quickly outgrows
+memory. A TraceWriter streams the recorded variables to disk as the run goes,
+in a directory of columnar files: every variable, and the sample times, is
+stored on its own as a sequence of chunks in time. The number of samples per
+chunk is set by a byte budget, chunk_bytes, for the samples of all recorded
+neurons, so a chunk stays the same size in memory whatever the number of
+neurons. Each chunk is split further into files of neuron_block neurons, each
+a (samples, neurons) array, so reading a few neurons only touches their
+blocks. Uncompressed files are .npy files that are read by memory-mapping;
+with compression="zlib" each file is deflated on write and inflated when it is
+read. Only one chunk per variable is held in memory while recording.
+
+The writer can record a subset of the neurons and of the variables, and
+downsample at record time, keeping every n-th step ("sample") or the average
+over each n steps ("mean").
+
+A TraceStore opens a recorded directory and reads time windows of selected
+neurons, touching only the chunks that overlap the window:
+
+    with TraceWriter("run1", variables=("V", "n"), every=10) as writer:
+        pop.Run(10_000, 0.01, I_inj=10.0, recorder=writer)
+    store = TraceStore("run1")
+    t, V = store.Read("V", t_start=500, t_end=600, neurons=[0, 5, 7])
+'''
+import json
+import os
+import shutil
+import zlib
+
+import numpy as np
+
+COMPRESSIONS = (None, "zlib")
+DOWNSAMPLING = ("sample", "mean")
+
+
+class TraceWriter:
+    '''
+    Streams recorded state variables into a chunked trace directory
+
+    Inputs
+        directory: str
+            The trace directory, created if needed
+        variables: tuple of str
+            "V" and/or gate names of the population, e.g. ("V", "m", "h", "n")
+        neurons: integer array, optional
+            The neurons to record (defaults to all)
+        every: int
+            Record one sample every this many steps
+        method: str
+            "sample" keeps the state at every n-th step; "mean" averages the
+            state over each n steps, stamped with the time of the last one
+        chunk_bytes: int
+            The memory budget of one chunk of a variable, which sets the number of
+            samples per chunk
+        neuron_block: int
+            The number of neurons per file of a chunk
+        compression: None or "zlib"
+            Whether to deflate the chunks
+        level: int
+            The zlib compression level, 1 (fast) to 9 (small)
+        dtype: np.float32 or np.float64
+            The precision of the stored samples
+        overwrite: bool
+            Whether to replace an existing trace directory
+    '''
+
+    def __init__(self, directory, variables=("V",), neurons=None, every=1, method="sample", chunk_bytes=16 * 2**20,
+                 neuron_block=1024, compression=None, level=1, dtype=np.float32, overwrite=False):
+        if method not in DOWNSAMPLING:
+            raise ValueError(f"Unknown downsampling method {method!r}, expected one of {DOWNSAMPLING}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {COMPRESSIONS}")
+        if os.path.exists(os.path.join(directory, "traces.json")):
+            if not overwrite:
+                raise FileExistsError(f"{directory} already holds traces; pass overwrite=True to replace them")
+            shutil.rmtree(directory)
+        self.directory = directory
+        self.variables = tuple(variables)
+        self.neurons = None if neurons is None else np.asarray(neurons, dtype=np.int64)
+        self.every = every
+        self.method = method
+        self.chunk_bytes = chunk_bytes
+        self.neuron_block = neuron_block
+        self.compression = compression
+        self.level = level
+        self.dtype = np.dtype(dtype)
+        for name in ("t",) + self.variables:
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+        self.chunks = []    # (n_samples, t_first, t_last) of every written chunk
+        self._buffers = None
+        self._n = 0
+        self._sums = None
+        self._steps = 0
+
+    def _Allocate(self, n_neurons):
+        self.n_neurons = n_neurons
+        self.chunk_size = max(self.chunk_bytes // (max(n_neurons, 1) * self.dtype.itemsize), 1)
+        self._t = np.empty(self.chunk_size)
+        self._buffers = {name: np.empty((self.chunk_size, n_neurons), dtype=self.dtype) for name in self.variables}
+        if self.method == "mean":
+            self._sums = {name: np.zeros(n_neurons) for name in self.variables}
+
+    def Append(self, t, values):
+        '''
+        Records one sample of every variable
+
+        Inputs
+            t: float
+                The time of the sample (ms)
+            values: dict of name -> array of shape (N,)
+                The state of all neurons; the recorded neurons are selected here
+        '''
+        self._Append(t, {name: self._Select(values[name]) for name in self.variables})
+
+    def _Select(self, x):
+        return x if self.neurons is None else x[self.neurons]
+
+    def _Append(self, t, samples):
+        if self._buffers is None:
+            self._Allocate(len(samples[self.variables[0]]))
+        for name in self.variables:
+            self._buffers[name][self._n] = samples[name]
+        self._t[self._n] = t
+        self._n += 1
+        if self._n == self.chunk_size:
+            self.Flush()
+
+    def Record(self, population):
+        '''
+        Takes the state of a population after one step, downsampled as configured
+
+        Pass the writer as the recorder of ConductanceBasedPopulation.Run or
+        Network.Run, or call it after every step.
+        '''
+        values = {name: population.V if name == "V" else population.Gate(name) for name in self.variables}
+        self._steps += 1
+        if self.method == "sample":
+            if self._steps % self.every == 0:
+                self.Append(population.t, values)
+            return
+        if self._sums is None:
+            self._Allocate(len(self._Select(values[self.variables[0]])))
+        for name in self.variables:
+            self._sums[name] += self._Select(values[name])
+        if self._steps % self.every == 0:
+            self._Append(population.t, {name: s / self.every for name, s in self._sums.items()})
+            for s in self._sums.values():
+                s.fill(0)
+
+    def _Write(self, name, stem, data):
+        path = os.path.join(self.directory, name, stem)
+        if self.compression == "zlib":
+            path += ".zlib"
+            with open(path + ".tmp", "wb") as f:
+                f.write(zlib.compress(np.ascontiguousarray(data).tobytes(), self.level))
+        else:
+            path += ".npy"
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, data)
+        # Readers never see a half-written chunk
+        os.replace(path + ".tmp", path)
+
+    def Flush(self):
+        '''
+        Writes the buffered samples as a new chunk and updates the metadata
+        '''
+        if self._n == 0:
+            return
+        index = len(self.chunks)
+        self._Write("t", f"{index:06d}", self._t[:self._n])
+        for name in self.variables:
+            for block, start in enumerate(range(0, self.n_neurons, self.neuron_block)):
+                self._Write(name, f"{index:06d}_{block:04d}",
+                            self._buffers[name][:self._n, start:start + self.neuron_block])
+        self.chunks.append((self._n, float(self._t[0]), float(self._t[self._n - 1])))
+        self._n = 0
+        self._WriteMetadata()
+
+    def _WriteMetadata(self):
+        meta = {"variables": list(self.variables), "dtype": self.dtype.str,
+                "n_neurons": getattr(self, "n_neurons", 0),
+                "neurons": None if self.neurons is None else self.neurons.tolist(),
+                "every": self.every, "method": self.method, "compression": self.compression,
+                "neuron_block": self.neuron_block,
+                "chunks": self.chunks}
+        path = os.path.join(self.directory, "traces.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+
+    def Close(self):
+        '''
+        Writes the last, partial chunk
+        '''
+        self.Flush()
+        self._WriteMetadata()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
+
+
+class TraceStore:
+    '''
+    Lazy, windowed access to a trace directory written by TraceWriter
+
+    Attributes
+        variables: list of str
+            The recorded variables
+        neurons: array
+            The index of the neuron in each recorded column
+        n_samples: int
+            The number of samples per variable
+        t_range: (float, float)
+            The times of the first and last samples (ms)
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "traces.json")) as f:
+            meta = json.load(f)
+        self.variables = meta["variables"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.compression = meta["compression"]
+        self.every = meta["every"]
+        self.method = meta["method"]
+        self.neuron_block = meta["neuron_block"]
+        n_neurons = meta["n_neurons"]
+        self.neurons = np.arange(n_neurons) if meta["neurons"] is None else np.asarray(meta["neurons"])
+        # The recorded neurons in increasing order, and the column of each
+        self._column_order = np.argsort(self.neurons, kind="stable")
+        self._sorted_neurons = self.neurons[self._column_order]
+        chunks = np.array(meta["chunks"], dtype=np.float64).reshape(-1, 3)
+        self._sizes = chunks[:, 0].astype(np.int64)
+        self._starts = np.concatenate([[0], np.cumsum(self._sizes)])
+        self._t_first, self._t_last = chunks[:, 1], chunks[:, 2]
+        self._cache = {}
+
+    @property
+    def n_samples(self):
+        return int(self._starts[-1])
+
+    @property
+    def n_chunks(self):
+        return len(self._sizes)
+
+    @property
+    def t_range(self):
+        return (float(self._t_first[0]), float(self._t_last[-1])) if len(self._sizes) else (np.nan, np.nan)
+
+    def Chunk(self, name, index, block=0):
+        '''
+        One block of neurons of a chunk of a variable ("t" for the times, which has
+        no blocks), memory-mapped or inflated
+
+        The last inflated file of each variable and block is kept, so reading
+        consecutive windows does not inflate it again.
+        '''
+        path = os.path.join(self.directory, name, f"{index:06d}" if name == "t" else f"{index:06d}_{block:04d}")
+        if self.compression is None:
+            return np.load(path + ".npy", mmap_mode="r")
+        cached = self._cache.get((name, block))
+        if cached is not None and cached[0] == index:
+            return cached[1]
+        with open(path + ".zlib", "rb") as f:
+            data = np.frombuffer(zlib.decompress(f.read()), dtype=np.float64 if name == "t" else self.dtype)
+        if name != "t":
+            data = data.reshape(self._sizes[index], -1)
+        self._cache[(name, block)] = (index, data)
+        return data
+
+    def _Columns(self, neurons):
+        '''
+        The stored column of each neuron, in any order the writer recorded them in
+        '''
+        if neurons is None:
+            return np.arange(len(self.neurons))
+        neurons = np.atleast_1d(np.asarray(neurons))
+        position = np.minimum(np.searchsorted(self._sorted_neurons, neurons), max(len(self.neurons) - 1, 0))
+        recorded = self._sorted_neurons[position] == neurons if len(self.neurons) else np.zeros(len(neurons), bool)
+        if not recorded.all():
+            raise KeyError(f"Neurons {neurons[~recorded]} were not recorded")
+        return self._column_order[position]
+
+    def Read(self, name, t_start=None, t_end=None, neurons=None):
+        '''
+        Reads the samples of a variable in a time window
+
+        Inputs
+            name: str
+                The variable
+            t_start, t_end: float, optional
+                The window [t_start, t_end] (ms); defaults to the whole run
+            neurons: integer array, optional
+                The neurons to read (defaults to every recorded neuron)
+
+        Outputs
+            (t, values): the sample times, and an array of shape (n_samples, n_neurons)
+        '''
+        if name not in self.variables:
+            raise KeyError(f"Variable {name!r} was not recorded; the store has {self.variables}")
+        t_start = -np.inf if t_start is None else t_start
+        t_end = np.inf if t_end is None else t_end
+        columns = self._Columns(neurons)
+        blocks = columns // self.neuron_block
+        chunks = np.flatnonzero((self._t_last >= t_start) & (self._t_first <= t_end))
+        times, values = [], []
+        for index in chunks:
+            t = self.Chunk("t", index)
+            lo, hi = np.searchsorted(t, t_start, "left"), np.searchsorted(t, t_end, "right")
+            times.append(np.array(t[lo:hi]))
+            window = np.empty((hi - lo, len(columns)), dtype=self.dtype)
+            for block in np.unique(blocks):
+                selected = blocks == block
+                window[:, selected] = self.Chunk(name, index, block)[lo:hi][:, columns[selected]
+                                                                             - block * self.neuron_block]
+            values.append(window)
+        if not times:
+            return np.empty(0), np.empty((0, len(columns)), dtype=self.dtype)
+        return np.concatenate(times), np.concatenate(values)
+
+    def Times(self, t_start=None, t_end=None):
+        '''
+        The sample times in a window (ms)
+        '''
+        t_start = -np.inf if t_start is None else t_start
+        t_end = np.inf if t_end is None else t_end
+        times = [np.array(t[np.searchsorted(t, t_start, "left"):np.searchsorted(t, t_end, "right")])
+                 for t in (self.Chunk("t", index) for index in
+                           np.flatnonzero((self._t_last >= t_start) & (self._t_first <= t_end)))]
+        return np.concatenate(times) if times else np.empty(0)
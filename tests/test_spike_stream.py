@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from neurodyn.spike_stream import SpikeStreamStats
+
+# Six bursts of four spikes 2 ms apart, one every 66 ms
+BURST_TIMES = (np.arange(6)[:, None] * 66.0 + np.arange(4) * 2.0).ravel()
+
+
+@pytest.mark.parametrize("warmup_intervals", [4, 5, 8, 12])
+def test_burst_counts_do_not_depend_on_warmup(warmup_intervals):
+    # Every warmup that holds the first long interval finds every burst, whole
+    stats = SpikeStreamStats(1, warmup_intervals=warmup_intervals)
+    stats.Update(np.zeros(len(BURST_TIMES), dtype=np.int64), BURST_TIMES)
+    results = stats.Results()
+    assert results["n_bursts"][0] == 6
+    assert results["burst_spikes"][0] == 24
+
+
+@pytest.mark.parametrize("warmup_intervals", [4, 8])
+def test_burst_counts_by_chunk(warmup_intervals):
+    stats = SpikeStreamStats(1, warmup_intervals=warmup_intervals)
+    for chunk in np.array_split(BURST_TIMES, 7):
+        stats.Update(np.zeros(len(chunk), dtype=np.int64), chunk)
+        # Results() replays the intervals held so far without consuming them
+        stats.Results()
+    results = stats.Results()
+    assert results["n_bursts"][0] == 6
+    assert results["burst_spikes"][0] == 24
+
+
+def test_last_warmup_interval_is_tested():
+    stats = SpikeStreamStats(1, warmup_intervals=2)
+    stats.Update([0, 0, 0], [0.0, 20.0, 21.0])
+    # The 1 ms interval is short against the 10.5 ms mean, and opens a candidate
+    np.testing.assert_array_equal(stats._run, [2])
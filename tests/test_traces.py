@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from neurodyn.traces import TraceWriter, TraceStore
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_unsorted_neuron_subset(tmp_path, compression):
+    neurons = [7, 2, 5]
+    V = np.arange(40 * 10, dtype=np.float32).reshape(40, 10)
+    # Small chunks and blocks, so that a read spans several of each
+    with TraceWriter(tmp_path / "run", neurons=neurons, chunk_bytes=3 * 4 * 16, neuron_block=2,
+                     compression=compression) as writer:
+        for k, row in enumerate(V):
+            writer.Append(float(k), {"V": row})
+    store = TraceStore(tmp_path / "run")
+    assert store.n_chunks == 3
+    for subset in ([2], [7], [5, 7], [2, 5, 7], [7, 2, 5]):
+        t, values = store.Read("V", neurons=subset)
+        np.testing.assert_array_equal(t, np.arange(40))
+        np.testing.assert_array_equal(values, V[:, subset])
+    t, values = store.Read("V", t_start=10, t_end=20)
+    np.testing.assert_array_equal(values, V[10:21][:, neurons])
+    with pytest.raises(KeyError, match=r"\[3\]"):
+        store.Read("V", neurons=[2, 3])